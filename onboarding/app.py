@@ -18,7 +18,12 @@ from tornado.options import options
 import koi
 
 from .controllers import (root_handler, capabilities_handler,
-                          repository_handler)
+                          repository_handler, cache_handler,
+                          connections_handler, metrics_handler,
+                          profile_handler, bulk_handler, upload_handler)
+from .models import (clients, compression, executor, idempotency, jobs,
+                     metrics, remote, resilience, scheduler, tracing,
+                     uploads, watchdog)
 from . import __version__
 
 # directory containing the config files
@@ -29,13 +34,90 @@ APPLICATION_URLS = [
     (r"", root_handler.RootHandler, {'version': __version__}),
     (r"/capabilities", capabilities_handler.CapabilitiesHandler),
 
+    # GET - hit/miss counters of the in-process caches
+    # DELETE - flush the in-process caches
+    (r"/caches", cache_handler.CacheHandler),
+    (r"/caches/{name}", cache_handler.CacheHandler),
+
+    # GET - pool utilisation and timings of connections to other services
+    (r"/connections", connections_handler.ConnectionsHandler),
+
+    # GET - latency histograms and counters of all processes, in the
+    # Prometheus text format
+    (r"/metrics", metrics_handler.MetricsHandler),
+
+    # POST - cProfile the process handling the request for a few seconds
+    (r"/profile", profile_handler.ProfileHandler),
+
     # Repository assets endpoints
     # POST - onboard assets to an organisations repository
     (r"/repositories/{repository_id}/assets",
-     repository_handler.AssetHandler)
+     repository_handler.AssetHandler),
+
+    # POST - start a resumable upload of assets to a repository
+    (r"/repositories/{repository_id}/uploads", upload_handler.UploadsHandler),
+
+    # GET - chunks received by an upload
+    # POST - onboard the upload's assets
+    # DELETE - cancel the upload
+    (r"/repositories/{repository_id}/uploads/{upload_id}",
+     upload_handler.UploadHandler),
+
+    # PUT - a numbered chunk of an upload
+    (r"/repositories/{repository_id}/uploads/{upload_id}/chunks/{number}",
+     upload_handler.UploadChunkHandler),
+
+    # POST - onboard assets to several repositories
+    (r"/bulk/assets", bulk_handler.BulkAssetHandler),
+
+    # GET - status and result of an asynchronous onboarding job
+    (r"/repositories/{repository_id}/jobs/{job_id}",
+     repository_handler.JobHandler)
 ]
 
 
+def application_urls():
+    """
+    The service's endpoints. If the stream_uploads option is set, assets
+    are onboarded as the request body is received.
+    """
+    if not options.stream_uploads:
+        return APPLICATION_URLS
+
+    return [(url, repository_handler.AssetStreamHandler) + tuple(rest)
+            if handler is repository_handler.AssetHandler
+            else (url, handler) + tuple(rest)
+            for url, handler, rest in
+            ((endpoint[0], endpoint[1], endpoint[2:])
+             for endpoint in APPLICATION_URLS)]
+
+
+def configure():
+    """Configure the service's models from the loaded options"""
+    clients.configure()
+    remote.configure()
+    jobs.configure()
+    executor.configure()
+    idempotency.configure()
+    compression.configure()
+    metrics.configure()
+    tracing.configure()
+    resilience.configure()
+    scheduler.configure()
+    uploads.configure()
+
+
+def make_application():
+    """Create the service's tornado Application"""
+    app = koi.make_application(
+        __version__,
+        options.service_type,
+        application_urls())
+    if options.compress_responses_min_size:
+        app.add_transform(compression.GZipContentEncoding)
+    return app
+
+
 def main():
     """
     The entry point for the Onboarding service.
@@ -55,14 +137,13 @@ def main():
             + python template --syslog_host=54.77.151.169
     """
     koi.load_config(CONF_DIR)
-    app = koi.make_application(
-        __version__,
-        options.service_type,
-        APPLICATION_URLS)
-    server = koi.make_server(app)
+    configure()
+    server = koi.make_server(make_application())
 
     # Forks multiple sub-processes, one for each core
     server.start(int(options.processes))
+    metrics.start()
+    watchdog.start()
 
     tornado.ioloop.IOLoop.instance().start()
 
@@ -0,0 +1,197 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""Onboard assets to several repositories with one request"""
+import json
+
+from tornado.gen import coroutine, Return
+from tornado.locks import Semaphore
+from tornado.options import options
+from koi import exceptions
+
+from onboarding.controllers.repository_handler import AssetHandler
+from onboarding.models import assets, metrics, remote, scheduler
+from onboarding.models.remote import get_repository
+from onboarding.utils import ignore_result
+
+
+class BulkAssetHandler(AssetHandler):
+    """
+    Onboards a list of payloads, each to its own repository, or one
+    payload to a list of repositories.
+
+    The repositories are onboarded to concurrently, up to
+    max_concurrent_bulk_repositories at a time, and each distinct payload
+    is sent to the transformation service once.
+    """
+
+    SUPPORTED_METHODS = ('POST', 'OPTIONS')
+
+    @coroutine
+    def post(self):
+        """Respond with the assets onboarded to each repository"""
+        if self.request.headers.get('Authorization') is None:
+            raise exceptions.HTTPError(401, 'OAuth token not provided')
+        self.verify_body_size()
+        self.decode_body()
+        items = self.get_items()
+
+        limit = Semaphore(options.max_concurrent_bulk_repositories)
+        responses = {}
+        onboarded = []
+        for item in items:
+            # each repository's calls are queued in its own share
+            with scheduler.activate(self.share(item['repository_id'])):
+                onboarded.append(self.onboard(item, limit, responses))
+        results = yield onboarded
+
+        failed = any(result['status'] != 200 for result in results)
+        status = 207 if failed else 200
+        self.set_status(status)
+        self.finish({'status': status, 'data': results})
+
+    def get_items(self):
+        """
+        Read and validate the repositories and payloads from the body
+
+        :returns: list of dicts with the repository_id, content_type and
+            data of each repository
+        :raises: HTTPError
+        """
+        body = self.get_json_body()
+        if not isinstance(body, dict):
+            raise exceptions.HTTPError(400, 'Body must be a JSON object')
+
+        if 'items' in body:
+            items = body['items']
+        elif 'repositories' in body:
+            repositories = body['repositories']
+            if not isinstance(repositories, list):
+                raise exceptions.HTTPError(400, 'repositories must be a list')
+            items = [{'repository_id': repository_id,
+                      'content_type': body.get('content_type'),
+                      'data': body.get('data')}
+                     for repository_id in repositories]
+        else:
+            raise exceptions.HTTPError(
+                400, 'Body must include either items or repositories')
+
+        if not isinstance(items, list) or not items:
+            raise exceptions.HTTPError(400, 'No repositories to onboard to')
+        if len(items) > options.max_bulk_repositories:
+            raise exceptions.HTTPError(
+                400, 'At most {} repositories can be onboarded to at once'
+                .format(options.max_bulk_repositories))
+
+        return [self.verify_item(item) for item in items]
+
+    def verify_item(self, item):
+        """
+        Validate a repository and payload
+
+        :param item: dict with the repository_id, content_type and data
+        :returns: the item with the data as a string
+        :raises: HTTPError
+        """
+        try:
+            repository_id = item['repository_id']
+            content_type = item['content_type']
+            data = item['data']
+        except (KeyError, TypeError):
+            raise exceptions.HTTPError(
+                400, 'Each item must have a repository_id, content_type '
+                     'and data')
+
+        if not isinstance(repository_id, basestring) or not repository_id:
+            raise exceptions.HTTPError(400, 'Invalid repository_id')
+        self.verify_content_type(content_type or '')
+        if data is None:
+            raise exceptions.HTTPError(400, 'Missing data')
+        if not isinstance(data, basestring):
+            data = json.dumps(data)
+
+        return {'repository_id': repository_id,
+                'content_type': content_type,
+                'data': data}
+
+    def transform_once(self, item, responses):
+        """
+        Start transforming an item's data with the transformation service,
+        unless the same data is already being transformed
+
+        :param item: the repository and payload
+        :param responses: Futures returned by remote.transform by content
+            type and data
+        :returns: a Future resolving to the transformed data, or None if
+            the data will be transformed in batches when it is onboarded
+        """
+        data, content_type = item['data'], item['content_type']
+        if assets.batches(data, content_type):
+            return None
+
+        r2rml_url = self.get_argument('r2rml_url', None)
+        local_transform = self.local_transform()
+        response = None
+        if not assets.use_local_transform(r2rml_url, local_transform):
+            key = (content_type, data)
+            if key not in responses:
+                responses[key] = remote.transform(data, content_type,
+                                                  r2rml_url)
+            response = responses[key]
+
+        return assets.transform(data, content_type, item['repository_id'],
+                                r2rml_url=r2rml_url,
+                                local_transform=local_transform,
+                                response=response)
+
+    @coroutine
+    def onboard(self, item, limit, responses):
+        """
+        Onboard an item's data to its repository
+
+        :param item: the repository and payload
+        :param limit: Semaphore limiting the repositories onboarded to
+            concurrently
+        :param responses: see transform_once
+        :returns: the repository's result, with the repository_id, status,
+            and the onboarded assets or errors
+        """
+        repository_id = item['repository_id']
+        with (yield limit.acquire()):
+            try:
+                token = self.get_token(repository_id)
+                repository = get_repository(repository_id)
+                try:
+                    token = yield token
+                except Exception:
+                    ignore_result(repository)
+                    raise
+                repository = yield repository
+
+                data, http_status, errors = yield assets.onboard(
+                    item['data'],
+                    item['content_type'],
+                    repository['service']['location'],
+                    repository_id,
+                    token=token,
+                    r2rml_url=self.get_argument('r2rml_url', None),
+                    transformed=self.transform_once(item, responses),
+                    local_transform=self.local_transform())
+            except exceptions.HTTPError as exc:
+                result = self._error_template(exc.status_code, exc.errors,
+                                              exc.source)
+                result['repository_id'] = repository_id
+                raise Return(result)
+
+        metrics.ASSETS.observe(len(data or []), method='POST')
+        result = {'repository_id': repository_id, 'status': 200,
+                  'data': data or []}
+        if errors:
+            result.update(status=http_status, errors=errors)
+        raise Return(result)
@@ -0,0 +1,56 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""Admin handler for the service's in-process caches"""
+
+from koi.base import BaseHandler
+from koi import exceptions
+
+from onboarding.models import cache
+
+
+class CacheHandler(BaseHandler):
+
+    """Reports on and flushes the caches in this process"""
+
+    def get_caches(self, name):
+        """
+        Get the caches selected by the request
+
+        :param name: the name of a cache, or None for all caches
+        :returns: dictionary of caches by name
+        :raises: HTTPError if there isn't a cache called name
+        """
+        if name is None:
+            return dict(cache.CACHES)
+
+        try:
+            return {name: cache.CACHES[name]}
+        except KeyError:
+            raise exceptions.HTTPError(404, 'Unknown cache "{}"'.format(name))
+
+    def get(self, name=None):
+        """GET the size and hit/miss counters of the caches"""
+        msg = {
+            'status': 200,
+            'data': {k: v.stats() for k, v in self.get_caches(name).items()}
+        }
+        self.finish(msg)
+
+    def delete(self, name=None):
+        """DELETE the entries of the caches"""
+        caches = self.get_caches(name)
+        for value in caches.values():
+            value.clear()
+
+        msg = {
+            'status': 200,
+            'data': {'flushed': sorted(caches.keys())}
+        }
+        self.finish(msg)
@@ -23,12 +23,17 @@ class CapabilitiesHandler(BaseHandler):
     def get(self):
         """GET current service capabilities.
 
-        Returns a JSON with info on the maximum body size for a post.
+        Returns a JSON with info on the maximum body size for a post, and
+        for a streamed post if streaming is enabled, and the maximum size
+        of a compressed post once it is decompressed.
         """
         msg = {
             'status': 200,
             'data': {
-                'max_post_body_size': options.max_post_body_size
+                'max_post_body_size': options.max_post_body_size,
+                'stream_uploads': bool(options.stream_uploads),
+                'max_stream_body_size': options.max_stream_body_size,
+                'max_decoded_body_size': options.max_decoded_body_size
             }
         }
         self.finish(msg)
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""Admin handler reporting on connections to other services"""
+
+from koi.base import BaseHandler
+
+from onboarding.models import clients
+
+
+class ConnectionsHandler(BaseHandler):
+
+    """Returns the pool utilisation and timings for each host"""
+
+    def get(self):
+        """GET the stats of the shared HTTP clients in this process"""
+        msg = {
+            'status': 200,
+            'data': clients.stats()
+        }
+        self.finish(msg)
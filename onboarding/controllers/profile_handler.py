@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""Admin handler profiling the process that handles the request"""
+import os
+
+from tornado.gen import coroutine
+from tornado.options import options
+from koi.base import BaseHandler
+from koi import exceptions
+
+from onboarding.models import profiler
+
+
+class ProfileHandler(BaseHandler):
+
+    """Takes a time-boxed cProfile of a running process"""
+
+    @coroutine
+    def post(self):
+        """POST to profile the process for a number of seconds"""
+        if not options.profile_max_seconds:
+            raise exceptions.HTTPError(404, 'Profiling is not enabled')
+
+        try:
+            seconds = float(self.get_argument('seconds', 10))
+            limit = int(self.get_argument('limit', 50))
+        except ValueError:
+            raise exceptions.HTTPError(400, 'seconds and limit must be numbers')
+        if not 0 < seconds <= options.profile_max_seconds:
+            raise exceptions.HTTPError(
+                400, 'seconds must be more than 0 and at most {}'.format(
+                    options.profile_max_seconds))
+
+        sort = self.get_argument('sort', 'cumulative')
+        if sort not in profiler.SORT_KEYS:
+            raise exceptions.HTTPError(
+                400, 'sort must be one of {}'.format(
+                    ', '.join(profiler.SORT_KEYS)))
+
+        try:
+            report = yield profiler.profile(seconds, sort, limit)
+        except profiler.ProfileRunning as exc:
+            raise exceptions.HTTPError(409, str(exc))
+
+        self.set_header('Content-Type', 'text/plain; charset=UTF-8')
+        self.set_header('X-Process-Id', str(os.getpid()))
+        self.finish(report)
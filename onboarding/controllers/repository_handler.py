@@ -13,20 +13,109 @@
 # limitations under the License.
 
 """API assets handler. Returns information on onboarded assets"""
+import json
 import logging
+import math
+from functools import partial
 
 from tornado.gen import coroutine, Return
 from tornado.options import options
+from tornado.web import stream_request_body
 from koi import base, exceptions
 
 from onboarding.models.remote import get_repository, exchange_delegate_token
-from onboarding.models import assets
+from onboarding.models.tokens import token_subject
+from onboarding.models import (assets, compression, idempotency, jobs,
+                               metrics, records, resilience, scheduler,
+                               tracing)
+from onboarding.utils import ignore_result
+
+
+@coroutine
+def delegated_token(request, repository_id):
+    """
+    Exchange the request's token for a token granting access to the
+    repository
+
+    :param request: the HTTP request
+    :param repository_id: str
+    :returns: the delegated token
+    """
+    token = request.headers.get('Authorization')
+    if token is None:
+        raise exceptions.HTTPError(401, 'OAuth token not provided')
+    token = token.split()[-1]
+
+    new_token = yield exchange_delegate_token(token, repository_id)
+    raise Return(new_token)
 
 
 class AssetHandler(base.CorsHandler, base.JsonHandler):
     """Onboarding Rights Raw Data to RDF data into a repository"""
 
     CONTENT_TYPES = ['text/csv', 'application/json']
+    # media type of responses with one JSON document per line
+    NDJSON = 'application/x-ndjson'
+    # the request's span, see _execute
+    span = None
+    # the request's share, see _execute
+    _share = None
+    # whether the request counts towards max_in_flight_requests
+    in_flight = False
+    # bytes written in the response body, see flush
+    response_bytes = 0
+
+    def _execute(self, transforms, *args, **kwargs):
+        """
+        Handle the request in its own span of a trace, with the request's
+        share of the transformation and repository services (see
+        scheduler)
+        """
+        self.span = tracing.request_span(self.request, 'assets')
+        self._share = self.share(kwargs.get('repository_id'))
+        with tracing.activate(self.span), scheduler.activate(self._share):
+            future = super(AssetHandler, self)._execute(
+                transforms, *args, **kwargs)
+
+        future.add_done_callback(
+            lambda _: self.span.finish(status=self.get_status()))
+        return future
+
+    def prepare(self):
+        """
+        Reject the request if it has an invalid priority, or too many
+        requests are in flight
+        """
+        if self.request.method not in ('POST', 'DELETE'):
+            return
+        if self.priority() not in scheduler.PRIORITIES:
+            raise exceptions.HTTPError(
+                400, '{} header must be one of {}'.format(
+                    scheduler.HEADER, ', '.join(sorted(scheduler.PRIORITIES))))
+        if not resilience.requests.acquire():
+            raise resilience.Unavailable(
+                'Too many requests, retry later', resilience.retry_after)
+        self.in_flight = True
+
+    def flush(self, include_footers=False, callback=None):
+        """Count the bytes of the response body (before compression)"""
+        self.response_bytes += sum(len(part) for part in self._write_buffer)
+        return super(AssetHandler, self).flush(include_footers, callback)
+
+    def on_finish(self):
+        metrics.RESPONSE_BYTES.inc(self.response_bytes,
+                                   method=self.request.method)
+        if self.in_flight:
+            self.in_flight = False
+            resilience.requests.release()
+
+    def write_error(self, status_code, **kwargs):
+        """Ask clients to retry requests that failed with 503 later"""
+        if status_code == 503:
+            exc = kwargs.get('exc_info', (None, None))[1]
+            retry_after = getattr(exc, 'retry_after', resilience.retry_after)
+            self.set_header('Retry-After', int(math.ceil(retry_after)))
+        super(AssetHandler, self).write_error(status_code, **kwargs)
 
     @coroutine
     def post(self, repository_id):
@@ -35,21 +124,31 @@ class AssetHandler(base.CorsHandler, base.JsonHandler):
 
         :param repository_id: str
         """
-        token = yield self.get_token(repository_id)
-
-        self.verify_content_type()
-        self.verify_body_size()
+        token, repository_url, transformed = yield self.start(repository_id)
+        if self.is_async():
+            self.submit_job(assets.onboard, repository_id, repository_url)
+            return
+        if self.streams_response():
+            yield self.stream_response(assets.onboard, repository_id,
+                                       repository_url, token, transformed)
+            return
 
-        repository = yield get_repository(repository_id)
-        repository_url = repository['service']['location']
-
-        data, http_status, errors = yield assets.onboard(
-            self.request.body,
-            self.request.headers.get('Content-Type', None),
-            repository_url,
-            repository_id,
-            token=token,
-            r2rml_url=self.get_argument("r2rml_url", None))
+        # the transform is unused if an earlier request's result is shared
+        ignore_result(transformed)
+        key, fingerprint = self.request_key(repository_id)
+        data, http_status, errors = yield idempotency.run_once(
+            key, fingerprint,
+            partial(assets.onboard,
+                    self.request.body,
+                    self.request.headers.get('Content-Type', None),
+                    repository_url,
+                    repository_id,
+                    token=token,
+                    r2rml_url=self.get_argument("r2rml_url", None),
+                    transformed=transformed,
+                    local_transform=self.local_transform()),
+            ttl=options.onboard_result_ttl)
+        metrics.ASSETS.observe(len(data or []), method='POST')
 
         if not errors:
             self.finish({'status': 200, 'data': data})
@@ -65,13 +164,17 @@ class AssetHandler(base.CorsHandler, base.JsonHandler):
 
         :param repository_id: str
         """
-        token = yield self.get_token(repository_id)
-
-        self.verify_content_type()
-        self.verify_body_size()
-
-        repository = yield get_repository(repository_id)
-        repository_url = repository['service']['location']
+        token, repository_url, transformed = yield self.start(repository_id)
+        if self.is_async():
+            self.submit_job(assets.delete, repository_id, repository_url)
+            return
+        if self.streams_response():
+            try:
+                yield self.stream_response(assets.delete, repository_id,
+                                           repository_url, token, transformed)
+            finally:
+                idempotency.forget(repository_id)
+            return
 
         data, http_status, errors = yield assets.delete(
             self.request.body,
@@ -79,7 +182,12 @@ class AssetHandler(base.CorsHandler, base.JsonHandler):
             repository_url,
             repository_id,
             token=token,
-            r2rml_url=self.get_argument("r2rml_url", None))
+            r2rml_url=self.get_argument("r2rml_url", None),
+            transformed=transformed,
+            local_transform=self.local_transform())
+        # repeated requests onboard the deleted assets again
+        idempotency.forget(repository_id)
+        metrics.ASSETS.observe(len(data or []), method='DELETE')
 
         if not errors:
             self.finish({'status': 200, 'data': data})
@@ -89,19 +197,256 @@ class AssetHandler(base.CorsHandler, base.JsonHandler):
                 {'errors': errors, 'data': data})
 
     @coroutine
+    def start(self, repository_id):
+        """
+        Validate the request and concurrently get the delegated token, look
+        up the repository and transform the data.
+
+        Errors are raised in the same order as if the calls were made one
+        after the other: token (401/403), content (415/400) and then
+        repository (404). Once one of them fails the results of the others
+        are ignored.
+
+        :param repository_id: str
+        :returns: the delegated token, the repository's url and a Future
+            resolving to the transformed data (or None)
+        """
+        token = self.get_token(repository_id)
+        repository = get_repository(repository_id)
+
+        try:
+            self.verify_content_type()
+            self.verify_body_size()
+            self.decode_body()
+        except exceptions.HTTPError as exc:
+            ignore_result(repository)
+            yield token
+            raise exc
+
+        transformed = self.transform(repository_id)
+
+        try:
+            token = yield token
+            repository = yield repository
+        except Exception:
+            ignore_result(repository, transformed)
+            raise
+
+        raise Return((token, repository['service']['location'], transformed))
+
+    def transform(self, repository_id):
+        """
+        Start transforming the request body. Large bodies are transformed in
+        batches when they are onboarded instead.
+
+        :param repository_id: str
+        :returns: Future resolving to the transformed data, or None
+        """
+        content_type = self.request.headers.get('Content-Type', None)
+        if self.is_async() or assets.batches(self.request.body, content_type):
+            return None
+        if (self.request.method == 'POST' and
+                idempotency.is_known(self.request_key(repository_id)[0])):
+            # the result will be shared with an earlier request
+            return None
+
+        return assets.transform(
+            self.request.body,
+            content_type,
+            repository_id,
+            r2rml_url=self.get_argument("r2rml_url", None),
+            local_transform=self.local_transform())
+
+    def local_transform(self):
+        """
+        Whether the request asks for the data to be transformed with the
+        default mapping in this service
+
+        :returns: True or False, or None to use the local_transform option
+        """
+        value = self.get_argument('local_transform', None)
+        if not value:
+            return None
+        return value.lower() in ('true', '1')
+
+    def request_key(self, repository_id):
+        """
+        The key used to share the result of onboarding with identical
+        requests, see idempotency.request_key
+
+        :param repository_id: str
+        :returns: the key (or None) and the request's fingerprint
+        """
+        if not hasattr(self, '_request_key'):
+            fingerprint = idempotency.fingerprint(
+                self.request.body,
+                self.request.headers.get('Content-Type', None),
+                repository_id,
+                self.get_argument("r2rml_url", None),
+                self.local_transform())
+            key = idempotency.request_key(
+                repository_id, fingerprint,
+                self.request.headers.get('Idempotency-Key'),
+                dedupe_by_content=options.dedupe_by_content)
+            self._request_key = (key, fingerprint)
+
+        return self._request_key
+
+    def is_async(self):
+        """Whether the request should be processed in a background job"""
+        value = self.get_argument('async', None) or ''
+        return value.lower() in ('true', '1')
+
+    def streams_response(self):
+        """Whether the client accepts the assets as newline delimited JSON"""
+        return self.NDJSON in self.request.headers.get('Accept', '')
+
+    @coroutine
+    def stream_response(self, func, repository_id, repository_url, token,
+                        transformed):
+        """
+        Process the request body and respond with each asset as a line of
+        JSON, written as soon as the batch of records it came from has been
+        stored, followed by a line with the status and any errors.
+
+        The response is not cached for identical requests, because the
+        assets are not kept in memory.
+
+        :param func: assets.onboard or assets.delete
+        :param repository_id: str
+        :param repository_url: url of the repository service
+        :param token: the delegated token
+        :param transformed: Future resolving to the transformed data, or
+            None
+        """
+        written = [0]
+
+        def write_assets(id_map):
+            self.write_assets(id_map)
+            written[0] += len(id_map)
+
+        _, http_status, errors = yield func(
+            self.request.body,
+            self.request.headers.get('Content-Type', None),
+            repository_url,
+            repository_id,
+            token=token,
+            r2rml_url=self.get_argument("r2rml_url", None),
+            transformed=transformed,
+            local_transform=self.local_transform(),
+            on_assets=write_assets)
+        metrics.ASSETS.observe(written[0], method=self.request.method)
+        self.finish_assets(written[0], http_status, errors)
+
+    def write_assets(self, id_map):
+        """Write assets as lines of JSON, see stream_response"""
+        self.set_header('Content-Type', self.NDJSON)
+        self.write(''.join(json.dumps(asset) + '\n' for asset in id_map))
+        ignore_result(self.flush())
+
+    def finish_assets(self, written, http_status, errors):
+        """
+        Finish a response streaming assets as lines of JSON with a line
+        with the status and any errors, see stream_response
+
+        :param written: the number of assets written
+        :param http_status: the status of onboarding
+        :param errors: errors returned during onboarding
+        :raises: HTTPError if onboarding failed before any asset was written
+        """
+        if errors and not written:
+            raise exceptions.HTTPError(http_status,
+                                       {'errors': errors, 'data': []})
+
+        # the status line has already been sent, so the outcome is given in
+        # the last line
+        status = {'status': http_status if errors else 200}
+        if errors:
+            status['errors'] = errors
+        self.set_header('Content-Type', self.NDJSON)
+        self.finish(json.dumps(status) + '\n')
+
+    def submit_job(self, func, repository_id, repository_url):
+        """
+        Queue a job to process the request body and respond with 202 and
+        the job
+
+        The delegated token is requested again when the job is run, because
+        it may have expired while the job was queued.
+
+        :param func: assets.onboard or assets.delete
+        :param repository_id: str
+        :param repository_url: url of the repository service
+        """
+        request = self.request
+        body = request.body
+        content_type = request.headers.get('Content-Type', None)
+        r2rml_url = self.get_argument("r2rml_url", None)
+        local_transform = self.local_transform()
+        share = scheduler.current()
+
+        @coroutine
+        def run(progress):
+            token = yield delegated_token(request, repository_id)
+            result = yield func(body, content_type, repository_url,
+                                repository_id, token=token,
+                                r2rml_url=r2rml_url, progress=progress,
+                                local_transform=local_transform)
+            if func is assets.delete:
+                idempotency.forget(repository_id)
+            metrics.ASSETS.observe(len(result[0] or []), method=request.method)
+            raise Return(result)
+
+        def work(progress):
+            # jobs are run outside of the request, in the request's share
+            with scheduler.activate(share):
+                return run(progress)
+
+        job = jobs.get_queue().submit(repository_id, work)
+        path = request.path.rsplit('/assets', 1)[0]
+        self.set_status(202)
+        self.set_header('Location', '{}/jobs/{}'.format(path, job['id']))
+        self.finish({'status': 202, 'data': job})
+
+    def priority(self):
+        """The priority the request asks for"""
+        return self.request.headers.get(
+            scheduler.HEADER, scheduler.DEFAULT_PRIORITY).strip().lower()
+
+    def share(self, repository_id):
+        """
+        The share the request's calls to other services are queued in: the
+        repository's, or the caller's if the schedule_share_by option is
+        "caller"
+
+        :param repository_id: str
+        :returns: a scheduler.Share
+        """
+        priority = self.priority()
+        if priority not in scheduler.PRIORITIES:
+            # rejected in prepare
+            priority = scheduler.DEFAULT_PRIORITY
+
+        queue = repository_id
+        if scheduler.share_by == 'caller':
+            token = self.request.headers.get('Authorization', '').split()
+            queue = token_subject(token[-1]) if token else None
+
+        return scheduler.Share(queue, priority)
+
     def get_token(self, repository_id):
         """Get a token granting access to the repository"""
-        token = self.request.headers.get('Authorization')
-        if token is None:
-            raise exceptions.HTTPError(401, 'OAuth token not provided')
-        token = token.split()[-1]
+        return delegated_token(self.request, repository_id)
 
-        new_token = yield exchange_delegate_token(token, repository_id)
-        raise Return(new_token)
+    def verify_content_type(self, content_type=None):
+        """
+        Return a 415 Unsupported Media Type error if invalid Content-Type
 
-    def verify_content_type(self):
-        """Return a 415 Unsupported Media Type error if invalid Content-Type"""
-        content_type = self.request.headers.get('Content-Type', '')
+        :param content_type: (optional) the content type to check, defaults
+            to the request's Content-Type header
+        """
+        if content_type is None:
+            content_type = self.request.headers.get('Content-Type', '')
 
         if content_type.split(';')[0] not in self.CONTENT_TYPES:
             msg = ('Unsupported content type "{}". '
@@ -110,12 +455,242 @@ class AssetHandler(base.CorsHandler, base.JsonHandler):
 
             raise exceptions.HTTPError(415, msg)
 
-    def verify_body_size(self):
+    def verify_content_encoding(self):
+        """
+        Return a 415 Unsupported Media Type error if the body is encoded
+        with something other than gzip or deflate
+
+        :returns: the Content-Encoding
+        """
+        encoding = self.request.headers.get('Content-Encoding', None)
+        if not compression.is_supported(encoding):
+            msg = ('Unsupported content encoding "{}". Content-Encoding '
+                   'header must be one of {}'.format(
+                       encoding, sorted(compression.WBITS)))
+            raise exceptions.HTTPError(415, msg)
+
+        return encoding
+
+    def decode_body(self):
+        """
+        Decompress a gzip or deflate encoded body. The Content-Length is
+        checked against max_post_body_size first, and the decompressed body
+        must be within max_decoded_body_size and max_compression_ratio.
+        """
+        metrics.REQUEST_BYTES.inc(len(self.request.body or ''),
+                                  method=self.request.method)
+        encoding = self.verify_content_encoding()
+        if not compression.is_compressed(encoding):
+            return
+
+        try:
+            self.request.body = compression.decompress(
+                self.request.body, encoding, options.max_decoded_body_size,
+                options.max_compression_ratio)
+        except compression.InvalidBody as exc:
+            raise exceptions.HTTPError(400, str(exc))
+
+    def verify_body_size(self, max_size=None):
         """Verify the size of the body is within the limit of the system"""
+        if max_size is None:
+            max_size = options.max_post_body_size
         content_length = long(self.request.headers.get('Content-Length', 0))
         logging.debug("Request size:{}".format(content_length))
 
-        if content_length > options.max_post_body_size:
+        if content_length > max_size:
             msg = 'Content length:{} is too large. Max allowed is:{}'.format(
-                content_length, options.max_post_body_size)
+                content_length, max_size)
             raise exceptions.HTTPError(400, msg)
+
+
+@stream_request_body
+class AssetStreamHandler(AssetHandler):
+    """
+    Onboard data as it is received.
+
+    The body is split into chunks of whole records (CSV rows or elements of
+    a JSON array) that are transformed and stored one after the other, so
+    only one chunk needs to be held in memory. Processing stops at the first
+    chunk that fails.
+
+    The onboarded assets are written as lines of JSON as each chunk is
+    stored if the client accepts them (see stream_response), otherwise only
+    their number is returned.
+    """
+
+    @coroutine
+    def prepare(self):
+        """Authorize the request and look up the repository before the body
+        is read"""
+        result = super(AssetStreamHandler, self).prepare()
+        if result is not None:
+            yield result
+        if self._finished:
+            return
+
+        self.request.connection.set_max_body_size(options.max_stream_body_size)
+        self.count = 0
+        self.errors = []
+        self.http_status = 200
+        self.splitter = None
+        self.decompressor = None
+
+        self.token, self.repository_url, _ = yield self.start(
+            self.path_kwargs['repository_id'])
+
+    def transform(self, repository_id):
+        """The body is transformed as it is received"""
+        return None
+
+    def verify_body_size(self, max_size=None):
+        """Verify the size of the body is within the streaming limit"""
+        super(AssetStreamHandler, self).verify_body_size(
+            options.max_stream_body_size)
+
+    def decode_body(self):
+        """The body is decompressed as it is received"""
+        encoding = self.verify_content_encoding()
+        if compression.is_compressed(encoding):
+            self.decompressor = compression.Decompressor(
+                encoding, options.max_stream_body_size,
+                options.max_compression_ratio)
+
+    def get_splitter(self):
+        if self.splitter is None:
+            self.splitter = records.make_splitter(
+                self.request.headers.get('Content-Type', None),
+                max_size=options.stream_chunk_size)
+        return self.splitter
+
+    def data_received(self, chunk):
+        """
+        Onboard each complete chunk of records in the request's span and
+        share
+        """
+        with tracing.activate(self.span), scheduler.activate(self._share):
+            return self.receive(chunk)
+
+    @coroutine
+    def receive(self, chunk):
+        """Onboard each complete chunk of records"""
+        if self._finished or self.errors:
+            return
+
+        metrics.REQUEST_BYTES.inc(len(chunk), method=self.request.method)
+        try:
+            if self.decompressor is not None:
+                chunk = self.decompressor.feed(chunk)
+            chunks = self.get_splitter().feed(chunk)
+        except ValueError as exc:
+            self.http_status = 400
+            self.errors.append({'message': str(exc)})
+            return
+
+        for data in chunks:
+            yield self.process(data)
+
+    @coroutine
+    def process(self, data):
+        """
+        Onboard (or delete) a chunk of records
+
+        :param data: a CSV or JSON document
+        """
+        if self.errors:
+            return
+
+        if self.request.method == 'DELETE':
+            func = assets.delete
+        else:
+            func = assets.onboard
+
+        result, http_status, errors = yield func(
+            data,
+            self.request.headers.get('Content-Type', None),
+            self.repository_url,
+            self.path_kwargs['repository_id'],
+            token=self.token,
+            r2rml_url=self.get_argument("r2rml_url", None),
+            local_transform=self.local_transform())
+
+        if result:
+            # the assets aren't kept, so that the response doesn't grow
+            # with the body
+            self.count += len(result)
+            if self.streams_response():
+                self.write_assets(result)
+        if errors:
+            self.http_status = http_status
+            self.errors.extend(errors)
+
+    @coroutine
+    def finish_stream(self):
+        """Onboard the remaining records and respond"""
+        if not self.errors:
+            try:
+                chunks = []
+                if self.decompressor is not None:
+                    chunks = self.get_splitter().feed(
+                        self.decompressor.flush())
+                chunks.extend(self.get_splitter().close())
+            except ValueError as exc:
+                self.http_status = 400
+                self.errors.append({'message': str(exc)})
+                chunks = []
+
+            for data in chunks:
+                yield self.process(data)
+
+        metrics.ASSETS.observe(self.count, method=self.request.method)
+        if self.streams_response():
+            self.finish_assets(self.count, self.http_status, self.errors)
+        elif not self.errors:
+            self.finish({'status': 200, 'data': {'count': self.count}})
+        else:
+            raise exceptions.HTTPError(
+                self.http_status,
+                {'errors': self.errors, 'data': {'count': self.count}})
+
+    @coroutine
+    def post(self, repository_id):
+        """
+        Respond with JSON containing audit of assets on boarded
+
+        :param repository_id: str
+        """
+        yield self.finish_stream()
+
+    @coroutine
+    def delete(self, repository_id):
+        """
+        Respond with JSON containing audit of assets deleted
+
+        :param repository_id: str
+        """
+        try:
+            yield self.finish_stream()
+        finally:
+            idempotency.forget(repository_id)
+
+
+class JobHandler(base.CorsHandler, base.JsonHandler):
+    """Reports on background onboarding jobs"""
+
+    @coroutine
+    def get(self, repository_id, job_id):
+        """
+        Respond with JSON containing the status of the job, and the assets
+        onboarded and errors once it has finished
+
+        :param repository_id: str
+        :param job_id: str
+        """
+        # the caller must have access to the job's repository
+        yield delegated_token(self.request, repository_id)
+
+        job = jobs.get_queue().get(job_id)
+        if job is None or job['repository_id'] != repository_id:
+            raise exceptions.HTTPError(
+                404, 'Job "{}" not found'.format(job_id))
+
+        self.finish({'status': 200, 'data': job})
@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""Onboard assets with resumable uploads, sent in chunks"""
+import json
+
+from tornado.gen import coroutine, Return
+from tornado.options import options
+from koi import exceptions
+
+from onboarding.controllers.repository_handler import AssetHandler
+from onboarding.models import assets, metrics, records, uploads
+from onboarding.models.remote import get_repository
+
+# request header with the SHA-256 checksum of a chunk, as a hex string
+CHECKSUM_HEADER = 'X-Content-SHA256'
+
+
+def get_upload(repository_id, upload_id):
+    """
+    Get an upload to a repository
+
+    :param repository_id: str
+    :param upload_id: str
+    :returns: the upload
+    :raises: HTTPError 404 if there is no such upload
+    """
+    upload = uploads.get_store().get(upload_id)
+    if upload is None or upload['repository_id'] != repository_id:
+        raise exceptions.HTTPError(
+            404, 'Upload "{}" not found'.format(upload_id))
+    return upload
+
+
+class UploadsHandler(AssetHandler):
+    """Starts resumable uploads"""
+
+    SUPPORTED_METHODS = ('POST', 'OPTIONS')
+
+    @coroutine
+    def post(self, repository_id):
+        """
+        Respond with a new upload to the repository, for the content type
+        given in the body
+
+        :param repository_id: str
+        """
+        yield self.get_token(repository_id)
+
+        body = self.get_json_body()
+        if not isinstance(body, dict):
+            raise exceptions.HTTPError(400, 'Body must be a JSON object')
+        content_type = body.get('content_type')
+        self.verify_content_type(content_type or '')
+
+        upload = uploads.get_store().create(
+            repository_id, content_type,
+            r2rml_url=self.get_argument('r2rml_url', None),
+            local_transform=self.local_transform())
+
+        self.set_status(201)
+        self.set_header('Location', '{}/{}'.format(
+            self.request.path.rstrip('/'), upload['id']))
+        self.finish({'status': 201, 'data': dict(upload, chunks=[])})
+
+
+class UploadHandler(AssetHandler):
+    """Reports on, commits and cancels resumable uploads"""
+
+    SUPPORTED_METHODS = ('GET', 'POST', 'DELETE', 'OPTIONS')
+
+    @coroutine
+    def get(self, repository_id, upload_id):
+        """
+        Respond with the upload and the numbers of the chunks received, so
+        that a client can resend the missing chunks
+
+        :param repository_id: str
+        :param upload_id: str
+        """
+        yield self.get_token(repository_id)
+        upload = get_upload(repository_id, upload_id)
+
+        chunks = uploads.get_store().chunks(upload_id)
+        self.finish({'status': 200, 'data': dict(upload, chunks=chunks)})
+
+    @coroutine
+    def post(self, repository_id, upload_id):
+        """
+        Commit the upload: onboard its records a batch at a time, and
+        respond with each asset as a line of JSON followed by a line with
+        the status and any errors. The upload is removed once all of its
+        records have been onboarded, otherwise it can be committed again.
+
+        :param repository_id: str
+        :param upload_id: str
+        """
+        token = yield self.get_token(repository_id)
+        upload = get_upload(repository_id, upload_id)
+        count = self.get_chunk_count()
+
+        store = uploads.get_store()
+        missing = store.missing(upload_id, count)
+        if missing:
+            raise exceptions.HTTPError(
+                409, 'Chunks {} have not been received'.format(
+                    ', '.join(str(number) for number in missing)))
+        if not store.lock(upload_id):
+            raise exceptions.HTTPError(
+                409, 'Upload "{}" is already being committed'.format(
+                    upload_id))
+
+        try:
+            repository = yield get_repository(repository_id)
+            errors = yield self.commit(upload, count,
+                                       repository['service']['location'],
+                                       token)
+        except Exception:
+            store.unlock(upload_id)
+            raise
+
+        if errors:
+            store.unlock(upload_id)
+        else:
+            store.remove(upload_id)
+
+    @coroutine
+    def delete(self, repository_id, upload_id):
+        """
+        Cancel the upload, removing its chunks
+
+        :param repository_id: str
+        :param upload_id: str
+        """
+        yield self.get_token(repository_id)
+        get_upload(repository_id, upload_id)
+
+        uploads.get_store().remove(upload_id)
+        self.finish({'status': 200})
+
+    def get_chunk_count(self):
+        """
+        Read the number of chunks of the upload from the body
+
+        :returns: int
+        :raises: HTTPError
+        """
+        body = self.get_json_body()
+        count = body.get('chunks') if isinstance(body, dict) else None
+        if not isinstance(count, (int, long)) or count < 1:
+            raise exceptions.HTTPError(
+                400, 'Body must include the number of chunks')
+        return count
+
+    def batches(self, upload, count):
+        """
+        Split the upload's chunks into batches of whole records (CSV rows or
+        elements of a JSON array), reading one chunk at a time
+
+        :param upload: the upload
+        :param count: the number of chunks
+        :returns: generator of CSV or JSON documents
+        """
+        splitter = records.make_splitter(upload['content_type'],
+                                         max_size=options.stream_chunk_size)
+        for chunk in uploads.get_store().read(upload['id'], count):
+            for data in splitter.feed(chunk):
+                yield data
+        for data in splitter.close():
+            yield data
+
+    @coroutine
+    def commit(self, upload, count, repository_url, token):
+        """
+        Onboard the upload's records, stopping at the first batch that
+        fails, and respond
+
+        :param upload: the upload
+        :param count: the number of chunks
+        :param repository_url: url of the repository service
+        :param token: the delegated token
+        :returns: the errors, if any
+        """
+        written = 0
+        http_status = 200
+        errors = []
+        try:
+            for data in self.batches(upload, count):
+                result, http_status, errors = yield assets.onboard(
+                    data,
+                    upload['content_type'],
+                    repository_url,
+                    upload['repository_id'],
+                    token=token,
+                    r2rml_url=upload['r2rml_url'],
+                    local_transform=upload['local_transform'])
+                if result:
+                    self.set_header('Content-Type', self.NDJSON)
+                    self.write(''.join(json.dumps(asset) + '\n'
+                                       for asset in result))
+                    written += len(result)
+                    yield self.flush()
+                if errors:
+                    break
+        except ValueError as exc:
+            http_status = 400
+            errors = [{'message': str(exc)}]
+        metrics.ASSETS.observe(written, method='POST')
+
+        self.finish_assets(written, http_status, errors)
+        raise Return(errors)
+
+
+class UploadChunkHandler(AssetHandler):
+    """Receives the chunks of resumable uploads"""
+
+    SUPPORTED_METHODS = ('PUT', 'OPTIONS')
+
+    @coroutine
+    def put(self, repository_id, upload_id, number):
+        """
+        Save a chunk of the upload's data, replacing it if it was already
+        received. The request must have the chunk's SHA-256 checksum in the
+        X-Content-SHA256 header.
+
+        :param repository_id: str
+        :param upload_id: str
+        :param number: the chunk's number, from 1
+        """
+        yield self.get_token(repository_id)
+        upload = get_upload(repository_id, upload_id)
+        if not number.isdigit():
+            raise exceptions.HTTPError(400, 'Invalid chunk number')
+        sha256 = self.request.headers.get(CHECKSUM_HEADER)
+        if not sha256:
+            raise exceptions.HTTPError(
+                400, '{} header not provided'.format(CHECKSUM_HEADER))
+
+        store = uploads.get_store()
+        body = self.request.body or ''
+        metrics.REQUEST_BYTES.inc(len(body), method='PUT')
+        store.put_chunk(upload['id'], int(number), body, sha256)
+        self.finish({'status': 200, 'data': dict(
+            upload, chunks=store.chunks(upload['id']))})
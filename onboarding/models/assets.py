@@ -12,123 +12,488 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import io
 import logging
 import re
+from collections import OrderedDict
+
 from tornado.options import options
 from tornado.gen import coroutine, Return
+from tornado.locks import Semaphore
+import executor
+import mapping
+import metrics
+import records
 import remote
+import tracing
 from bass.hubkey import generate_hub_key
 
 ASSET_ID = re.compile(r'http://openpermissions.org/ns/id/[0-9a-f]{32}')
 
 
+def use_local_transform(r2rml_url=None, local_transform=None):
+    """
+    Whether data is transformed with the default mapping in this service
+    rather than by the transformation service
+
+    :param r2rml_url: karma mapping file url, only the transformation
+        service can use a custom mapping
+    :param local_transform: (optional) the choice made for the request,
+        defaults to the local_transform option
+    """
+    if r2rml_url:
+        return False
+    if local_transform is None:
+        local_transform = options.local_transform
+    return bool(local_transform)
+
+
 @coroutine
-def onboard(data, content_type, repository_url, repository_id, token=None, r2rml_url=None):
+def transform(data, content_type, repository_id, r2rml_url=None,
+              local_transform=None, response=None):
     """
-    Transforms source data into RDF triples
+    Transforms source data into RDF triples and generates the id_map
     :param data: the source data
     :param content_type: the http request content type
-    :param repository_url: url of the repository service
     :param repository_id: the repository ID
-    :param token: an authorization token
     :param r2rml_url: karma mapping file url (used by transformation)
-    :return: list of on boarded assets and errors
+    :param local_transform: (optional) whether to transform the data with
+        the default mapping in this service, see use_local_transform
+    :param response: (optional) Future returned by remote.transform for the
+        data, shared when the data is onboarded to several repositories.
+        Unused if the data is transformed locally.
+    :return: transformed data, http status and errors
     """
-    assets = None
+    if use_local_transform(r2rml_url, local_transform):
+        result = yield executor.run(
+            len(data or ''), mapping.transform, data, content_type,
+            repository_id, options.default_resolver_id, options.hub_id)
+        raise Return(result)
 
-    response_trans, http_status, errors = yield remote.transform(data, content_type, r2rml_url)
+    if response is None:
+        response_trans, http_status, errors = yield remote.transform(
+            data, content_type, r2rml_url)
+    else:
+        response_trans, http_status, errors = yield response
+        if http_status == 200:
+            # the id_map of each repository is added to its own copy
+            response_trans = dict(response_trans,
+                                  data=dict(response_trans['data']))
 
     if 'id_map' not in response_trans['data']:
-        response_trans['data']['id_map'] = generate_idmap(
+        response_trans['data']['id_map'] = yield generate_idmap_async(
             response_trans, repository_id)
 
     logging.debug(response_trans)
-    if not errors and http_status == 200:
-        http_status, errors = yield remote.store(response_trans, repository_url,
-                                          repository_id, token=token)
-        assets = response_trans['data']['id_map']
-    logging.debug('<<< onboard')
+    raise Return((response_trans, http_status, errors))
+
+
+def batches(data, content_type):
+    """
+    Split source data into batches of whole records if it is larger than the
+    batch_size option
+
+    :param data: the source data
+    :param content_type: the http request content type
+    :return: list of batches, or None if the data should not be split
+    """
+    if not options.batch_size or len(data or '') <= options.batch_size:
+        return None
+
+    try:
+        chunks = records.split(data, content_type,
+                               max_size=options.batch_size,
+                               max_records=options.batch_records or None)
+    except ValueError as exc:
+        # leave it to the transformation service to report invalid data
+        logging.debug('Not splitting data: {}'.format(exc))
+        return None
+
+    if len(chunks) < 2:
+        return None
+
+    return chunks
+
+
+@coroutine
+def _process(send, data, content_type, repository_url, repository_id,
+             token=None, r2rml_url=None, transformed=None, transforms=None,
+             stores=None, local_transform=None):
+    """
+    Transform the data and send it to the repository
+
+    :param send: remote.store or remote.delete
+    :param transforms: (optional) Semaphore limiting concurrent transforms
+    :param stores: (optional) Semaphore limiting concurrent calls to send
+    :return: id map, http status and errors
+    """
+    if transformed is not None:
+        response_trans, http_status, errors = yield transformed
+    elif transforms is not None:
+        with (yield transforms.acquire()):
+            response_trans, http_status, errors = yield transform(
+                data, content_type, repository_id, r2rml_url,
+                local_transform)
+    else:
+        response_trans, http_status, errors = yield transform(
+            data, content_type, repository_id, r2rml_url, local_transform)
+
+    if errors or http_status != 200:
+        raise Return((None, http_status, errors))
+
+    if stores is not None:
+        with (yield stores.acquire()):
+            http_status, errors = yield send(response_trans, repository_url,
+                                             repository_id, token=token)
+    else:
+        http_status, errors = yield send(response_trans, repository_url,
+                                         repository_id, token=token)
+
+    raise Return((response_trans['data']['id_map'], http_status, errors))
+
+
+@coroutine
+def _pipeline(send, chunks, content_type, repository_url, repository_id,
+              token=None, r2rml_url=None, progress=None,
+              local_transform=None, on_assets=None):
+    """
+    Transform and send batches of data, starting to transform the next batch
+    while the previous one is being sent to the repository.
+
+    Batches are processed independently, if one fails the others are still
+    stored.
+
+    :param send: remote.store or remote.delete
+    :param chunks: list of batches of source data
+    :param progress: (optional) function called with the number of batches
+        processed and the total number of batches after each batch
+    :param on_assets: (optional) function called with the id map of each
+        batch as soon as it has been stored, instead of merging them
+    :return: merged id map, http status of the first failed batch and errors
+        annotated with the index of the batch
+    """
+    transforms = Semaphore(options.max_concurrent_transforms)
+    stores = Semaphore(options.max_concurrent_stores)
+
+    completed = [0]
+    if progress is not None:
+        progress(0, len(chunks))
+
+    @coroutine
+    def process(chunk):
+        result = yield _process(send, chunk, content_type, repository_url,
+                                repository_id, token=token,
+                                r2rml_url=r2rml_url, transforms=transforms,
+                                stores=stores, local_transform=local_transform)
+        if on_assets is not None:
+            result = _send_assets(result, on_assets)
+
+        completed[0] += 1
+        if progress is not None:
+            progress(completed[0], len(chunks))
+        raise Return(result)
+
+    results = yield [process(chunk) for chunk in chunks]
+
+    assets = []
+    http_status = 200
+    errors = []
+    for index, (id_map, status, batch_errors) in enumerate(results):
+        if batch_errors or status != 200:
+            if not errors:
+                http_status = status
+            errors.extend(dict(error, batch=index)
+                          for error in batch_errors or
+                          [{'message': 'Error {}'.format(status)}])
+        elif id_map:
+            assets.extend(id_map)
+
+    logging.debug('processed {} batches, {} failed'.format(
+        len(chunks), len(set(e['batch'] for e in errors))))
     raise Return((assets, http_status, errors))
 
+
+def _send_assets(result, on_assets):
+    """
+    Pass the id map of a successful result to on_assets instead of
+    returning it
+
+    :param result: id map, http status and errors
+    :param on_assets: function called with the id map
+    :return: an empty id map (or None if it failed), http status and errors
+    """
+    id_map, http_status, errors = result
+    if id_map and not errors and http_status == 200:
+        on_assets(id_map)
+        id_map = []
+    return id_map, http_status, errors
+
+
+def _clean_deleted(id_map):
+    """Remove the generated ids that don't apply to deleted assets"""
+    if id_map:
+        id_map[0].pop('entity_id', None)
+        id_map[0].pop('hub_key', None)
+
+
+def _clean_first(on_assets):
+    """
+    Wrap on_assets so that the first assets passed to it are cleaned with
+    _clean_deleted, as the whole id map is when it is returned
+    """
+    cleaned = [False]
+
+    def wrapper(id_map):
+        if not cleaned[0]:
+            cleaned[0] = True
+            _clean_deleted(id_map)
+        on_assets(id_map)
+
+    return wrapper
+
+
 @coroutine
-def delete(data, content_type, repository_url, repository_id, token=None, r2rml_url=None):
+def onboard(data, content_type, repository_url, repository_id, token=None, r2rml_url=None,
+            transformed=None, progress=None, local_transform=None,
+            on_assets=None):
     """
-    Transforms source data into RDF triples to be deleted from the repo
+    Transforms source data into RDF triples
+
+    Data larger than the batch_size option is split into batches that are
+    transformed and stored concurrently.
+
     :param data: the source data
     :param content_type: the http request content type
     :param repository_url: url of the repository service
     :param repository_id: the repository ID
     :param token: an authorization token
     :param r2rml_url: karma mapping file url (used by transformation)
+    :param transformed: (optional) Future returned by transform if the data
+        is already being transformed
+    :param progress: (optional) function called with the number of batches
+        processed and the total number of batches
+    :param local_transform: (optional) whether to transform the data with
+        the default mapping in this service, see use_local_transform
+    :param on_assets: (optional) function called with the assets of each
+        batch as soon as they have been stored. The assets are then not
+        included in the returned list.
     :return: list of on boarded assets and errors
     """
-    assets = None
+    chunks = None if transformed is not None else batches(data, content_type)
+    if chunks:
+        result = yield _pipeline(remote.store, chunks, content_type,
+                                 repository_url, repository_id, token=token,
+                                 r2rml_url=r2rml_url, progress=progress,
+                                 local_transform=local_transform,
+                                 on_assets=on_assets)
+    else:
+        result = yield _process(remote.store, data, content_type,
+                                repository_url, repository_id, token=token,
+                                r2rml_url=r2rml_url, transformed=transformed,
+                                local_transform=local_transform)
+        if on_assets is not None:
+            result = _send_assets(result, on_assets)
+        if progress is not None:
+            progress(1, 1)
+    logging.debug('<<< onboard')
+    raise Return(result)
 
-    response_trans, http_status, errors = yield remote.transform(data, content_type, r2rml_url)
 
-    if 'id_map' not in response_trans['data']:
-        response_trans['data']['id_map'] = generate_idmap(
-            response_trans, repository_id)
+@coroutine
+def delete(data, content_type, repository_url, repository_id, token=None, r2rml_url=None,
+           transformed=None, progress=None, local_transform=None,
+           on_assets=None):
+    """
+    Transforms source data into RDF triples to be deleted from the repo
+
+    Data larger than the batch_size option is split into batches, like
+    onboard.
+
+    :param data: the source data
+    :param content_type: the http request content type
+    :param repository_url: url of the repository service
+    :param repository_id: the repository ID
+    :param token: an authorization token
+    :param r2rml_url: karma mapping file url (used by transformation)
+    :param transformed: (optional) Future returned by transform if the data
+        is already being transformed
+    :param progress: (optional) function called with the number of batches
+        processed and the total number of batches
+    :param local_transform: (optional) whether to transform the data with
+        the default mapping in this service, see use_local_transform
+    :param on_assets: (optional) function called with the assets of each
+        batch as soon as they have been stored. The assets are then not
+        included in the returned list.
+    :return: list of on boarded assets and errors
+    """
+    chunks = None if transformed is not None else batches(data, content_type)
+    if chunks:
+        if on_assets is not None:
+            on_assets = _clean_first(on_assets)
+        result = yield _pipeline(remote.delete, chunks, content_type,
+                                 repository_url, repository_id, token=token,
+                                 r2rml_url=r2rml_url, progress=progress,
+                                 local_transform=local_transform,
+                                 on_assets=on_assets)
+        # cleaned once, like the id map of data that isn't batched
+        _clean_deleted(result[0])
+    else:
+        assets, http_status, errors = yield _process(
+            remote.delete, data, content_type, repository_url, repository_id,
+            token=token, r2rml_url=r2rml_url, transformed=transformed,
+            local_transform=local_transform)
+        _clean_deleted(assets)
+        result = (assets, http_status, errors)
+        if on_assets is not None:
+            result = _send_assets(result, on_assets)
+        if progress is not None:
+            progress(1, 1)
 
-    logging.debug(response_trans)
-    if not errors and http_status == 200:
-        http_status, errors = yield remote.delete(response_trans, repository_url,
-                                          repository_id, token=token)
-        assets = response_trans['data']['id_map']
-        assets[0].pop('entity_id', None)
-        assets[0].pop('hub_key', None)
-                
     logging.debug('<<< DELETE')
-    raise Return((assets, http_status, errors))
+    raise Return(result)
+
+
+RE_ENTITY_ID = re.compile(r'<http://openpermissions.org/ns/id/([^>]*)> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://openpermissions.org/ns/op/1.1/Asset>')
+RE_SOURCE_ID_TYPES = re.compile(r'_:([^ ]+) <http://openpermissions.org/ns/op/1.1/id_type> <http://openpermissions.org/ns/hub(?:[^/]*)/([^>]+)>')
+# the value may contain escaped characters, e.g. \", which are kept escaped
+RE_SOURCE_IDS = re.compile(r'_:([^ ]+) <http://openpermissions.org/ns/op/1.1/value> "((?:[^"\\]|\\.)*)"')
+
+
+class _Block(object):
+    """The identifiers found in one record of the triple data"""
+
+    def __init__(self):
+        self.entity_id = None
+        self.source_id_types = {}
+        self.source_ids = {}
+
+    def add(self, line):
+        """Extract the identifiers from a line of N-Triples"""
+        if line.startswith('_:'):
+            match = RE_SOURCE_IDS.match(line)
+            if match:
+                self.source_ids[match.group(1)] = match.group(2)
+                return
+            match = RE_SOURCE_ID_TYPES.match(line)
+            if match:
+                self.source_id_types[match.group(1)] = match.group(2)
+        elif self.entity_id is None:
+            match = RE_ENTITY_ID.match(line)
+            if match:
+                self.entity_id = match.group(1)
+
+    def source_id_list(self):
+        source_ids = []
+        for k in self.source_ids.keys():
+            try:
+                source_ids.append({'source_id': self.source_ids[k],
+                                   'source_id_type': self.source_id_types[k]})
+            except KeyError as e:
+                logging.warning("exception extraction source ids %r" % (e,))
+                logging.warning("entity_id=%s" % (self.entity_id,))
+        return source_ids
+
+
+def iter_blocks(value):
+    """
+    Read the records in triple data in one pass.
+
+    Karma outputs a blank line after each record, so the triples are read
+    line by line and a blank line ends the current record.
+
+    :param value: N-Triples
+    :returns: generator of _Block
+    """
+    if isinstance(value, unicode):
+        lines = io.StringIO(value)
+    else:
+        lines = io.BytesIO(value)
+
+    block = None
+    for line in lines:
+        line = line.strip()
+        if not line:
+            if block is not None:
+                yield block
+                block = None
+            continue
+
+        if block is None:
+            block = _Block()
+        block.add(line)
+
+    if block is not None:
+        yield block
+
+
+def _triples(data):
+    """The versions of the transformed data to read the ids from"""
+    if 'rdf_n3' in data['data']:
+        return [data['data']['rdf_n3']]
+    return data['data'].values()
 
 
-RE_ENTITY_ID="<http://openpermissions.org/ns/id/([^>]*)> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://openpermissions.org/ns/op/1.1/Asset>"
-RE_SOURCE_ID_TYPES="_:([^ ]+) <http://openpermissions.org/ns/op/1.1/id_type> <http://openpermissions.org/ns/hub(?:[^/]*)/([^>]+)>"
-RE_SOURCE_IDS="_:([^ ]+) <http://openpermissions.org/ns/op/1.1/value> \"((?:[^\"]|\\\\\")*)\""
 def generate_idmap(data, repository_id):
     """
     Generate hub_keys for assets and returns an id_map linking
     the final part of the asset with the key.
 
     :param data: A dictionary of containing different version of the
-                 transformed data (output format is assumed to be n3)
+                 transformed data (output format is assumed to be n3). Only
+                 the rdf_n3 version is read if it is present.
     :param repository_id: ID of repository
     :returns: a dictionary mapping ids used in final part of the hub key
               with the hub key.
     """
-    id_map = {}
-    resolver_id = options.default_resolver_id
-    hub_id = options.hub_id
-
-    for value in data['data'].values():
-
-        # now process each block in the triple data - karma outputs a double new line for each new record or EOF(FIXME!)
-        for p in re.findall("(([^\n]|(\n[^\n]))*)(?:\n\n|\Z)", value, re.M):
-            p = p[0]
-            if len(p.strip()):
-                # extract the necessary information
-                try:
-                    entity_id = re.findall(RE_ENTITY_ID, p, re.M)[0]
-                except:
-                    logging.warning("Could not find entity_id in triple data")
-                    continue
-                entity_source_id_types = dict(re.findall(RE_SOURCE_ID_TYPES, p, re.M))
-                entity_source_id_values = dict(re.findall(RE_SOURCE_IDS, p, re.M))
-                source_ids = []
-                for k in entity_source_id_values.keys():
-                    try:
-                        source_ids.append({'source_id': entity_source_id_values[k], 'source_id_type': entity_source_id_types[k]})
-                    except Exception, e:
-                        logging.warning("exception extraction source ids %r" % (e,))
-                        logging.warning("data=%s" % (p,))
-
-                hub_key = generate_hub_key(resolver_id, hub_id, repository_id, 'asset', entity_id)
-
-                id_map[hub_key] = {
-                    "entity_type": 'asset',
-                    "entity_id": entity_id,
-                    "hub_key": hub_key,
-                    "source_ids": source_ids
-                }
+    return idmap_from_triples(_triples(data), repository_id,
+                              options.default_resolver_id, options.hub_id)
+
+
+@metrics.timed('generate_idmap')
+@tracing.traced
+def generate_idmap_async(data, repository_id):
+    """
+    Generate the id_map in the executor, unless the data is smaller than
+    the cpu_inline_threshold option
+
+    :param data: A dictionary of containing different version of the
+                 transformed data
+    :param repository_id: ID of repository
+    :returns: a Future resolving to the id_map
+    """
+    values = _triples(data)
+    return executor.run(sum(len(value) for value in values),
+                        idmap_from_triples, values, repository_id,
+                        options.default_resolver_id, options.hub_id)
+
+
+def idmap_from_triples(values, repository_id, resolver_id, hub_id):
+    """
+    Generate the id_map of N-Triples documents. The options are passed in
+    so that it can be run in another process.
+
+    :param values: list of N-Triples documents
+    :param repository_id: ID of repository
+    :param resolver_id: the hub key resolver ID
+    :param hub_id: the hub ID
+    :returns: list of id_map entries
+    """
+    id_map = OrderedDict()
+
+    for value in values:
+        for block in iter_blocks(value):
+            if block.entity_id is None:
+                logging.warning("Could not find entity_id in triple data")
+                continue
+
+            hub_key = generate_hub_key(resolver_id, hub_id, repository_id,
+                                       'asset', block.entity_id)
+
+            id_map[hub_key] = {
+                "entity_type": 'asset',
+                "entity_id": block.entity_id,
+                "hub_key": hub_key,
+                "source_ids": block.source_id_list()
+            }
 
     return id_map.values()
@@ -0,0 +1,320 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""In-process caches for the results of calls to other services"""
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import time
+from collections import OrderedDict
+
+from tornado.gen import coroutine, Return
+
+# all caches created in this process, by name
+CACHES = {}
+
+_MISSING = object()
+
+
+class LRUCache(object):
+    """
+    Size bounded least recently used cache where each entry has its own
+    expiry time.
+
+    Concurrent lookups of a key that is not cached share a single fetch, so
+    that a burst of requests for the same key results in one call to the
+    remote service.
+    """
+
+    def __init__(self, name, max_size=1000, ttl=None):
+        """
+        :param name: name used to report on and flush the cache
+        :param max_size: maximum number of entries to keep
+        :param ttl: default number of seconds an entry is valid, None means
+            entries do not expire
+        """
+        self.name = name
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._pending = {}
+        CACHES[name] = self
+
+    @staticmethod
+    def _now():
+        return time.time()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, key):
+        entry = self._entries.get(key)
+        return entry is not None and not self._expired(entry)
+
+    def _expired(self, entry):
+        expires = entry[0]
+        return expires is not None and expires <= self._now()
+
+    def get(self, key, default=None):
+        """
+        Get a cached value, marking it as the most recently used
+
+        :param key: the cache key
+        :param default: returned if the key is not cached or has expired
+        """
+        entry = self._entries.pop(key, None)
+        if entry is None or self._expired(entry):
+            self.misses += 1
+            return default
+
+        self._entries[key] = entry
+        self.hits += 1
+        return entry[1]
+
+    def set(self, key, value, ttl=None):
+        """
+        Cache a value, evicting the least recently used entries if the cache
+        is full
+
+        :param key: the cache key
+        :param value: the value to cache
+        :param ttl: seconds until the entry expires, defaults to the cache's
+            ttl. The value is not cached if the ttl is not positive.
+        """
+        if ttl is None:
+            ttl = self.ttl
+
+        self._entries.pop(key, None)
+        if ttl is not None and ttl <= 0:
+            return
+
+        expires = None if ttl is None else self._now() + ttl
+        self._entries[key] = (expires, value)
+
+        while len(self._entries) > self.max_size:
+            self._evict()
+
+    def _evict(self):
+        """Remove the least recently used entry"""
+        self._entries.popitem(last=False)
+
+    def is_pending(self, key):
+        """Whether the key is being fetched"""
+        return key in self._pending
+
+    def invalidate(self, key):
+        """Remove a key from the cache"""
+        self._entries.pop(key, None)
+
+    def keys(self):
+        """The keys of the entries held in memory"""
+        return list(self._entries)
+
+    def clear(self):
+        """Remove all entries from the cache"""
+        self._entries.clear()
+
+    def stats(self):
+        """Return the cache's size and hit/miss counters"""
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'pending': len(self._pending)
+        }
+
+    @coroutine
+    def get_or_fetch(self, key, fetch):
+        """
+        Get a cached value or fetch it if it isn't cached.
+
+        If the key is already being fetched then wait for that fetch rather
+        than starting another one. Errors are not cached.
+
+        :param key: the cache key
+        :param fetch: a function returning a Future that resolves to a
+            (value, ttl) tuple
+        :returns: the value
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            raise Return(value)
+
+        future = self._pending.get(key)
+        if future is None:
+            future = self._fetch(key, fetch)
+            if not future.done():
+                self._pending[key] = future
+
+        value = yield future
+        raise Return(value)
+
+    @coroutine
+    def _fetch(self, key, fetch):
+        """Fetch a value and cache it"""
+        try:
+            value, ttl = yield fetch()
+            self.set(key, value, ttl)
+        finally:
+            self._pending.pop(key, None)
+
+        raise Return(value)
+
+
+class SpillCache(LRUCache):
+    """
+    LRUCache that writes the entries it evicts to files in a directory, and
+    reads them back the next time they are used, so that more entries can
+    be kept than fit in memory. The values must be JSON serialisable.
+
+    Entries are only spilled if a directory is set, and at most max_files
+    files are kept, removing the oldest.
+    """
+
+    def __init__(self, name, max_size=1000, ttl=None, directory=None,
+                 max_files=10000):
+        """
+        :param name: name used to report on and flush the cache
+        :param max_size: maximum number of entries to keep in memory
+        :param ttl: default number of seconds an entry is valid, None means
+            entries do not expire
+        :param directory: (optional) directory for evicted entries, created
+            if needed
+        :param max_files: maximum number of entries kept in the directory
+        """
+        super(SpillCache, self).__init__(name, max_size, ttl)
+        self.directory = directory
+        self.max_files = max_files
+
+    def _path(self, key):
+        name = hashlib.sha256(repr(key)).hexdigest()
+        return os.path.join(self.directory, '{}.json'.format(name))
+
+    def _evict(self):
+        key, entry = self._entries.popitem(last=False)
+        if self.directory and not self._expired(entry):
+            self._spill(key, entry)
+
+    def _spill(self, key, entry):
+        """Write an entry to a file"""
+        expires, value = entry
+        try:
+            content = json.dumps({'expires': expires, 'value': value})
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            # write to a temporary file first so that readers never see a
+            # partially written entry
+            fd, path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+            with os.fdopen(fd, 'w') as f:
+                f.write(content)
+            os.rename(path, self._path(key))
+        except (EnvironmentError, TypeError, ValueError):
+            logging.exception('Unable to spill an entry of cache %s', self.name)
+            return
+
+        self._remove_oldest()
+
+    def _remove_oldest(self):
+        """Remove the oldest files if there are more than max_files"""
+        paths = self._files()
+        if len(paths) <= self.max_files:
+            return
+
+        ages = []
+        for path in paths:
+            try:
+                ages.append((os.path.getmtime(path), path))
+            except OSError:
+                # removed by another process
+                pass
+
+        for _, path in sorted(ages)[:len(ages) - self.max_files]:
+            _remove(path)
+
+    def _files(self):
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return []
+        return [os.path.join(self.directory, name) for name in names
+                if name.endswith('.json')]
+
+    def _load(self, key):
+        """Move an entry from its file back into memory"""
+        path = self._path(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (EnvironmentError, ValueError):
+            return _MISSING
+        _remove(path)
+
+        expires = entry['expires']
+        if expires is None:
+            ttl = None
+        else:
+            ttl = expires - self._now()
+            if ttl <= 0:
+                return _MISSING
+
+        self.set(key, entry['value'], ttl)
+        return entry['value']
+
+    def get(self, key, default=None):
+        """
+        Get a cached value, from its file if it was evicted from memory
+
+        :param key: the cache key
+        :param default: returned if the key is not cached or has expired
+        """
+        value = super(SpillCache, self).get(key, _MISSING)
+        if value is _MISSING and self.directory:
+            value = self._load(key)
+            if value is not _MISSING:
+                self.misses -= 1
+                self.hits += 1
+
+        return default if value is _MISSING else value
+
+    def invalidate(self, key):
+        """Remove a key from the cache and its directory"""
+        super(SpillCache, self).invalidate(key)
+        if self.directory:
+            _remove(self._path(key))
+
+    def clear(self):
+        """Remove all entries from the cache and its directory"""
+        super(SpillCache, self).clear()
+        if self.directory:
+            for path in self._files():
+                _remove(path)
+
+    def stats(self):
+        """Return the cache's size, number of files and hit/miss counters"""
+        result = super(SpillCache, self).stats()
+        result['files'] = len(self._files()) if self.directory else 0
+        return result
+
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except OSError:
+        # already removed, e.g. by another process
+        pass
+
+
+def stats():
+    """Return the stats of all caches"""
+    return {name: cache.stats() for name, cache in CACHES.items()}
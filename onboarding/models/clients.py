@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+HTTP clients shared by all calls to other services.
+
+Each host gets one client for the lifetime of the process with a limit on
+the number of concurrent connections. When pycurl is installed the curl
+based client is used, which keeps connections alive between requests.
+"""
+import logging
+from functools import partial
+from urlparse import urljoin, urlparse
+
+from tornado import httpclient
+from tornado.gen import coroutine, Return
+from tornado.ioloop import IOLoop
+from tornado.options import options
+import chub
+from chub.api import Resource, API_VERSION
+from chub.handlers import async_fetch
+from koi.configure import ssl_server_options
+
+from onboarding.models import metrics, tracing
+
+CURL_CLIENT = 'tornado.curl_httpclient.CurlAsyncHTTPClient'
+
+# timings reported by the curl client that are recorded for each host
+TIMINGS = ('queue', 'namelookup', 'connect', 'appconnect', 'starttransfer',
+           'total')
+
+# shared clients by host
+_clients = {}
+_ssl_options = None
+
+
+def curl_available():
+    """Check whether the curl based client can be used"""
+    try:
+        import pycurl  # noqa
+        return True
+    except ImportError:
+        return False
+
+
+def use_curl():
+    """Whether the curl based client is configured"""
+    return bool(options.http_use_curl) and curl_available()
+
+
+def configure():
+    """
+    Configure the HTTP client implementation from the service's options.
+    All clients, including those created by chub, add the traceparent header
+    to their requests.
+    """
+    if use_curl():
+        httpclient.AsyncHTTPClient.configure(
+            tracing.client_class(CURL_CLIENT),
+            max_clients=options.http_max_clients)
+    else:
+        if options.http_use_curl:
+            logging.warning('pycurl is not installed, connections to other '
+                            'services will not be kept alive')
+        httpclient.AsyncHTTPClient.configure(
+            tracing.client_class(), max_clients=options.http_max_clients)
+
+    _clients.clear()
+
+
+def ssl_options():
+    """The ssl options shared by all clients"""
+    global _ssl_options
+    if _ssl_options is None:
+        _ssl_options = ssl_server_options()
+
+    return _ssl_options
+
+
+def request_defaults():
+    """Default request parameters for connecting to other services"""
+    if use_curl():
+        # the curl client can't use an SSLContext
+        return {
+            'ca_certs': options.ssl_ca_cert,
+            'client_cert': options.ssl_cert,
+            'client_key': options.ssl_key,
+            'validate_cert': bool(options.ssl_cert_reqs)
+        }
+    else:
+        return {'ssl_options': ssl_options()}
+
+
+class HostStats(object):
+    """Counters and timings of the requests made to a host"""
+
+    def __init__(self, max_clients):
+        self.max_clients = max_clients
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = 0
+        self.errors = 0
+        self._timings = {name: [0, 0.0] for name in TIMINGS + ('request',)}
+
+    def started(self):
+        self.requests += 1
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def finished(self, response, error=False):
+        self.in_flight -= 1
+        if error:
+            self.errors += 1
+
+        if response is None:
+            return
+
+        timings = dict(response.time_info or {})
+        if response.request_time is not None:
+            timings['request'] = response.request_time
+        for name, value in timings.items():
+            if name in self._timings:
+                self._timings[name][0] += 1
+                self._timings[name][1] += value
+
+    def stats(self):
+        return {
+            'max_clients': self.max_clients,
+            'in_flight': self.in_flight,
+            'max_in_flight': self.max_in_flight,
+            'utilisation': float(self.in_flight) / (self.max_clients or 1),
+            'requests': self.requests,
+            'errors': self.errors,
+            'mean_seconds': {name: total / count
+                             for name, (count, total) in self._timings.items()
+                             if count}
+        }
+
+
+class InstrumentedClient(object):
+    """Wraps an AsyncHTTPClient to record the requests made with it"""
+
+    def __init__(self, client, max_clients, host=''):
+        self.client = client
+        self.stats = HostStats(max_clients)
+        self.host = host
+
+    @property
+    def io_loop(self):
+        return self.client.io_loop
+
+    @coroutine
+    def fetch(self, request, **kwargs):
+        self.stats.started()
+        metrics.UPSTREAM_SENT_BYTES.inc(
+            len(getattr(request, 'body', None) or ''), host=self.host)
+        try:
+            response = yield self.client.fetch(request, **kwargs)
+        except httpclient.HTTPError as exc:
+            self.stats.finished(exc.response, error=True)
+            self.record(exc.response, exc.code)
+            raise
+        except Exception:
+            self.stats.finished(None, error=True)
+            self.record(None, 599)
+            raise
+
+        self.stats.finished(response)
+        self.record(response, response.code)
+        raise Return(response)
+
+    def record(self, response, code):
+        """Record the response's status code and size"""
+        metrics.UPSTREAM_RESPONSES.inc(host=self.host, code=code)
+        if response is not None:
+            metrics.UPSTREAM_RECEIVED_BYTES.inc(len(response.body or ''),
+                                                host=self.host)
+
+
+def get_client(url):
+    """
+    Get the shared client for the url's host
+
+    :param url: a url
+    :returns: an InstrumentedClient
+    """
+    host = urlparse(url).netloc
+    client = _clients.get(host)
+    if client is None or client.io_loop is not IOLoop.current():
+        max_clients = options.http_max_clients
+        client = InstrumentedClient(
+            httpclient.AsyncHTTPClient(force_instance=True,
+                                       max_clients=max_clients,
+                                       defaults=request_defaults()),
+            max_clients, host)
+        _clients[host] = client
+
+    return client
+
+
+def stats():
+    """Return the counters and timings for each host"""
+    return {
+        'client': 'curl' if use_curl() else 'simple',
+        'hosts': {host: client.stats.stats()
+                  for host, client in _clients.items()}
+    }
+
+
+class API(chub.API):
+    """
+    chub API client that sends its requests using the shared client for the
+    base_url's host
+    """
+
+    def __init__(self, base_url, api_version=API_VERSION, token=None):
+        # chub.API.__init__ is not used because it creates a new client
+        self.base_url = urljoin(base_url, api_version)
+        fetch = partial(async_fetch, httpclient=get_client(base_url))
+        Resource.__init__(self, self.base_url, fetch)
+        if token:
+            self.token = token
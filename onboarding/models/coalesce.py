@@ -0,0 +1,134 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Combine concurrent writes to the same destination into one request.
+
+Writes added with the same key within a short window are buffered and
+then flushed together, and every writer gets the result of the combined
+request.
+"""
+import re
+import sys
+
+from tornado.concurrent import Future, chain_future
+from tornado.ioloop import IOLoop
+
+from onboarding.models import metrics
+
+COALESCED_WRITES = metrics.Histogram(
+    'onboarding_coalesced_writes',
+    'Number of writes combined into each request to a repository service',
+    buckets=metrics.COUNT_BUCKETS)
+
+# a string literal (skipped) or a blank node label
+RE_BLANK_NODE = re.compile(
+    r'"(?:[^"\\]|\\.)*"|_:([A-Za-z0-9_][A-Za-z0-9_\-]*)')
+
+
+def merge_n3(documents):
+    """
+    Concatenate N3 documents, renaming the blank nodes of each document so
+    that documents using the same labels don't share nodes
+
+    :param documents: list of N3 strings
+    :returns: a single N3 string
+    """
+    if len(documents) == 1:
+        return documents[0]
+
+    merged = []
+    for index, document in enumerate(documents):
+        prefix = '_:d{}_'.format(index)
+
+        def rename(match):
+            if match.group(1) is None:
+                return match.group(0)
+            return prefix + match.group(1)
+
+        merged.append(RE_BLANK_NODE.sub(rename, document))
+
+    return '\n'.join(merged)
+
+
+class _Batch(object):
+    """Writes buffered for a key"""
+
+    def __init__(self):
+        self.items = []
+        self.size = 0
+        self.future = Future()
+        self.timeout = None
+
+
+class Coalescer(object):
+    """
+    Buffers writes for up to window seconds, or until they add up to
+    max_bytes, before flushing them with a single call.
+    """
+
+    def __init__(self, flush, window=0, max_bytes=0):
+        """
+        :param flush: function called with a key and the list of items
+            added for it, returning a Future resolving to the result shared
+            by all of the writes
+        :param window: seconds to wait for more writes after the first, 0
+            disables coalescing
+        :param max_bytes: flush once the buffered writes are at least this
+            large, 0 for no limit
+        """
+        self._flush = flush
+        self.window = window
+        self.max_bytes = max_bytes
+        self._batches = {}
+
+    @property
+    def enabled(self):
+        return bool(self.window)
+
+    def add(self, key, item, size=0):
+        """
+        Add a write to the key's batch
+
+        :param key: writes with equal keys are combined
+        :param item: passed to flush
+        :param size: the size of the item in bytes
+        :returns: a Future resolving to the result of flushing the batch
+        """
+        batch = self._batches.get(key)
+        if batch is None:
+            batch = self._batches[key] = _Batch()
+            batch.timeout = IOLoop.current().call_later(
+                self.window, self.flush, key)
+
+        batch.items.append(item)
+        batch.size += size
+        future = batch.future
+        if self.max_bytes and batch.size >= self.max_bytes:
+            self.flush(key)
+
+        return future
+
+    def flush(self, key):
+        """Flush the key's batch now"""
+        batch = self._batches.pop(key, None)
+        if batch is None:
+            return
+
+        IOLoop.current().remove_timeout(batch.timeout)
+        COALESCED_WRITES.observe(len(batch.items))
+        try:
+            result = self._flush(key, batch.items)
+        except Exception:
+            batch.future.set_exc_info(sys.exc_info())
+        else:
+            chain_future(result, batch.future)
+
+    def __len__(self):
+        return sum(len(batch.items) for batch in self._batches.values())
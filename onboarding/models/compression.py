@@ -0,0 +1,235 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Compress and decompress request and response bodies.
+
+Request bodies encoded with gzip or deflate are decompressed incrementally,
+and rejected as soon as they are larger than allowed or expand by more than
+a maximum ratio, so that a small body can't be used to fill the memory.
+
+Request bodies sent to other services are compressed with gzip if they are
+large enough, unless the service has shown it doesn't accept compressed
+bodies (see send).
+"""
+import logging
+import zlib
+from urlparse import urlparse
+
+from tornado import httpclient, web
+from tornado.gen import coroutine, Return
+from tornado.options import options
+
+# window bits of the zlib formats by Content-Encoding
+WBITS = {
+    'gzip': 16 + zlib.MAX_WBITS,
+    'x-gzip': 16 + zlib.MAX_WBITS,
+    'deflate': zlib.MAX_WBITS
+}
+
+IDENTITY = ('', 'identity')
+
+# request bodies sent to other services are compressed if they have at
+# least request_min_size bytes, 0 disables compression
+request_min_size = 0
+
+# whether other services accept compressed bodies, by host. Hosts that
+# haven't been sent a compressed body yet are not included.
+peers = {}
+
+
+class InvalidBody(ValueError):
+    """The body could not be decompressed"""
+
+
+def configure():
+    """Configure compression using the service's options"""
+    global request_min_size
+    request_min_size = options.compress_requests_min_size
+    GZipContentEncoding.MIN_LENGTH = options.compress_responses_min_size
+    peers.clear()
+
+
+def is_supported(encoding):
+    """Whether a Content-Encoding can be decompressed"""
+    return _normalise(encoding) in WBITS or _normalise(encoding) in IDENTITY
+
+
+def is_compressed(encoding):
+    """Whether a Content-Encoding is not the identity encoding"""
+    return _normalise(encoding) not in IDENTITY
+
+
+def _normalise(encoding):
+    return (encoding or '').strip().lower()
+
+
+class Decompressor(object):
+    """Decompresses a body as it is received"""
+
+    def __init__(self, encoding, max_size, max_ratio=None):
+        """
+        :param encoding: the Content-Encoding, gzip or deflate
+        :param max_size: maximum size of the decompressed body, in bytes
+        :param max_ratio: (optional) maximum ratio of the decompressed size
+            to the compressed size
+        """
+        self.max_size = max_size
+        self.max_ratio = max_ratio
+        self.size = 0
+        self.compressed_size = 0
+        self._decompressor = zlib.decompressobj(WBITS[_normalise(encoding)])
+
+    def feed(self, data):
+        """
+        Decompress the next part of the body
+
+        :param data: compressed bytes
+        :returns: the decompressed bytes
+        :raises: InvalidBody
+        """
+        self.compressed_size += len(data)
+        try:
+            # decompress at most one byte more than is allowed, so that the
+            # whole of an oversized body is never held in memory
+            result = self._decompressor.decompress(
+                data, self.max_size - self.size + 1)
+        except zlib.error as exc:
+            raise InvalidBody('Unable to decompress the body: {}'.format(exc))
+
+        return self._check(result)
+
+    def flush(self):
+        """
+        Decompress the rest of the body
+
+        :returns: the decompressed bytes
+        :raises: InvalidBody
+        """
+        try:
+            result = self._decompressor.flush()
+        except zlib.error as exc:
+            raise InvalidBody('Unable to decompress the body: {}'.format(exc))
+
+        return self._check(result)
+
+    def _check(self, result):
+        self.size += len(result)
+        if self.size > self.max_size or self._decompressor.unconsumed_tail:
+            raise InvalidBody(
+                'Decompressed body is too large. Max allowed is:{}'.format(
+                    self.max_size))
+        if self.max_ratio and self.size > self.max_ratio * self.compressed_size:
+            raise InvalidBody(
+                'Body expands by more than the maximum ratio of {}'.format(
+                    self.max_ratio))
+
+        return result
+
+
+def decompress(data, encoding, max_size, max_ratio=None):
+    """
+    Decompress a body
+
+    :param data: the compressed body
+    :param encoding: the Content-Encoding, gzip or deflate
+    :param max_size: maximum size of the decompressed body, in bytes
+    :param max_ratio: (optional) maximum ratio of the decompressed size to
+        the compressed size
+    :returns: the decompressed body
+    :raises: InvalidBody
+    """
+    decompressor = Decompressor(encoding, max_size, max_ratio)
+    return decompressor.feed(data) + decompressor.flush()
+
+
+def compress(data):
+    """
+    Compress a body with gzip
+
+    :param data: str or unicode, which is encoded as UTF-8
+    :returns: the compressed body
+    """
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+
+    compressor = zlib.compressobj(6, zlib.DEFLATED, WBITS['gzip'])
+    return compressor.compress(data) + compressor.flush()
+
+
+def _host(url):
+    return urlparse(url).netloc
+
+
+def request_encoding(url, size):
+    """
+    The Content-Encoding to use to send a body to a service
+
+    :param url: url of the service
+    :param size: size of the body, in bytes
+    :returns: 'gzip', or None if the body should not be compressed
+    """
+    if not request_min_size or size < request_min_size:
+        return None
+    if peers.get(_host(url)) is False:
+        return None
+    return 'gzip'
+
+
+@coroutine
+def send(endpoint, method, url, body, headers, **kwargs):
+    """
+    Send a request to another service, compressing the body if the service
+    accepts compressed bodies.
+
+    Until a service has accepted a compressed body, a compressed request it
+    rejects with 400 or 415 is sent again uncompressed. If that succeeds the
+    service is not sent compressed bodies again.
+
+    :param endpoint: a chub resource
+    :param method: the name of the endpoint's method, e.g. 'post'
+    :param url: url of the service
+    :param body: the request body
+    :param headers: the request headers
+    :param kwargs: other arguments for the HTTPRequest
+    :returns: the response
+    :raises: httpclient.HTTPError
+    """
+    host = _host(url)
+    encoding = request_encoding(url, len(body or ''))
+    if encoding:
+        endpoint.prepare_request(
+            headers=dict(headers, **{'Content-Encoding': encoding}),
+            body=compress(body),
+            **kwargs)
+        try:
+            response = yield getattr(endpoint, method)()
+        except httpclient.HTTPError as exc:
+            if exc.code not in (400, 415) or peers.get(host):
+                raise exc
+        else:
+            peers[host] = True
+            raise Return(response)
+
+    endpoint.prepare_request(headers=headers, body=body, **kwargs)
+    response = yield getattr(endpoint, method)()
+
+    if encoding:
+        logging.info('%s does not accept compressed bodies', host)
+        peers[host] = False
+
+    raise Return(response)
+
+
+class GZipContentEncoding(web.GZipContentEncoding):
+    """
+    Compress responses of at least MIN_LENGTH bytes for clients that accept
+    gzip, e.g. the id_maps of large onboarding requests
+    """
+    MIN_LENGTH = 1024
@@ -0,0 +1,78 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Run CPU bound work off the IOLoop.
+
+The executor is a thread or process pool chosen with the cpu_executor
+option. It is created the first time it is used, so that each of the
+service's forked processes has its own pool. Work on small inputs is run
+inline because it would take longer to hand it to the pool.
+"""
+import multiprocessing
+import sys
+
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from tornado.concurrent import Future
+from tornado.options import options
+
+EXECUTORS = {
+    'thread': ThreadPoolExecutor,
+    'process': ProcessPoolExecutor
+}
+
+_executor = None
+
+
+def configure():
+    """Shut down the current executor so it's recreated from the options"""
+    global _executor
+    if options.cpu_executor and options.cpu_executor not in EXECUTORS:
+        raise ValueError('Unknown cpu_executor "{}", must be one of {}'.format(
+            options.cpu_executor, sorted(EXECUTORS)))
+
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+def get_executor():
+    """
+    Get the process's executor
+
+    :returns: an Executor, or None if work is always run inline
+    """
+    global _executor
+    if _executor is None and options.cpu_executor:
+        workers = options.cpu_workers or multiprocessing.cpu_count()
+        _executor = EXECUTORS[options.cpu_executor](workers)
+
+    return _executor
+
+
+def run(size, func, *args):
+    """
+    Call a function in the executor, or inline if the input is small
+
+    :param size: size of the input, compared with the
+        cpu_inline_threshold option
+    :param func: the function, it must be picklable for a process pool
+    :param args: the function's arguments
+    :returns: a Future resolving to the function's result
+    """
+    executor = get_executor()
+    if executor is not None and size > options.cpu_inline_threshold:
+        return executor.submit(func, *args)
+
+    future = Future()
+    try:
+        future.set_result(func(*args))
+    except Exception:
+        future.set_exc_info(sys.exc_info())
+    return future
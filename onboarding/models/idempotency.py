@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Return the result of a recent identical onboarding request instead of
+onboarding the same data again.
+
+Requests are matched by their Idempotency-Key header, or by a hash of the
+request if deduplicating by content is enabled. A request that matches one
+still being processed waits for its result. Only successful results are
+kept.
+"""
+import hashlib
+from functools import partial
+
+from tornado.gen import coroutine, Return
+from tornado.options import options
+from koi import exceptions
+
+from onboarding.models.cache import LRUCache
+
+results = LRUCache('onboard_results')
+
+
+def configure():
+    """Set the size of the cache from the service's options"""
+    results.max_size = options.onboard_result_cache_size
+
+
+def fingerprint(data, content_type, repository_id, r2rml_url=None,
+                local_transform=None):
+    """
+    Hash the parts of a request that affect its result
+
+    :returns: a hex digest
+    """
+    digest = hashlib.sha256()
+    for part in (repository_id, content_type, r2rml_url, local_transform):
+        digest.update(repr(part))
+        digest.update('\0')
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+    digest.update(data or '')
+    return digest.hexdigest()
+
+
+def request_key(repository_id, request_fingerprint, idempotency_key=None,
+                dedupe_by_content=False):
+    """
+    The cache key of a request
+
+    :param repository_id: the repository ID
+    :param request_fingerprint: returned by fingerprint
+    :param idempotency_key: (optional) the Idempotency-Key header
+    :param dedupe_by_content: whether requests without an Idempotency-Key
+        are matched by their fingerprint
+    :returns: the key, or None if the result should not be shared
+    """
+    if idempotency_key:
+        return ('key', repository_id, idempotency_key)
+    if dedupe_by_content:
+        return ('content', repository_id, request_fingerprint)
+    return None
+
+
+def forget(repository_id):
+    """
+    Forget the results of onboarding to a repository, so that assets
+    deleted from it are onboarded again by a repeated request
+    """
+    for key in results.keys():
+        if key[1] == repository_id:
+            results.invalidate(key)
+
+
+def is_known(key):
+    """Whether a result for the key is cached or being produced"""
+    return key is not None and (key in results or results.is_pending(key))
+
+
+@coroutine
+def run_once(key, request_fingerprint, func, ttl=300):
+    """
+    Call func, unless there is already a result for the key
+
+    :param key: returned by request_key, func is always called if None
+    :param request_fingerprint: returned by fingerprint
+    :param func: function returning a Future that resolves to a
+        (data, http_status, errors) tuple
+    :param ttl: seconds a successful result is kept for
+    :returns: the result of func
+    :raises: HTTPError 422 if an Idempotency-Key is reused for a different
+        request
+    """
+    if key is None:
+        result = yield func()
+        raise Return(result)
+
+    stored_fingerprint, result = yield results.get_or_fetch(
+        key, partial(_fetch, request_fingerprint, func, ttl))
+
+    if stored_fingerprint != request_fingerprint:
+        raise exceptions.HTTPError(
+            422, 'Idempotency-Key has already been used for a different '
+                 'request')
+
+    raise Return(result)
+
+
+@coroutine
+def _fetch(request_fingerprint, func, ttl):
+    result = yield func()
+    _, http_status, errors = result
+    if errors or http_status != 200:
+        ttl = 0
+    raise Return(((request_fingerprint, result), ttl))
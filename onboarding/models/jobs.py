@@ -0,0 +1,287 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Background onboarding jobs.
+
+Jobs are queued and run by a fixed number of workers in each process. The
+state of each job is kept in a backend: the memory backend only holds the
+jobs of the current process, the file backend writes them to a directory so
+that they can be read by any of the service's processes.
+"""
+import json
+import logging
+import os
+import tempfile
+import time
+import uuid
+from collections import OrderedDict
+
+from tornado.gen import coroutine
+from tornado.ioloop import IOLoop
+from tornado.options import options
+from tornado.queues import Queue, QueueFull
+from koi import exceptions
+
+QUEUED = 'queued'
+RUNNING = 'running'
+COMPLETED = 'completed'
+FAILED = 'failed'
+FINISHED = (COMPLETED, FAILED)
+
+
+def new_job(repository_id):
+    """
+    Create the record of a job
+
+    :param repository_id: the repository the job onboards assets to
+    :returns: dictionary describing the job
+    """
+    now = time.time()
+    return {
+        'id': uuid.uuid4().hex,
+        'repository_id': repository_id,
+        'status': QUEUED,
+        'created': now,
+        'updated': now,
+        'progress': {'completed': 0, 'total': None},
+        'http_status': None,
+        'data': None,
+        'errors': []
+    }
+
+
+def error_list(exc):
+    """
+    Format the errors of an HTTPError like the errors in a response
+
+    :param exc: a koi HTTPError
+    :returns: list of error objects
+    """
+    errors = exc.errors
+    if not isinstance(errors, list):
+        errors = [errors]
+    return [error if isinstance(error, dict)
+            else {'source': exc.source, 'message': error}
+            for error in errors]
+
+
+class MemoryBackend(object):
+    """Keeps jobs in this process, evicting the oldest finished jobs"""
+
+    def __init__(self, max_jobs=1000, ttl=3600):
+        """
+        :param max_jobs: maximum number of jobs to keep
+        :param ttl: seconds a finished job is kept for
+        """
+        self.max_jobs = max_jobs
+        self.ttl = ttl
+        self._jobs = OrderedDict()
+
+    def save(self, job):
+        self._jobs.pop(job['id'], None)
+        self._jobs[job['id']] = job
+        self._evict()
+
+    def get(self, job_id):
+        job = self._jobs.get(job_id)
+        if job is not None and self._expired(job):
+            del self._jobs[job_id]
+            return None
+        return job
+
+    def _expired(self, job):
+        return (job['status'] in FINISHED and
+                job['updated'] + self.ttl <= time.time())
+
+    def _evict(self):
+        for job_id, job in self._jobs.items():
+            if len(self._jobs) <= self.max_jobs and not self._expired(job):
+                break
+            if job['status'] in FINISHED:
+                del self._jobs[job_id]
+
+
+class FileBackend(object):
+    """
+    Keeps each job in a JSON file in a directory shared by all processes.
+    Files of finished jobs are removed once they expire.
+    """
+
+    def __init__(self, directory, ttl=3600):
+        """
+        :param directory: directory for the job files, created if needed
+        :param ttl: seconds a finished job is kept for
+        """
+        self.directory = directory
+        self.ttl = ttl
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, job_id):
+        # job ids are generated by new_job, don't let a requested id point
+        # outside the directory
+        return os.path.join(self.directory,
+                            '{}.json'.format(os.path.basename(job_id)))
+
+    def save(self, job):
+        # write to a temporary file first so that readers never see a
+        # partially written job
+        fd, path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(job, f)
+        os.rename(path, self._path(job['id']))
+
+        if job['status'] in FINISHED:
+            self._evict()
+
+    def get(self, job_id):
+        try:
+            with open(self._path(job_id)) as f:
+                job = json.load(f)
+        except (IOError, ValueError):
+            return None
+
+        if job['status'] in FINISHED and job['updated'] + self.ttl <= time.time():
+            return None
+        return job
+
+    def _evict(self):
+        expired = time.time() - self.ttl
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            try:
+                if os.path.getmtime(path) < expired:
+                    os.remove(path)
+            except OSError:
+                # removed by another process
+                pass
+
+
+BACKENDS = {
+    'memory': lambda: MemoryBackend(options.max_jobs, options.job_ttl),
+    'file': lambda: FileBackend(options.job_dir, options.job_ttl)
+}
+
+
+class JobQueue(object):
+    """
+    Runs jobs in the background, with at most max_workers running at the
+    same time
+    """
+
+    def __init__(self, backend, max_workers=2, max_queued=100):
+        """
+        :param backend: where the state of the jobs is kept
+        :param max_workers: number of jobs run concurrently
+        :param max_queued: number of jobs that can wait to be run
+        """
+        self.backend = backend
+        self.max_workers = max_workers
+        self.max_queued = max_queued
+        self._queue = None
+        self._io_loop = None
+
+    def _start(self):
+        """Start the workers on the current IOLoop if they aren't running"""
+        io_loop = IOLoop.current()
+        if self._queue is not None and self._io_loop is io_loop:
+            return
+
+        self._io_loop = io_loop
+        self._queue = Queue(maxsize=self.max_queued)
+        for _ in range(self.max_workers):
+            io_loop.spawn_callback(self._worker, self._queue)
+
+    def submit(self, repository_id, work):
+        """
+        Queue a job
+
+        :param repository_id: the repository the job onboards assets to
+        :param work: function called with a progress callback, returning a
+            Future that resolves to a (data, http_status, errors) tuple
+        :returns: the job
+        :raises: HTTPError 503 if the queue is full
+        """
+        self._start()
+        job = new_job(repository_id)
+        try:
+            self._queue.put_nowait((job, work))
+        except QueueFull:
+            raise exceptions.HTTPError(
+                503, 'Too many jobs are queued, try again later')
+
+        self.backend.save(job)
+        return job
+
+    def get(self, job_id):
+        """Get a job, or None if it isn't known"""
+        return self.backend.get(job_id)
+
+    @coroutine
+    def _worker(self, queue):
+        while True:
+            job, work = yield queue.get()
+            try:
+                yield self._run(job, work)
+            finally:
+                queue.task_done()
+
+    @coroutine
+    def _run(self, job, work):
+        self._update(job, status=RUNNING)
+
+        def progress(completed, total):
+            job['progress'] = {'completed': completed, 'total': total}
+            self._update(job)
+
+        try:
+            data, http_status, errors = yield work(progress)
+        except exceptions.HTTPError as exc:
+            logging.warning('Job {} failed: {}'.format(job['id'], exc))
+            self._update(job, status=FAILED, http_status=exc.status_code,
+                         errors=error_list(exc))
+        except Exception:
+            logging.exception('Job {} failed'.format(job['id']))
+            self._update(job, status=FAILED, http_status=500,
+                         errors=[{'message': 'Internal Server Error'}])
+        else:
+            self._update(job, status=FAILED if errors else COMPLETED,
+                         http_status=http_status, data=data,
+                         errors=errors or [])
+
+    def _update(self, job, **kwargs):
+        job.update(kwargs, updated=time.time())
+        try:
+            self.backend.save(job)
+        except (IOError, OSError):
+            logging.exception('Could not save job {}'.format(job['id']))
+
+
+queue = None
+
+
+def configure():
+    """Create the job queue using the backend set by the job_store option"""
+    global queue
+    try:
+        backend = BACKENDS[options.job_store]()
+    except KeyError:
+        raise ValueError('Unknown job_store "{}", must be one of {}'.format(
+            options.job_store, sorted(BACKENDS)))
+
+    queue = JobQueue(backend, options.max_concurrent_jobs,
+                     options.max_queued_jobs)
+
+
+def get_queue():
+    """The process's job queue, created with the configured options"""
+    if queue is None:
+        configure()
+    return queue
@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Transform source data with the default mapping without calling the
+transformation service.
+
+The default mapping is fixed (see the onboarding API documentation), so the
+N-Triples it produces can be written directly while the data is read, along
+with the id_map, instead of parsing them back out of the transformation
+service's response.
+"""
+import csv
+import io
+import json
+import uuid
+from datetime import datetime
+from urllib import quote
+
+from bass.hubkey import generate_hub_key, is_hub_key, parse_hub_key
+
+ID = u'http://openpermissions.org/ns/id/'
+HUB = u'http://openpermissions.org/ns/hub/'
+OP = u'http://openpermissions.org/ns/op/1.1/'
+RDF_TYPE = u'<http://www.w3.org/1999/02/22-rdf-syntax-ns#type>'
+DESCRIPTION = u'<http://purl.org/dc/terms/description>'
+MODIFIED = u'<http://purl.org/dc/terms/modified>'
+DATE_TIME = u'<http://www.w3.org/2001/XMLSchema#dateTime>'
+
+LITERAL_ESCAPES = {
+    u'\\': u'\\\\',
+    u'"': u'\\"',
+    u'\n': u'\\n',
+    u'\r': u'\\r',
+    u'\t': u'\\t'
+}
+
+CSV_FIELDS = ('source_id_types', 'source_ids')
+
+
+class InvalidData(ValueError):
+    """The data can't be transformed with the default mapping"""
+
+    def __init__(self, message, line=None):
+        super(InvalidData, self).__init__(message)
+        self.line = line
+
+    def error(self):
+        """The error in the format returned by the transformation service"""
+        error = {'source': 'onboarding', 'message': self.args[0]}
+        if self.line is not None:
+            error['line'] = self.line
+        return error
+
+
+def literal(value):
+    """Format a value as an N-Triples literal"""
+    return u'"{}"'.format(u''.join(LITERAL_ESCAPES.get(char, char)
+                                   for char in value))
+
+
+def iri_part(value):
+    """Percent encode a value so that it can be used in an IRI"""
+    return quote(value.encode('utf-8'), safe='').decode('ascii')
+
+
+def entity_id(value):
+    """The entity ID of an offer or set, which may be given as a hub key"""
+    if is_hub_key(value):
+        return parse_hub_key(value)['entity_id']
+    return value
+
+
+class Writer(object):
+    """Writes the triples and id_map entries of assets"""
+
+    def __init__(self, resolver_id, hub_id, repository_id):
+        self.resolver_id = resolver_id
+        self.hub_id = hub_id
+        self.repository_id = repository_id
+        self.modified = u'{}^^{}'.format(
+            literal(datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%S.%fZ')),
+            DATE_TIME)
+        self.id_map = []
+        self._lines = []
+
+    def asset(self, source_ids, offer_ids=(), set_ids=(), description=None):
+        """
+        Add an asset
+
+        :param source_ids: list of (source_id_type, source_id) tuples
+        :param offer_ids: IDs of offers for the asset
+        :param set_ids: IDs of sets the asset belongs to
+        :param description: description of the asset
+        """
+        asset_id = uuid.uuid4().hex
+        asset = u'<{}{}>'.format(ID, asset_id)
+        lines = self._lines
+
+        lines.append(u'{} {} <{}Asset> .'.format(asset, RDF_TYPE, OP))
+        if description:
+            lines.append(u'{} {} {} .'.format(asset, DESCRIPTION,
+                                              literal(description)))
+        lines.append(u'{} {} {} .'.format(asset, MODIFIED, self.modified))
+
+        for index, (id_type, value) in enumerate(source_ids):
+            node = u'_:Id{}N{}'.format(asset_id, index)
+            id_type_iri = u'<{}{}>'.format(HUB, iri_part(id_type))
+            lines.append(u'{} <{}alsoIdentifiedBy> {} .'.format(asset, OP, node))
+            lines.append(u'{} {} <{}Id> .'.format(node, RDF_TYPE, OP))
+            lines.append(u'{} <{}id_type> {} .'.format(node, OP, id_type_iri))
+            lines.append(u'{} <{}value> {} .'.format(node, OP, literal(value)))
+            lines.append(u'{} {} <{}IdType> .'.format(id_type_iri, RDF_TYPE, OP))
+
+        for offer_id in offer_ids:
+            offer = u'<{}{}>'.format(ID, iri_part(entity_id(offer_id)))
+            lines.append(u'{} {} <{}Policy> .'.format(offer, RDF_TYPE, OP))
+            lines.append(u'{} <{}defaultTarget> {} .'.format(offer, OP, asset))
+
+        for set_id in set_ids:
+            asset_set = u'<{}{}>'.format(ID, iri_part(entity_id(set_id)))
+            lines.append(u'{} {} <{}AssetSet> .'.format(asset_set, RDF_TYPE, OP))
+            lines.append(u'{} <{}hasElement> {} .'.format(asset_set, OP, asset))
+
+        # a blank line separates the assets, as in the transformation
+        # service's output
+        lines.append(u'')
+
+        hub_key = generate_hub_key(self.resolver_id, self.hub_id,
+                                   self.repository_id, 'asset', asset_id)
+        self.id_map.append({
+            'entity_type': 'asset',
+            'entity_id': asset_id,
+            'hub_key': hub_key,
+            'source_ids': [{'source_id_type': id_type, 'source_id': value}
+                           for id_type, value in source_ids]
+        })
+
+    def result(self):
+        """The transformed data, like the transformation service's response"""
+        return {'data': {'rdf_n3': u'\n'.join(self._lines),
+                         'id_map': self.id_map}}
+
+
+def _split(value):
+    """Split a tilde separated CSV field"""
+    parts = (part.strip() for part in value.split(u'~'))
+    return [part for part in parts if part]
+
+
+def _text(value):
+    if isinstance(value, str):
+        return value.decode('utf-8')
+    if value is None:
+        return u''
+    return unicode(value)
+
+
+def read_csv(data):
+    """
+    Read assets from CSV data
+
+    :param data: CSV with source_id_types and source_ids columns
+    :returns: generator of (line number, source ids, offer ids, set ids,
+        description)
+    :raises: InvalidData
+    """
+    if isinstance(data, unicode):
+        data = data.encode('utf-8')
+
+    reader = csv.DictReader(io.BytesIO(data))
+    try:
+        fieldnames = reader.fieldnames
+    except csv.Error as exc:
+        raise InvalidData(str(exc), 1)
+    if not fieldnames:
+        raise InvalidData('Missing csv data', 1)
+
+    fields = [field.strip() for field in fieldnames]
+    reader.fieldnames = fields
+    for field in CSV_FIELDS:
+        if field not in fields:
+            raise InvalidData('Missing "{}" column'.format(field), 1)
+
+    try:
+        for row in reader:
+            line = reader.line_num
+            id_types = _split(_text(row.get('source_id_types')))
+            ids = _split(_text(row.get('source_ids')))
+            if not ids:
+                raise InvalidData('Missing source_ids', line)
+            if len(id_types) != len(ids):
+                raise InvalidData('The number of source_id_types and '
+                                  'source_ids must be the same', line)
+
+            yield (line, zip(id_types, ids),
+                   _split(_text(row.get('offer_ids'))),
+                   _split(_text(row.get('set_ids'))),
+                   _text(row.get('description')).strip())
+    except csv.Error as exc:
+        # e.g. a line ending that isn't \n or \r\n inside the data. The
+        # line that failed hasn't been counted yet
+        raise InvalidData(str(exc), reader.line_num + 1)
+
+
+def read_json(data):
+    """
+    Read assets from JSON data
+
+    :param data: JSON array of assets
+    :returns: generator of (index, source ids, offer ids, set ids,
+        description)
+    :raises: InvalidData
+    """
+    try:
+        items = json.loads(data) if data else None
+    except ValueError:
+        raise InvalidData('Invalid json data')
+
+    if not items:
+        raise InvalidData('Missing json data')
+    if not isinstance(items, list):
+        raise InvalidData('Expected an array of assets')
+
+    for index, item in enumerate(items):
+        try:
+            source_ids = [(_text(source_id['source_id_type']),
+                           _text(source_id['source_id']))
+                          for source_id in item['source_ids']]
+            offer_ids = [_text(offer_id) for offer_id in item.get('offer_ids', [])]
+            set_ids = [_text(set_id) for set_id in item.get('set_ids', [])]
+            description = _text(item.get('description'))
+        except (AttributeError, KeyError, TypeError):
+            raise InvalidData('Invalid asset at index {}, source_ids is '
+                              'required'.format(index))
+
+        if not source_ids:
+            raise InvalidData('Missing source_ids at index {}'.format(index))
+
+        yield index, source_ids, offer_ids, set_ids, description
+
+
+READERS = {
+    'text/csv': read_csv,
+    'application/json': read_json
+}
+
+
+def transform(data, content_type, repository_id, resolver_id, hub_id):
+    """
+    Transform source data with the default mapping.
+
+    The options are passed in so that it can be run in another process.
+
+    :param data: the source data
+    :param content_type: the http request content type
+    :param repository_id: the repository ID
+    :param resolver_id: the hub key resolver ID
+    :param hub_id: the hub ID
+    :return: transformed data (with rdf_n3 and id_map), http status and
+        errors, like assets.transform
+    """
+    reader = READERS.get((content_type or '').split(';')[0].strip())
+    if reader is None:
+        error = {'source': 'onboarding',
+                 'message': 'Unsupported content type "{}"'.format(content_type)}
+        return None, 415, [error]
+
+    writer = Writer(resolver_id, hub_id, repository_id)
+    try:
+        for _, source_ids, offer_ids, set_ids, description in reader(data):
+            writer.asset(source_ids, offer_ids, set_ids, description)
+    except InvalidData as exc:
+        return None, 400, [exc.error()]
+
+    if not writer.id_map:
+        return None, 400, [InvalidData('No assets found in the data').error()]
+
+    return writer.result(), 200, []
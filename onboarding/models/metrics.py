@@ -0,0 +1,344 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Counters and latency histograms in the Prometheus text format.
+
+Each process records its own metrics. So that they can be aggregated across
+the processes forked by the service, every process writes its metrics to a
+file in the metrics_dir directory every metrics_interval seconds. The
+metrics endpoint adds up the files of all processes.
+"""
+import functools
+import json
+import logging
+import os
+import tempfile
+import time
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.options import options
+
+# all metrics, by name
+METRICS = {}
+
+# upper bounds of the buckets of latency histograms, in seconds
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0)
+# upper bounds of the buckets of histograms of numbers of assets
+COUNT_BUCKETS = (1, 10, 100, 1000, 10000, 100000, 1000000)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4'
+
+# directory shared by the service's processes, None if the metrics are not
+# aggregated
+directory = None
+_writer = None
+
+
+class Counter(object):
+    """A value that only goes up, for each combination of label values"""
+
+    type = 'counter'
+
+    def __init__(self, name, description, labels=()):
+        """
+        :param name: name of the metric
+        :param description: help text for the metric
+        :param labels: names of the labels
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self.values = {}
+        METRICS[name] = self
+
+    def _key(self, labels):
+        return tuple(unicode(labels[label]) for label in self.labels)
+
+    def inc(self, amount=1, **labels):
+        """Add to the value for the labels"""
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def clear(self):
+        """Reset all values"""
+        self.values.clear()
+
+    def dump(self):
+        """The metric as JSON serialisable data, see merge"""
+        return {
+            'type': self.type,
+            'help': self.description,
+            'labels': self.labels,
+            'values': [[list(key), value] for key, value in self.values.items()]
+        }
+
+
+class Gauge(Counter):
+    """A value that goes up and down, for each combination of label values.
+    The values of the processes are added up."""
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        """Set the value for the labels"""
+        self.values[self._key(labels)] = value
+
+    def remove(self, **labels):
+        """Remove the value for the labels"""
+        self.values.pop(self._key(labels), None)
+
+
+class Histogram(Counter):
+    """Counts of observations in buckets, for each combination of labels"""
+
+    type = 'histogram'
+
+    def __init__(self, name, description, labels=(), buckets=SECONDS_BUCKETS):
+        """
+        :param name: name of the metric
+        :param description: help text for the metric
+        :param labels: names of the labels
+        :param buckets: upper bounds of the buckets, in increasing order
+        """
+        super(Histogram, self).__init__(name, description, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        """Record an observation"""
+        key = self._key(labels)
+        # a count for each bucket and +Inf, then the sum of the values
+        counts = self.values.get(key)
+        if counts is None:
+            counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+
+        for index, bound in enumerate(self.buckets):
+            if value <= bound:
+                break
+        else:
+            index = len(self.buckets)
+        counts[index] += 1
+        counts[-1] += value
+
+    def dump(self):
+        result = super(Histogram, self).dump()
+        result['buckets'] = self.buckets
+        return result
+
+
+def _add(total, value):
+    if isinstance(total, list):
+        return [a + b for a, b in zip(total, value)]
+    return total + value
+
+
+def merge(dumps):
+    """
+    Add up metrics dumped by several processes
+
+    :param dumps: list of dictionaries of dumped metrics by name
+    :returns: dictionary of merged metrics by name
+    """
+    merged = {}
+    for metrics in dumps:
+        for name, metric in metrics.items():
+            target = merged.get(name)
+            if target is None:
+                target = merged[name] = dict(metric, values={})
+            for key, value in metric['values']:
+                key = tuple(key)
+                if key in target['values']:
+                    value = _add(target['values'][key], value)
+                target['values'][key] = value
+
+    for metric in merged.values():
+        metric['values'] = sorted(metric['values'].items())
+    return merged
+
+
+def _labels(names, values, extra=()):
+    pairs = zip(names, values) + list(extra)
+    if not pairs:
+        return ''
+    return u'{{{}}}'.format(u','.join(
+        u'{}="{}"'.format(name, unicode(value).replace(u'\\', u'\\\\')
+                          .replace(u'"', u'\\"').replace(u'\n', u'\\n'))
+        for name, value in pairs))
+
+
+def _number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(metrics):
+    """
+    Format metrics in the Prometheus text format
+
+    :param metrics: dictionary of metrics by name, returned by merge
+    :returns: unicode
+    """
+    lines = []
+    for name in sorted(metrics):
+        metric = metrics[name]
+        lines.append(u'# HELP {} {}'.format(name, metric['help']))
+        lines.append(u'# TYPE {} {}'.format(name, metric['type']))
+        for key, value in metric['values']:
+            if metric['type'] != 'histogram':
+                lines.append(u'{}{} {}'.format(
+                    name, _labels(metric['labels'], key), _number(value)))
+                continue
+
+            cumulative = 0
+            bounds = [_number(bound) for bound in metric['buckets']] + ['+Inf']
+            for bound, count in zip(bounds, value):
+                cumulative += count
+                lines.append(u'{}_bucket{} {}'.format(
+                    name, _labels(metric['labels'], key, [('le', bound)]),
+                    cumulative))
+            labels = _labels(metric['labels'], key)
+            lines.append(u'{}_sum{} {}'.format(name, labels, _number(value[-1])))
+            lines.append(u'{}_count{} {}'.format(name, labels, cumulative))
+
+    return u'\n'.join(lines) + u'\n'
+
+
+def dump():
+    """This process's metrics as JSON serialisable data"""
+    return {name: metric.dump() for name, metric in METRICS.items()}
+
+
+def _path(pid):
+    return os.path.join(directory, '{}.json'.format(pid))
+
+
+def write():
+    """Write this process's metrics to its file in the directory"""
+    if not directory:
+        return
+
+    try:
+        # write to a temporary file first so that readers never see a
+        # partially written file
+        fd, path = tempfile.mkstemp(dir=directory, suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(dump(), f)
+        os.rename(path, _path(os.getpid()))
+    except EnvironmentError:
+        logging.exception('Unable to write metrics to %s', directory)
+
+
+def collect():
+    """
+    The metrics of all the service's processes
+
+    :returns: dictionary of merged metrics by name
+    """
+    if not directory:
+        return merge([dump()])
+
+    write()
+    dumps = []
+    for name in os.listdir(directory):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                dumps.append(json.load(f))
+        except (EnvironmentError, ValueError):
+            # removed or being replaced by another process
+            pass
+
+    return merge(dumps)
+
+
+def configure():
+    """
+    Set the directory from the service's options, removing the files of
+    the previous run. Called before the processes are forked.
+    """
+    global directory
+    directory = options.metrics_dir or None
+    if not directory:
+        return
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    for name in os.listdir(directory):
+        try:
+            os.remove(os.path.join(directory, name))
+        except OSError:
+            pass
+
+
+def start():
+    """Start writing this process's metrics periodically"""
+    global _writer
+    if directory and _writer is None:
+        _writer = PeriodicCallback(write, options.metrics_interval * 1000)
+        _writer.start()
+
+
+def timed(stage):
+    """
+    Decorator recording how long the Future returned by a function takes to
+    resolve in the stage_seconds histogram
+
+    :param stage: the stage label
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start_time = time.time()
+            future = func(*args, **kwargs)
+
+            def record(_):
+                STAGE_SECONDS.observe(time.time() - start_time, stage=stage)
+
+            if isinstance(future, Future):
+                future.add_done_callback(record)
+            else:
+                # e.g. an executor's Future, whose callbacks are run in
+                # another thread
+                IOLoop.current().add_future(future, record)
+            return future
+        return wrapper
+    return decorator
+
+
+STAGE_SECONDS = Histogram(
+    'onboarding_stage_seconds',
+    'Time taken by each stage of onboarding, in seconds',
+    labels=('stage',))
+ASSETS = Histogram(
+    'onboarding_assets_per_request',
+    'Number of assets onboarded or deleted by each request',
+    labels=('method',), buckets=COUNT_BUCKETS)
+REQUEST_BYTES = Counter(
+    'onboarding_request_bytes_total',
+    'Bytes received in the bodies of requests to onboard or delete assets',
+    labels=('method',))
+RESPONSE_BYTES = Counter(
+    'onboarding_response_bytes_total',
+    'Bytes sent in the bodies of responses to requests to onboard or delete '
+    'assets',
+    labels=('method',))
+UPSTREAM_SENT_BYTES = Counter(
+    'onboarding_upstream_sent_bytes_total',
+    'Bytes sent in the bodies of requests to other services',
+    labels=('host',))
+UPSTREAM_RECEIVED_BYTES = Counter(
+    'onboarding_upstream_received_bytes_total',
+    'Bytes received in the bodies of responses from other services',
+    labels=('host',))
+UPSTREAM_RESPONSES = Counter(
+    'onboarding_upstream_responses_total',
+    'Responses from other services by status code, 599 for connection errors',
+    labels=('host', 'code'))
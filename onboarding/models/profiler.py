@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Profile a running process for a few seconds.
+
+Everything the IOLoop runs while the profile is being taken is profiled,
+including the handling of other requests. Only one profile is taken at a
+time in each process.
+"""
+import cProfile
+import pstats
+from cStringIO import StringIO
+
+from tornado.gen import coroutine, sleep, Return
+
+SORT_KEYS = ('cumulative', 'time', 'calls')
+
+# whether a profile is being taken
+_running = False
+
+
+class ProfileRunning(Exception):
+    """A profile is already being taken"""
+
+
+@coroutine
+def profile(seconds, sort='cumulative', limit=50):
+    """
+    Profile the IOLoop's thread
+
+    :param seconds: how long to profile for
+    :param sort: how the functions are sorted, one of SORT_KEYS
+    :param limit: maximum number of functions in the report
+    :returns: the pstats report
+    :raises: ProfileRunning
+    """
+    global _running
+    if _running:
+        raise ProfileRunning('A profile is already being taken')
+
+    _running = True
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield sleep(seconds)
+    finally:
+        profiler.disable()
+        _running = False
+
+    output = StringIO()
+    stats = pstats.Stats(profiler, stream=output)
+    stats.sort_stats(sort).print_stats(limit)
+    raise Return(output.getvalue())
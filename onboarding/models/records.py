@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Split CSV and JSON source data into chunks of whole records.
+
+Data can be fed to a splitter in pieces of any size, e.g. as it is received.
+Each chunk is a valid document on its own: CSV chunks start with the header
+row and JSON chunks are arrays of the elements of the source array.
+"""
+import re
+
+CSV_TOKENS = re.compile(r'["\n]')
+JSON_TOKENS = re.compile(r'["\\\[\]{},]')
+
+
+class CSVSplitter(object):
+    """Split CSV data on row boundaries"""
+
+    def __init__(self, max_size=None, max_records=None):
+        """
+        :param max_size: a chunk is emitted once it has at least this many
+            bytes
+        :param max_records: a chunk is emitted once it has this many rows
+            (not including the header)
+        """
+        self.max_size = max_size
+        self.max_records = max_records
+        self.header = None
+        self._partial = []
+        self._rows = []
+        self._size = 0
+        self._quoted = False
+
+    def feed(self, data):
+        """
+        Add data to the splitter
+
+        :param data: the next piece of the CSV document
+        :returns: list of complete chunks
+        """
+        chunks = []
+        start = 0
+        for match in CSV_TOKENS.finditer(data):
+            if match.group() == '"':
+                self._quoted = not self._quoted
+            elif not self._quoted:
+                self._partial.append(data[start:match.end()])
+                self._add_row(''.join(self._partial))
+                self._partial = []
+                start = match.end()
+                chunks.extend(self._chunks())
+
+        self._partial.append(data[start:])
+        return chunks
+
+    def close(self):
+        """
+        Signal the end of the data
+
+        :returns: list of remaining chunks
+        """
+        row = ''.join(self._partial)
+        self._partial = []
+        if row.strip():
+            self._add_row(row)
+
+        return self._chunks(final=True)
+
+    def _add_row(self, row):
+        if self.header is None:
+            self.header = row
+        elif row.strip():
+            self._rows.append(row)
+            self._size += len(row)
+
+    def _full(self):
+        return ((self.max_size is not None and self._size >= self.max_size) or
+                (self.max_records is not None and
+                 len(self._rows) >= self.max_records))
+
+    def _chunks(self, final=False):
+        chunks = []
+        if self._rows and (final or self._full()):
+            header = self.header
+            if not header.endswith('\n'):
+                header += '\n'
+            chunks.append(header + ''.join(self._rows))
+            self._rows = []
+            self._size = 0
+
+        return chunks
+
+
+class JSONSplitter(object):
+    """Split a JSON array into smaller arrays"""
+
+    def __init__(self, max_size=None, max_records=None):
+        """
+        :param max_size: a chunk is emitted once it has at least this many
+            bytes
+        :param max_records: a chunk is emitted once it has this many elements
+        """
+        self.max_size = max_size
+        self.max_records = max_records
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._started = False
+        self._partial = []
+        self._elements = []
+        self._size = 0
+
+    def feed(self, data):
+        """
+        Add data to the splitter
+
+        :param data: the next piece of the JSON document
+        :returns: list of complete chunks
+        :raises: ValueError if the data is not a JSON array
+        """
+        if not self._started:
+            stripped = data.lstrip()
+            if not stripped:
+                return []
+            if stripped[0] != '[':
+                raise ValueError('Expected a JSON array')
+
+        start = 0
+        chunks = []
+        pos = 0
+        while True:
+            match = JSON_TOKENS.search(data, pos)
+            if match is None:
+                break
+            pos = match.end()
+            char = match.group()
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == '\\':
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                continue
+
+            if char == '"':
+                self._in_string = True
+            elif char in '[{':
+                self._depth += 1
+                if not self._started:
+                    self._started = True
+                    start = pos
+            elif char in ']}':
+                self._depth -= 1
+                if self._depth == 0:
+                    self._partial.append(data[start:match.start()])
+                    self._add_element()
+                    start = pos
+            elif char == ',' and self._depth == 1:
+                self._partial.append(data[start:match.start()])
+                self._add_element()
+                start = pos
+
+            chunks.extend(self._chunks())
+
+        if self._started and self._depth > 0:
+            self._partial.append(data[start:])
+
+        return chunks
+
+    def close(self):
+        """
+        Signal the end of the data
+
+        :returns: list of remaining chunks
+        :raises: ValueError if the array is incomplete
+        """
+        if self._depth > 0 or self._in_string:
+            raise ValueError('Incomplete JSON array')
+
+        return self._chunks(final=True)
+
+    def _add_element(self):
+        element = ''.join(self._partial).strip()
+        self._partial = []
+        if element:
+            self._elements.append(element)
+            self._size += len(element)
+
+    def _full(self):
+        return ((self.max_size is not None and self._size >= self.max_size) or
+                (self.max_records is not None and
+                 len(self._elements) >= self.max_records))
+
+    def _chunks(self, final=False):
+        chunks = []
+        if self._elements and (final or self._full()):
+            chunks.append('[' + ','.join(self._elements) + ']')
+            self._elements = []
+            self._size = 0
+
+        return chunks
+
+
+SPLITTERS = {
+    'text/csv': CSVSplitter,
+    'application/json': JSONSplitter
+}
+
+
+def make_splitter(content_type, max_size=None, max_records=None):
+    """
+    Create a splitter for the content type
+
+    :param content_type: the content type of the data, e.g. text/csv
+    :param max_size: minimum size of a chunk, in bytes
+    :param max_records: maximum number of records in a chunk
+    :returns: a splitter
+    :raises: ValueError if the content type is not supported
+    """
+    try:
+        splitter = SPLITTERS[content_type.split(';')[0].strip()]
+    except (AttributeError, KeyError):
+        raise ValueError('Unsupported content type "{}"'.format(content_type))
+
+    return splitter(max_size=max_size, max_records=max_records)
+
+
+def split(data, content_type, max_size=None, max_records=None):
+    """
+    Split a whole document into chunks
+
+    :param data: the source data
+    :param content_type: the content type of the data, e.g. text/csv
+    :param max_size: minimum size of a chunk, in bytes
+    :param max_records: maximum number of records in a chunk
+    :returns: list of chunks
+    :raises: ValueError
+    """
+    splitter = make_splitter(content_type, max_size, max_records)
+    return splitter.feed(data) + splitter.close()
@@ -7,6 +7,7 @@
 # distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and limitations under the License.
 
+import hashlib
 import logging
 import json
 import functools
@@ -17,9 +18,34 @@ from tornado.options import options
 from tornado import httpclient
 from tornado.gen import coroutine, Return
 from tornado.concurrent import Future
-from chub import API, oauth2
+from chub import oauth2
 from koi import exceptions
-from koi.configure import ssl_server_options
+
+from onboarding.models import (coalesce, compression, metrics, resilience,
+                               scheduler, tracing)
+from onboarding.models.cache import LRUCache, SpillCache
+from onboarding.models.clients import API, ssl_options
+from onboarding.models.tokens import token_scope, token_ttl, TokenManager
+
+# delegated tokens by (caller's token, repository ID)
+delegate_tokens = LRUCache('delegate_tokens')
+# repositories by repository ID
+repositories = LRUCache('repositories')
+# successful responses of the transformation service by (r2rml_url,
+# content type, sha256 of the data)
+transforms = SpillCache('transforms')
+
+
+def configure():
+    """Configure the caches using the service's options"""
+    delegate_tokens.max_size = options.delegate_token_cache_size
+    repositories.max_size = options.repository_cache_size
+    transforms.max_size = options.transform_cache_size
+    transforms.ttl = options.transform_cache_ttl
+    transforms.directory = options.transform_cache_dir or None
+    transforms.max_files = options.transform_cache_files
+    writes.window = options.store_coalesce_window
+    writes.max_bytes = options.store_coalesce_max_bytes
 
 
 def raise_client_http_error(error):
@@ -48,15 +74,67 @@ def raise_from_remote(func):
     return wrapper
 
 
+@metrics.timed('transform_token')
+@tracing.traced
+@coroutine
+def _transformation_token():
+    """Request a token for writing to the transformation service"""
+    token = yield resilience.call('auth', functools.partial(
+        oauth2.get_token,
+        options.url_auth,
+        options.service_id,
+        options.client_secret,
+        scope=oauth2.Write(options.url_transformation),
+        cache=False,
+        ssl_options=ssl_options()
+    ))
+    raise Return(token)
+
+
+transformation_token = TokenManager(_transformation_token)
+
+
+@metrics.timed('transform')
+@tracing.traced
 @coroutine
 def transform(data, content_type, r2rml_url):
     """
     Transforms source data into RDF triples
+
+    Successful responses are cached, so that transforming the same data
+    again, e.g. to delete assets that were just onboarded, doesn't call the
+    transformation service. The cached triples include the entity ids and
+    timestamps generated by the transformation service, so onboarding the
+    same data again within transform_cache_ttl stores the same triples and
+    returns the same hub keys, rather than generating new ones.
+
     :param data: the source data
     :param content_type: the http request content type
     :param r2rml_url: karma mapping file url
     :return: Transformed data and errors
     """
+    encoded = data.encode('utf-8') if isinstance(data, unicode) else data
+    key = (r2rml_url, content_type, hashlib.sha256(encoded or '').hexdigest())
+    response, http_status, errors = yield transforms.get_or_fetch(
+        key, functools.partial(_transform, data, content_type, r2rml_url))
+
+    if http_status == 200:
+        # the response is shared, callers may add to the data (e.g. the
+        # id_map)
+        response = dict(response, data=dict(response['data']))
+
+    raise Return((response, http_status, errors))
+
+
+@tracing.traced
+@coroutine
+def _transform(data, content_type, r2rml_url):
+    """
+    Call the transformation service
+
+    :returns: the transformed data, http status and errors, and the number
+        of seconds they can be cached for
+    """
     logging.debug('>>> transform')
 
     response = None
@@ -64,34 +142,25 @@ def transform(data, content_type, r2rml_url):
     errors = []
 
     try:
-        token = yield oauth2.get_token(
-            options.url_auth,
-            options.service_id,
-            options.client_secret,
-            scope=oauth2.Write(options.url_transformation),
-            ssl_options=ssl_server_options()
-        )
+        token = yield transformation_token.get()
     except httpclient.HTTPError as exc:
         logging.exception('Error getting token for the transformation service')
         raise exceptions.HTTPError(500, 'Internal Server Error')
 
     headers = {'Accept': 'application/json', 'Content-Type': content_type}
 
-    client = API(options.url_transformation,
-                 token=token,
-                 ssl_options=ssl_server_options())
+    client = API(options.url_transformation, token=token)
 
     if r2rml_url:
         params = urlencode({'r2rml_url': r2rml_url})
         client.transformation.assets.path += '?{}'.format(params)
 
     try:
-        client.transformation.assets.prepare_request(
-            request_timeout=180,
-            headers=headers,
-            body=data
-        )
-        response = yield client.transformation.assets.post()
+        response = yield resilience.call(
+            'transformation', functools.partial(
+                scheduler.scheduled(scheduler.transforms, compression.send),
+                client.transformation.assets, 'post',
+                options.url_transformation, data, headers))
     except httpclient.HTTPError as exc:
         response = exc.response
         logging.exception(
@@ -100,50 +169,142 @@ def transform(data, content_type, r2rml_url):
         errors = json.loads(exc.response.body)['errors']
 
     logging.debug('<<< transform')
-    raise Return((response, http_status, errors))
+    # only successful responses are cached, for the cache's ttl
+    ttl = None if http_status == 200 and not errors else 0
+    raise Return(((response, http_status, errors), ttl))
 
 
-@raise_from_remote
+@metrics.timed('get_repository')
+@tracing.traced
 @coroutine
 def get_repository(repository_id):
     """
     Get the repository service address from accounts service
     for storing data.
 
+    Repositories are cached for repository_cache_ttl seconds, and unknown
+    repositories for repository_not_found_ttl seconds.
+
     :param repository_id: the repository ID
     :return: url of the repository url
     :raise: HTTPError
     """
-    client = API(options.url_accounts, ssl_options=ssl_server_options())
+    repository = yield repositories.get_or_fetch(
+        repository_id,
+        functools.partial(_get_repository, repository_id))
+
+    if isinstance(repository, NotFound):
+        raise exceptions.HTTPError(404, repository.errors)
+
+    raise Return(repository)
+
+
+class NotFound(object):
+    """Cached in place of a repository that does not exist"""
+
+    def __init__(self, errors):
+        self.errors = errors
+
+
+@tracing.traced
+@raise_from_remote
+@coroutine
+def _get_repository(repository_id):
+    """
+    Get the repository from the accounts service
+
+    :param repository_id: the repository ID
+    :returns: the repository, or a NotFound instance, and the number of
+        seconds it can be cached for
+    :raise: HTTPError
+    """
+    endpoint = API(options.url_accounts).accounts.repositories[repository_id]
+
+    def fetch(**kwargs):
+        endpoint.prepare_request(**kwargs)
+        return endpoint.get()
+
+    try:
+        response = yield resilience.call('accounts', fetch)
+    except httpclient.HTTPError as exc:
+        if exc.code != 404:
+            raise
+        raise Return((NotFound(json.loads(exc.response.body)),
+                      options.repository_not_found_ttl))
+
     try:
-        response = yield client.accounts.repositories[repository_id].get()
         logging.debug(response['data'])
-        raise Return(response['data'])
+        raise Return((response['data'], options.repository_cache_ttl))
     except KeyError:
         error = 'Cannot find a repository'
-        raise exceptions.HTTPError(404, error)
+        raise Return((NotFound(error), options.repository_not_found_ttl))
+
 
+def invalidate_repository(repository_id, repository_url):
+    """
+    Remove a repository from the cache if its location is repository_url,
+    e.g. because the repository service could not be reached.
+
+    :param repository_id: the repository ID
+    :param repository_url: url of the repository service
+    """
+    repository = repositories.get(repository_id)
+    try:
+        location = repository['service']['location']
+    except (KeyError, TypeError):
+        return
 
+    if location == repository_url:
+        logging.info('Removing repository %s from the cache', repository_id)
+        repositories.invalidate(repository_id)
+
+
+@metrics.timed('token_exchange')
+@tracing.traced
 @coroutine
 def exchange_delegate_token(token, repository_id):
     """
     Exchange a token for a delegated token
 
+    Delegated tokens are cached until shortly before either the delegated
+    token or the client's token expires.
+
     :param token: a JWT granting the onboarding service access to write on the
         client's behalf
     :param repository_id: the target repsitory's ID
     :returns: a new JWT authorized to write to the repository
     :raises: HTTPError
     """
+    new_token = yield delegate_tokens.get_or_fetch(
+        (token, repository_id),
+        functools.partial(_exchange_delegate_token, token, repository_id))
+
+    raise Return(new_token)
+
+
+@tracing.traced
+@coroutine
+def _exchange_delegate_token(token, repository_id):
+    """
+    Request a delegated token from the auth service
+
+    :param token: a JWT granting the onboarding service access to write on the
+        client's behalf
+    :param repository_id: the target repsitory's ID
+    :returns: the new JWT and the number of seconds it can be cached for
+    :raises: HTTPError
+    """
     try:
-        new_token = yield oauth2.get_token(
+        new_token = yield resilience.call('auth', functools.partial(
+            oauth2.get_token,
             options.url_auth,
             options.service_id,
             options.client_secret,
             scope=oauth2.Write(repository_id),
             jwt=token,
-            ssl_options=ssl_server_options()
-        )
+            cache=False,
+            ssl_options=ssl_options()
+        ))
     except httpclient.HTTPError as exc:
         if exc.code in (403, 400):
             try:
@@ -158,13 +319,61 @@ def exchange_delegate_token(token, repository_id):
             logging.exception(msg)
             raise exceptions.HTTPError(500, msg)
 
-    raise Return(new_token)
+    raise Return((new_token, token_ttl(token, new_token)))
 
 
-@coroutine
+def _store_writes(key, writes):
+    """
+    Store the N3 of coalesced writes in one request
+
+    :param key: the repository url, repository ID and token scope
+    :param writes: list of the N3 and token of each write
+    :returns: a Future resolving to the http status and errors
+    """
+    repository_url, repository_id, _ = key
+    rdf_n3 = coalesce.merge_n3([n3 for n3, _ in writes])
+    # the tokens have the same scope, any one of them can be used
+    token = writes[0][1]
+    return _store({'data': {'rdf_n3': rdf_n3}}, repository_url,
+                  repository_id, token=token)
+
+
+# stores to the same repository with tokens of the same scope, combined
+# into one request when store_coalesce_window is set
+writes = coalesce.Coalescer(_store_writes)
+
+
+@tracing.traced
 def store(response_trans, repository_url, repository_id, token=None):
     """
     Send the rdf N3 content to the repository service
+
+    If write coalescing is enabled the content is sent together with that
+    of other stores to the same repository made within the
+    store_coalesce_window, and the result of the combined request is
+    returned.
+
+    :param response_trans: transformed data from the transformation service
+    :param repository_url: url of the repository service
+    :param repository_id: the repository ID
+    :param token: an authorization token
+    :return: a Future resolving to the http status and errors
+    """
+    if not writes.enabled:
+        return _store(response_trans, repository_url, repository_id,
+                      token=token)
+
+    rdf_n3 = response_trans['data']['rdf_n3']
+    key = (repository_url, repository_id, token_scope(token))
+    return writes.add(key, (rdf_n3, token), len(rdf_n3))
+
+
+@metrics.timed('store')
+@tracing.traced
+@coroutine
+def _store(response_trans, repository_url, repository_id, token=None):
+    """
+    Send the rdf N3 content to the repository service
     :param response_trans: transformed data from the transformation service
     :param repository_url: url of the repository service
     :param repository_id: the repository ID
@@ -179,14 +388,18 @@ def store(response_trans, repository_url, repository_id, token=None):
         'Accept': 'application/json'
     }
 
-    client = API(repository_url, ssl_options=ssl_server_options(), token=token)
+    client = API(repository_url, token=token)
     endpoint = client.repository.repositories[repository_id].assets
 
     try:
         rdf_n3 = response_trans['data']['rdf_n3']
-        endpoint.prepare_request(
-            request_timeout=180, headers=headers, body=rdf_n3)
-        yield endpoint.post()
+        yield resilience.call('repository', functools.partial(
+            scheduler.scheduled(scheduler.stores, compression.send),
+            endpoint, 'post', repository_url, rdf_n3, headers),
+            circuit=repository_url, idempotent=False)
+    except resilience.CircuitOpen as exc:
+        http_status = 503
+        errors = [{"message": str(exc)}]
     except httpclient.HTTPError as exc:
         logging.debug('Repository service error code:{}'.format(exc.code))
         logging.debug('Repository service error body:{}'.format(exc.response))
@@ -197,15 +410,21 @@ def store(response_trans, repository_url, repository_id, token=None):
             http_status = 500
             errors = [
                 {"message": "Repository service error {}".format(exc.code)}]
+        # 599 is used for connection failures
+        if exc.code == 599:
+            invalidate_repository(repository_id, repository_url)
     # socket error can occur if repository_url doesn't resolve to anything
     # by the dns server
     except socket.error as exc:
         http_status = 500
         message = "Socket error {} from {}".format(exc.args, repository_url)
         errors = [{"message": message}]
+        invalidate_repository(repository_id, repository_url)
     logging.debug('<<< transform')
     raise Return((http_status, errors))
 
+@metrics.timed('delete')
+@tracing.traced
 @coroutine
 def delete(response_trans, repository_url, repository_id, token=None):
     """
@@ -224,14 +443,19 @@ def delete(response_trans, repository_url, repository_id, token=None):
         'Accept': 'application/json'
     }
 
-    client = API(repository_url, ssl_options=ssl_server_options(), token=token)
+    client = API(repository_url, token=token)
     endpoint = client.repository.repositories[repository_id].assets
 
     try:
         rdf_n3 = response_trans['data']['rdf_n3']
-        endpoint.prepare_request(
-            request_timeout=180, headers=headers, body=rdf_n3, allow_nonstandard_methods=True)
-        yield endpoint.delete()
+        yield resilience.call('repository', functools.partial(
+            scheduler.scheduled(scheduler.stores, compression.send),
+            endpoint, 'delete', repository_url, rdf_n3, headers,
+            allow_nonstandard_methods=True), circuit=repository_url,
+            idempotent=False)
+    except resilience.CircuitOpen as exc:
+        http_status = 503
+        errors = [{"message": str(exc)}]
     except httpclient.HTTPError as exc:
         logging.debug('Repository service error code:{}'.format(exc.code))
         logging.debug('Repository service error body:{}'.format(exc.response))
@@ -242,11 +466,15 @@ def delete(response_trans, repository_url, repository_id, token=None):
             http_status = 500
             errors = [
                 {"message": "Repository service error {}".format(exc.code)}]
+        # 599 is used for connection failures
+        if exc.code == 599:
+            invalidate_repository(repository_id, repository_url)
     # socket error can occur if repository_url doesn't resolve to anything
     # by the dns server
     except socket.error as exc:
         http_status = 500
         message = "Socket error {} from {}".format(exc.args, repository_url)
         errors = [{"message": message}]
+        invalidate_repository(repository_id, repository_url)
     logging.debug('<<< transform')
     raise Return((http_status, errors))
@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Policies for calls to other services, and load shedding.
+
+Each call to another service (see call) has the connect and request
+timeouts of the service, and is retried with a random, exponentially
+growing delay if it fails with a connection error, a timeout, or a 502,
+503 or 504 response. Storing and deleting triples are not idempotent (the
+triples can have blank nodes, so storing them again adds duplicates), so
+those calls are only retried if the request can't have been handled: a
+connection failure, or a 502 or 503 response.
+
+Calls to a repository service go through a circuit breaker for its url.
+After a number of consecutive failures the circuit opens and calls fail
+immediately with CircuitOpen until the reset timeout has passed. Then a
+single call is let through, closing the circuit if it succeeds.
+
+Until configure is called there are no retries, circuit breakers or
+limit on the number of requests in flight.
+"""
+import logging
+import random
+import socket
+import time
+
+from tornado import httpclient
+from tornado.gen import coroutine, sleep, Return
+from tornado.options import options
+from koi import exceptions
+
+from onboarding.models import metrics
+
+UPSTREAMS = ('accounts', 'auth', 'transformation', 'repository')
+
+# status codes of failures that are retried, 599 is used for connection
+# errors and timeouts
+RETRY_CODES = (502, 503, 504, 599)
+# status codes of failures of calls that aren't idempotent that are retried
+UNHANDLED_CODES = (502, 503)
+# errors of the curl client when the request wasn't sent: couldn't resolve
+# the proxy or host, or couldn't connect
+CURL_CONNECT_ERRORS = (5, 6, 7)
+
+UPSTREAM_RETRIES = metrics.Counter(
+    'onboarding_upstream_retries_total',
+    'Calls to other services that were retried',
+    labels=('upstream',))
+CIRCUIT_REJECTIONS = metrics.Counter(
+    'onboarding_circuit_rejections_total',
+    'Calls to repository services that failed because the circuit was open',
+    labels=('url',))
+REQUESTS_SHED = metrics.Counter(
+    'onboarding_requests_shed_total',
+    'Requests rejected with 503 because too many requests were in flight')
+
+
+class Policy(object):
+    """The timeouts and retries of calls to a service"""
+
+    def __init__(self, connect_timeout=20.0, request_timeout=180.0,
+                 retries=0, backoff=0.1, max_backoff=2.0):
+        """
+        :param connect_timeout: seconds to wait for a connection
+        :param request_timeout: seconds to wait for the whole request
+        :param retries: maximum number of retries of a failed call
+        :param backoff: maximum delay before the first retry, doubled for
+            each retry after that
+        :param max_backoff: maximum delay before a retry
+        """
+        self.connect_timeout = connect_timeout
+        self.request_timeout = request_timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+
+    def request_kwargs(self):
+        """The HTTPRequest arguments of the timeouts"""
+        return {'connect_timeout': self.connect_timeout,
+                'request_timeout': self.request_timeout}
+
+    def delay(self, retry):
+        """A random delay before a retry ("full jitter")"""
+        return random.uniform(0, min(self.max_backoff,
+                                     self.backoff * 2 ** retry))
+
+
+class CircuitOpen(httpclient.HTTPError):
+    """A call was not made because the service's circuit is open"""
+
+    def __init__(self, url, retry_after):
+        super(CircuitOpen, self).__init__(
+            503, 'Service at {} is unavailable'.format(url))
+        self.url = url
+        self.retry_after = retry_after
+
+    def __str__(self):
+        return self.message
+
+
+class CircuitBreaker(object):
+    """Stops calls to a service after consecutive failures"""
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half-open'
+
+    def __init__(self, failures=5, reset_timeout=30):
+        """
+        :param failures: number of consecutive failures that open the
+            circuit
+        :param reset_timeout: seconds until a call is let through to test
+            whether the service has recovered
+        """
+        self.max_failures = failures
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    @staticmethod
+    def _now():
+        return time.time()
+
+    def allow(self):
+        """Whether a call can be made"""
+        if self.state == self.CLOSED:
+            return True
+        if self.state == self.OPEN and self.retry_after() <= 0:
+            # let one call through to test the service
+            self.state = self.HALF_OPEN
+            return True
+        return False
+
+    def retry_after(self):
+        """Seconds until the circuit is tested again"""
+        if self.opened_at is None:
+            return 0
+        return max(self.opened_at + self.reset_timeout - self._now(), 0)
+
+    def succeeded(self):
+        """Record a successful call, closing the circuit"""
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = None
+
+    def failed(self):
+        """Record a failed call, opening the circuit if there are too many"""
+        self.failures += 1
+        if self.state == self.HALF_OPEN or self.failures >= self.max_failures:
+            if self.state != self.OPEN:
+                logging.warning('Opening circuit after %d failures',
+                                self.failures)
+            self.state = self.OPEN
+            self.opened_at = self._now()
+
+    def stats(self):
+        return {'state': self.state, 'failures': self.failures,
+                'retry_after': self.retry_after()}
+
+
+class InFlight(object):
+    """Counts the requests being processed, up to a limit"""
+
+    def __init__(self, limit=0):
+        """
+        :param limit: maximum number of requests, 0 for no limit
+        """
+        self.limit = limit
+        self.count = 0
+
+    def acquire(self):
+        """
+        Start a request
+
+        :returns: False if there are already limit requests in flight
+        """
+        if self.limit and self.count >= self.limit:
+            REQUESTS_SHED.inc()
+            return False
+        self.count += 1
+        return True
+
+    def release(self):
+        """Finish a request"""
+        self.count -= 1
+
+
+class Unavailable(exceptions.HTTPError):
+    """A 503 error, with the number of seconds after which to retry"""
+
+    def __init__(self, errors, retry_after, **kwargs):
+        super(Unavailable, self).__init__(503, errors, **kwargs)
+        self.retry_after = retry_after
+
+
+# policies by upstream service
+policies = {name: Policy() for name in UPSTREAMS}
+# circuit breakers by url, and the settings of new breakers. 0 failures
+# disables the circuit breakers.
+breakers = {}
+circuit_failures = 0
+circuit_reset_timeout = 30
+# requests in flight in this process
+requests = InFlight()
+# seconds clients are asked to wait when a request is shed
+retry_after = 5
+
+
+def configure():
+    """Configure the policies and limits from the service's options"""
+    global circuit_failures, circuit_reset_timeout, retry_after
+    for name in UPSTREAMS:
+        policies[name] = Policy(
+            getattr(options, '{}_connect_timeout'.format(name)),
+            getattr(options, '{}_request_timeout'.format(name)),
+            options.upstream_retries,
+            options.upstream_retry_backoff,
+            options.upstream_retry_max_backoff)
+
+    breakers.clear()
+    circuit_failures = options.circuit_failures
+    circuit_reset_timeout = options.circuit_reset_timeout
+    requests.limit = options.max_in_flight_requests
+    retry_after = options.retry_after
+
+
+def get_breaker(url):
+    """The circuit breaker for a url, None if they are disabled"""
+    if not circuit_failures:
+        return None
+
+    breaker = breakers.get(url)
+    if breaker is None:
+        breaker = breakers[url] = CircuitBreaker(circuit_failures,
+                                                 circuit_reset_timeout)
+    return breaker
+
+
+def is_failure(exc):
+    """Whether an error means the service is unavailable"""
+    if isinstance(exc, socket.error):
+        return True
+    return getattr(exc, 'code', None) in RETRY_CODES
+
+
+def is_unhandled(exc):
+    """
+    Whether an error means the service didn't handle the request, unlike
+    e.g. a timeout after the request was sent
+    """
+    if isinstance(exc, socket.error):
+        # the simple client's connection errors
+        return True
+    return (getattr(exc, 'code', None) in UNHANDLED_CODES or
+            getattr(exc, 'errno', None) in CURL_CONNECT_ERRORS)
+
+
+@coroutine
+def call(upstream, func, circuit=None, idempotent=True):
+    """
+    Call a service with its policy
+
+    :param upstream: the service's name, one of UPSTREAMS
+    :param func: function making the call, called with the policy's
+        request_kwargs for each attempt and returning a Future
+    :param circuit: (optional) the url of the circuit breaker to use
+    :param idempotent: (optional) False to only retry the call if the
+        request wasn't handled (see is_unhandled)
+    :returns: the result of the call
+    :raises: CircuitOpen, or the error of the last attempt
+    """
+    policy = policies[upstream]
+    breaker = get_breaker(circuit) if circuit else None
+    retry = 0
+    while True:
+        if breaker is not None and not breaker.allow():
+            CIRCUIT_REJECTIONS.inc(url=circuit)
+            raise CircuitOpen(circuit, breaker.retry_after())
+
+        try:
+            result = yield func(**policy.request_kwargs())
+        except (httpclient.HTTPError, socket.error) as exc:
+            failure = is_failure(exc)
+            if breaker is not None:
+                # other errors, e.g. 400, show the service is available
+                if failure:
+                    breaker.failed()
+                else:
+                    breaker.succeeded()
+            retryable = failure and (idempotent or is_unhandled(exc))
+            if not retryable or retry >= policy.retries:
+                raise
+        else:
+            if breaker is not None:
+                breaker.succeeded()
+            raise Return(result)
+
+        delay = policy.delay(retry)
+        logging.info('Retrying call to the %s service in %.2f seconds: %s',
+                     upstream, delay, exc)
+        UPSTREAM_RETRIES.inc(upstream=upstream)
+        yield sleep(delay)
+        retry += 1
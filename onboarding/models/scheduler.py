@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Fair scheduling of calls to the transformation and repository services.
+
+Each process has a budget of concurrent transforms and of concurrent
+stores (see FairScheduler). Work waiting for the budget is queued by the
+share it belongs to, normally the repository (or the caller) and the
+request's priority, and the queues take turns in proportion to their
+priority's weight (start-time fair queueing), so that a tenant onboarding
+a large catalogue doesn't hold up small requests from other tenants.
+
+The share of a request is made current with activate, in the same way as
+the request's span (see tracing), so that work started while handling the
+request is queued by its share.
+"""
+import functools
+import threading
+import time
+from collections import deque
+
+from tornado.concurrent import Future
+from tornado.gen import coroutine, Return
+from tornado.options import options
+from tornado.stack_context import StackContext
+
+from onboarding.models import metrics
+
+# weight of each priority, a queue of priority "high" gets four times as
+# many turns as a queue of priority "low"
+PRIORITIES = {'high': 4, 'normal': 2, 'low': 1}
+DEFAULT_PRIORITY = 'normal'
+# request header giving the priority
+HEADER = 'X-Priority'
+
+QUEUE_DEPTH = metrics.Gauge(
+    'onboarding_scheduler_queue_depth',
+    'Calls waiting for the budget of a stage, by queue',
+    labels=('stage', 'queue', 'priority'))
+QUEUE_WAIT_SECONDS = metrics.Histogram(
+    'onboarding_scheduler_wait_seconds',
+    'Time calls waited for the budget of a stage, by priority, in seconds',
+    labels=('stage', 'priority'))
+
+_state = threading.local()
+
+
+class Share(object):
+    """The queue and priority work is scheduled with"""
+
+    def __init__(self, queue=None, priority=DEFAULT_PRIORITY):
+        """
+        :param queue: name of the queue, e.g. a repository ID
+        :param priority: one of PRIORITIES
+        """
+        self.queue = queue
+        self.priority = priority
+
+    @property
+    def key(self):
+        return self.queue, self.priority
+
+    @property
+    def weight(self):
+        return PRIORITIES[self.priority]
+
+
+DEFAULT_SHARE = Share()
+
+
+class _Queue(object):
+    """The calls of a share waiting for a stage's budget"""
+
+    def __init__(self, share, tag):
+        self.share = share
+        self.waiters = deque()
+        # number of calls of the share holding part of the budget
+        self.active = 0
+        # virtual start time of the next call
+        self.tag = tag
+
+
+class _Slot(object):
+    """Part of a stage's budget, released when the with block exits"""
+
+    def __init__(self, scheduler, queue):
+        self._scheduler = scheduler
+        self._queue = queue
+
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+    def release(self):
+        if self._queue is not None:
+            self._scheduler._release(self._queue)
+            self._queue = None
+
+
+class FairScheduler(object):
+    """
+    Limits the concurrent calls of a stage, granting waiting calls fairly
+    between queues
+
+    Usage::
+
+        with (yield scheduler.acquire()):
+            ...
+    """
+
+    def __init__(self, stage, limit=0):
+        """
+        :param stage: name of the stage, e.g. "store"
+        :param limit: maximum number of concurrent calls, 0 for no limit
+        """
+        self.stage = stage
+        self.limit = limit
+        self.active = 0
+        self._queues = {}
+        self._virtual_time = 0.0
+
+    def acquire(self, share=None):
+        """
+        Wait for part of the budget
+
+        :param share: (optional) the share to queue the call in, defaults
+            to the current share
+        :returns: a Future resolving to a context manager releasing the
+            budget
+        """
+        if share is None:
+            share = current()
+
+        queue = self._queues.get(share.key)
+        if queue is None:
+            queue = self._queues[share.key] = _Queue(share,
+                                                     self._virtual_time)
+        elif not queue.waiters:
+            # idle queues don't save up turns
+            queue.tag = max(queue.tag, self._virtual_time)
+
+        future = Future()
+        queue.waiters.append((future, time.time()))
+        self._grant()
+        self._record_depth(queue)
+        return future
+
+    def _grant(self):
+        """Grant the budget to waiting calls, the lowest tag first"""
+        while not self.limit or self.active < self.limit:
+            waiting = [queue for queue in self._queues.values()
+                       if queue.waiters]
+            if not waiting:
+                return
+
+            queue = min(waiting, key=lambda q: q.tag)
+            future, queued_at = queue.waiters.popleft()
+            self._virtual_time = queue.tag
+            queue.tag += 1.0 / queue.share.weight
+            queue.active += 1
+            self.active += 1
+
+            self._record_depth(queue)
+            QUEUE_WAIT_SECONDS.observe(
+                time.time() - queued_at, stage=self.stage,
+                priority=queue.share.priority)
+            future.set_result(_Slot(self, queue))
+
+    def _release(self, queue):
+        queue.active -= 1
+        self.active -= 1
+        if not queue.active and not queue.waiters:
+            del self._queues[queue.share.key]
+        self._grant()
+
+    def _record_depth(self, queue):
+        labels = {'stage': self.stage, 'queue': queue.share.queue,
+                  'priority': queue.share.priority}
+        if queue.waiters:
+            QUEUE_DEPTH.set(len(queue.waiters), **labels)
+        else:
+            QUEUE_DEPTH.remove(**labels)
+
+    def waiting(self):
+        """The number of calls waiting for the budget"""
+        return sum(len(queue.waiters) for queue in self._queues.values())
+
+
+def scheduled(fair, func):
+    """
+    Wrap a function returning a Future so that every call waits for part of
+    a budget, and holds it until the Future resolves. Used for each attempt
+    of a retried call (see resilience.call), so that the budget isn't held
+    while backing off.
+
+    :param fair: the FairScheduler
+    :param func: the function
+    """
+    @coroutine
+    def wrapper(*args, **kwargs):
+        with (yield fair.acquire()):
+            result = yield func(*args, **kwargs)
+        raise Return(result)
+    return wrapper
+
+
+# budgets of the calls to the transformation and repository services
+transforms = FairScheduler('transform')
+stores = FairScheduler('store')
+# what requests are queued by, "repository" or "caller"
+share_by = 'repository'
+
+
+def configure():
+    """Configure the budgets from the service's options"""
+    global share_by
+    transforms.limit = options.max_scheduled_transforms
+    stores.limit = options.max_scheduled_stores
+    share_by = options.schedule_share_by
+
+
+class _Active(object):
+    """Makes a share the current share"""
+
+    def __init__(self, share):
+        self.share = share
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = getattr(_state, 'share', None)
+        _state.share = self.share
+
+    def __exit__(self, *exc_info):
+        _state.share = self.previous
+
+
+def activate(share):
+    """
+    A context manager making share the current share of everything started
+    within it, including callbacks and coroutines that resume later
+    """
+    return StackContext(functools.partial(_Active, share))
+
+
+def current():
+    """The current share, or DEFAULT_SHARE outside of a request"""
+    return getattr(_state, 'share', None) or DEFAULT_SHARE
@@ -0,0 +1,206 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""Helpers for OAuth tokens used to call other services"""
+import base64
+import json
+import logging
+import time
+
+from tornado.gen import coroutine, Return
+from tornado.ioloop import IOLoop
+from tornado.stack_context import NullContext
+
+# Don't re-use a token with less than this many seconds remaining
+MIN_TOKEN_LIFETIME = 60
+# Refresh a token in the background this many seconds before it expires
+REFRESH_MARGIN = 2 * MIN_TOKEN_LIFETIME
+# Seconds to wait before retrying a failed background refresh
+RETRY_DELAY = 10
+
+
+def _claims(token):
+    """The claims of a JWT, without verifying it"""
+    payload = token.split('.')[1]
+    payload += '=' * (-len(payload) % 4)
+    return json.loads(base64.urlsafe_b64decode(str(payload)))
+
+
+def token_expiry(token):
+    """
+    Read the expiry time from a JWT without verifying it.
+
+    The token has already been verified by the auth service, the expiry is
+    only used to decide how long it can be cached.
+
+    :param token: a JWT
+    :returns: the expiry as a unix timestamp or None if it can't be read
+    """
+    try:
+        return float(_claims(token)['exp'])
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        logging.debug('Could not read the expiry of token')
+        return None
+
+
+def token_claim(token, name):
+    """
+    Read a claim from a JWT without verifying it.
+
+    :param token: a JWT
+    :param name: the claim's name
+    :returns: the claim's value, or None if it can't be read
+    """
+    try:
+        return _claims(token)[name]
+    except (AttributeError, IndexError, KeyError, TypeError, ValueError):
+        return None
+
+
+def token_scope(token):
+    """
+    Read the scope from a JWT without verifying it.
+
+    :param token: a JWT
+    :returns: the scope, or the token itself if the scope can't be read, so
+        that tokens without a readable scope are never treated as equivalent
+    """
+    scope = token_claim(token, 'scope')
+    return token if scope is None else scope
+
+
+def token_subject(token):
+    """
+    Read the subject, i.e. the client, from a JWT without verifying it.
+
+    :param token: a JWT
+    :returns: the subject, or None if it can't be read
+    """
+    return token_claim(token, 'sub')
+
+
+def token_ttl(*tokens):
+    """
+    The number of seconds the tokens can be used for, taking into account
+    that a token should not be re-used close to it's expiry
+
+    :param tokens: one or more JWTs
+    :returns: the lifetime of the token that expires first, 0 if any of
+        the expiry times can't be read
+    """
+    expiries = [token_expiry(token) for token in tokens]
+    if not expiries or None in expiries:
+        return 0
+
+    return min(expiries) - time.time() - MIN_TOKEN_LIFETIME
+
+
+class TokenManager(object):
+    """
+    Keeps a token for calling another service, refreshing it in the
+    background shortly before it expires.
+
+    Concurrent requests for a token while it is being refreshed share the
+    same request to the auth service.
+    """
+
+    def __init__(self, fetch, refresh_margin=REFRESH_MARGIN):
+        """
+        :param fetch: a function returning a Future that resolves to a new
+            token
+        :param refresh_margin: seconds before the token expires to refresh
+            it in the background
+        """
+        self._fetch = fetch
+        self.refresh_margin = refresh_margin
+        self._token = None
+        self._expiry = None
+        self._refreshing = None
+        self._timeout = None
+
+    def _valid(self):
+        return (self._token is not None and self._expiry is not None and
+                self._expiry - MIN_TOKEN_LIFETIME > time.time())
+
+    @coroutine
+    def get(self):
+        """
+        Get a valid token, requesting a new one if required
+
+        :returns: a token
+        """
+        if self._valid():
+            raise Return(self._token)
+
+        token = yield self.refresh()
+        raise Return(token)
+
+    def refresh(self):
+        """
+        Request a new token, or join the request already in progress
+
+        :returns: a Future that resolves to the new token
+        """
+        if self._refreshing is not None:
+            return self._refreshing
+
+        future = self._refresh()
+        if not future.done():
+            self._refreshing = future
+
+        return future
+
+    def reset(self):
+        """Forget the current token and cancel the background refresh"""
+        self._token = None
+        self._expiry = None
+        self._cancel_refresh()
+
+    @coroutine
+    def _refresh(self):
+        try:
+            token = yield self._fetch()
+        finally:
+            self._refreshing = None
+
+        self._token = token
+        self._expiry = token_expiry(token)
+        self._schedule_refresh()
+        raise Return(token)
+
+    def _cancel_refresh(self):
+        if self._timeout is not None:
+            IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+
+    def _schedule_refresh(self, deadline=None):
+        self._cancel_refresh()
+        if deadline is None:
+            if self._expiry is None:
+                return
+            deadline = self._expiry - self.refresh_margin
+
+        # tokens that are too short lived are refreshed when they are used
+        if deadline <= time.time():
+            return
+
+        # the refresh isn't part of the request that happened to fetch the
+        # token, e.g. its trace span
+        with NullContext():
+            self._timeout = IOLoop.current().call_at(
+                deadline, self._background_refresh)
+
+    def _background_refresh(self):
+        self._timeout = None
+        IOLoop.current().add_future(self.refresh(), self._refreshed)
+
+    def _refreshed(self, future):
+        if future.exception() is not None:
+            logging.warning('Failed to refresh token: %r', future.exception())
+            self._schedule_refresh(time.time() + RETRY_DELAY)
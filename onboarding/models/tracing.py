@@ -0,0 +1,285 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Trace requests through the service and the services it calls.
+
+Each request to onboard or delete assets gets a trace, continuing the
+caller's trace if the request has a W3C traceparent header. Calls to other
+services and other slow steps are recorded as spans of the trace, and the
+traceparent header is added to the requests made to other services so that
+their work can be joined to the trace.
+
+The current span follows the request through callbacks and coroutines in a
+tornado StackContext. Finished spans are exported to the sink chosen with the
+trace_sink option, see SINKS.
+"""
+import functools
+import json
+import logging
+import os
+import re
+import socket
+import threading
+import time
+
+from tornado.concurrent import Future
+from tornado.ioloop import IOLoop
+from tornado.options import options
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+from tornado.stack_context import StackContext
+from tornado.util import import_object
+
+HEADER = 'traceparent'
+RE_TRACEPARENT = re.compile(
+    r'^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$')
+
+_state = threading.local()
+
+# where finished spans are sent, None if they are discarded
+sink = None
+
+
+def _new_id(size):
+    return os.urandom(size).encode('hex')
+
+
+class Span(object):
+    """A timed step of a trace"""
+
+    def __init__(self, name, trace_id=None, parent_id=None, **attributes):
+        """
+        :param name: name of the step
+        :param trace_id: (optional) the trace's ID, a new trace is started
+            if not given
+        :param parent_id: (optional) the ID of the span this is part of
+        :param attributes: values describing the step
+        """
+        self.name = name
+        self.trace_id = trace_id or _new_id(16)
+        self.span_id = _new_id(8)
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start = time.time()
+
+    def child(self, name, **attributes):
+        """Start a span that is part of this span"""
+        return Span(name, self.trace_id, self.span_id, **attributes)
+
+    def traceparent(self):
+        """The value of the traceparent header for calls made in this span"""
+        return '00-{}-{}-01'.format(self.trace_id, self.span_id)
+
+    def finish(self, error=None, **attributes):
+        """
+        Record the end of the span and export it
+
+        :param error: (optional) the exception the step failed with
+        :param attributes: values to add to the span's attributes
+        """
+        if sink is None:
+            return
+
+        self.attributes.update(attributes)
+        record = {
+            'trace_id': self.trace_id,
+            'span_id': self.span_id,
+            'parent_id': self.parent_id,
+            'name': self.name,
+            'start': self.start,
+            'duration': time.time() - self.start,
+            'attributes': self.attributes
+        }
+        if error is not None:
+            record['error'] = repr(error)
+
+        try:
+            sink.export(record)
+        except Exception:
+            logging.exception('Unable to export span %s', self.name)
+
+
+def parse_traceparent(value):
+    """
+    Parse a traceparent header
+
+    :param value: the header's value
+    :returns: the trace ID and parent span ID, or None if the value is
+        missing or invalid
+    """
+    match = RE_TRACEPARENT.match((value or '').strip().lower())
+    if match is None:
+        return None
+
+    version, trace_id, parent_id, _ = match.groups()
+    if version == 'ff' or not int(trace_id, 16) or not int(parent_id, 16):
+        return None
+    return trace_id, parent_id
+
+
+def request_span(request, name):
+    """
+    Start the span of a request, continuing the caller's trace if the
+    request has a traceparent header
+
+    :param request: the HTTPServerRequest
+    :param name: name of the span
+    """
+    trace_id, parent_id = (parse_traceparent(request.headers.get(HEADER)) or
+                           (None, None))
+    return Span(name, trace_id, parent_id, method=request.method,
+                path=request.path)
+
+
+class _Active(object):
+    """Makes a span the current span"""
+
+    def __init__(self, span):
+        self.span = span
+        self.previous = None
+
+    def __enter__(self):
+        self.previous = current()
+        _state.span = self.span
+
+    def __exit__(self, *exc_info):
+        _state.span = self.previous
+
+
+def activate(span):
+    """
+    A context manager making span the current span of everything started
+    within it, including callbacks and coroutines that resume later
+    """
+    return StackContext(functools.partial(_Active, span))
+
+
+def current():
+    """The current span, or None if not in a trace"""
+    return getattr(_state, 'span', None)
+
+
+def traced(func):
+    """
+    Decorator recording a span for each call of a function returning a
+    Future, if it is called in a trace
+    """
+    name = '{}.{}'.format(func.__module__.rsplit('.', 1)[-1], func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        parent = current()
+        if parent is None:
+            return func(*args, **kwargs)
+
+        span = parent.child(name)
+        with activate(span):
+            future = func(*args, **kwargs)
+
+        def finish(result):
+            span.finish(result.exception())
+
+        if isinstance(future, Future):
+            future.add_done_callback(finish)
+        else:
+            # e.g. an executor's Future, whose callbacks are run in another
+            # thread
+            IOLoop.current().add_future(future, finish)
+        return future
+    return wrapper
+
+
+class TracingClientMixin(object):
+    """
+    Adds the traceparent header of the current span to the requests made
+    by an AsyncHTTPClient
+    """
+
+    def fetch_impl(self, request, callback):
+        span = current()
+        if span is not None:
+            request.headers[HEADER] = span.traceparent()
+        super(TracingClientMixin, self).fetch_impl(request, callback)
+
+
+_client_classes = {}
+
+
+def client_class(impl=None):
+    """
+    Get an AsyncHTTPClient implementation that propagates traces
+
+    :param impl: (optional) the AsyncHTTPClient implementation, or its
+        name, defaults to the simple client
+    :returns: a subclass of impl
+    """
+    if impl is None:
+        impl = SimpleAsyncHTTPClient
+    elif isinstance(impl, basestring):
+        impl = import_object(impl)
+
+    if impl not in _client_classes:
+        _client_classes[impl] = type('Tracing' + impl.__name__,
+                                     (TracingClientMixin, impl), {})
+    return _client_classes[impl]
+
+
+class LogSink(object):
+    """Writes each span as a line of JSON to a file, or the service's log"""
+
+    def __init__(self, path=None):
+        """
+        :param path: (optional) the file, the spans are logged with the
+            service's other messages if not given
+        """
+        self.logger = logging.getLogger('onboarding.tracing')
+        if path:
+            handler = logging.FileHandler(path)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            self.logger.addHandler(handler)
+            self.logger.setLevel(logging.INFO)
+            self.logger.propagate = False
+
+    def export(self, span):
+        self.logger.info(json.dumps(span))
+
+
+class UDPSink(object):
+    """Sends each span as a JSON datagram to a collector, e.g. on localhost"""
+
+    def __init__(self, address):
+        """
+        :param address: the collector's host:port
+        """
+        host, port = address.rsplit(':', 1)
+        self.address = (host, int(port))
+        self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def export(self, span):
+        try:
+            self.socket.sendto(json.dumps(span), self.address)
+        except socket.error as exc:
+            logging.debug('Unable to send span to %s: %s', self.address, exc)
+
+
+SINKS = {
+    'log': lambda: LogSink(options.trace_log_file or None),
+    'udp': lambda: UDPSink(options.trace_collector)
+}
+
+
+def configure():
+    """Create the sink chosen with the trace_sink option"""
+    global sink
+    if options.trace_sink and options.trace_sink not in SINKS:
+        raise ValueError('Unknown trace_sink "{}", must be one of {}'.format(
+            options.trace_sink, sorted(SINKS)))
+
+    sink = SINKS[options.trace_sink]() if options.trace_sink else None
@@ -0,0 +1,233 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Resumable uploads.
+
+The data of an upload is sent in numbered chunks, which are spooled to files
+in a directory shared by all of the service's processes rather than kept in
+memory. If sending a chunk fails only that chunk has to be sent again, to
+any process. Once all of the chunks have been received the upload is
+committed, and its records are onboarded (see upload_handler).
+"""
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+import uuid
+
+from tornado.options import options
+from koi import exceptions
+
+# upload ids are generated by create, don't let a requested id point
+# outside the directory
+RE_UPLOAD_ID = re.compile(r'^[0-9a-f]{32}$')
+
+UPLOAD_FILE = 'upload.json'
+COMMIT_FILE = 'commit.lock'
+
+
+def checksum(data):
+    """The SHA-256 checksum of a chunk, as a hex string"""
+    return hashlib.sha256(data).hexdigest()
+
+
+class UploadStore(object):
+    """
+    Keeps each upload in a directory, with a JSON file describing the
+    upload and a file for each chunk. Uploads that haven't received a chunk
+    for ttl seconds are removed.
+    """
+
+    def __init__(self, directory, ttl=86400, max_chunk_size=0, max_chunks=0):
+        """
+        :param directory: directory for the uploads, created if needed
+        :param ttl: seconds an upload is kept for after its last change
+        :param max_chunk_size: maximum size of a chunk in bytes, 0 for no
+            limit
+        :param max_chunks: maximum number of chunks of an upload, 0 for no
+            limit
+        """
+        self.directory = directory
+        self.ttl = ttl
+        self.max_chunk_size = max_chunk_size
+        self.max_chunks = max_chunks
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, upload_id, *names):
+        return os.path.join(self.directory, upload_id, *names)
+
+    def _chunk_path(self, upload_id, number):
+        return self._path(upload_id, '{}.chunk'.format(number))
+
+    def _expired(self, upload_id):
+        # adding a chunk to the directory updates its modification time
+        try:
+            modified = os.path.getmtime(self._path(upload_id))
+        except OSError:
+            return True
+        return modified + self.ttl <= time.time()
+
+    def create(self, repository_id, content_type, r2rml_url=None,
+               local_transform=None):
+        """
+        Start an upload
+
+        :param repository_id: the repository the data will be onboarded to
+        :param content_type: the content type of the data
+        :param r2rml_url: (optional) url of the mapping for the data
+        :param local_transform: (optional) whether to transform the data
+            with the local mapping
+        :returns: the upload
+        """
+        self._evict()
+
+        upload = {
+            'id': uuid.uuid4().hex,
+            'repository_id': repository_id,
+            'content_type': content_type,
+            'r2rml_url': r2rml_url,
+            'local_transform': local_transform,
+            'created': time.time()
+        }
+        os.makedirs(self._path(upload['id']))
+        with open(self._path(upload['id'], UPLOAD_FILE), 'w') as f:
+            json.dump(upload, f)
+
+        return upload
+
+    def get(self, upload_id):
+        """
+        :param upload_id: the upload's id
+        :returns: the upload, or None if it doesn't exist or has expired
+        """
+        if not RE_UPLOAD_ID.match(upload_id) or self._expired(upload_id):
+            return None
+        try:
+            with open(self._path(upload_id, UPLOAD_FILE)) as f:
+                return json.load(f)
+        except (IOError, ValueError):
+            return None
+
+    def chunks(self, upload_id):
+        """
+        :param upload_id: the upload's id
+        :returns: the sorted numbers of the chunks received
+        """
+        try:
+            names = os.listdir(self._path(upload_id))
+        except OSError:
+            return []
+        return sorted(int(name.split('.')[0]) for name in names
+                      if name.endswith('.chunk'))
+
+    def put_chunk(self, upload_id, number, data, sha256):
+        """
+        Save a chunk, replacing it if it was already received
+
+        :param upload_id: the upload's id
+        :param number: the chunk's number, from 1
+        :param data: the chunk's data
+        :param sha256: the SHA-256 checksum of the data sent by the client,
+            as a hex string
+        :raises: HTTPError 400 if the number or checksum are invalid, or
+            413 if the chunk is too large
+        """
+        if number < 1 or (self.max_chunks and number > self.max_chunks):
+            raise exceptions.HTTPError(
+                400, 'Chunk number must be between 1 and {}'.format(
+                    self.max_chunks or 'infinity'))
+        if self.max_chunk_size and len(data) > self.max_chunk_size:
+            raise exceptions.HTTPError(
+                413, 'Chunk is too large. Max allowed is:{}'.format(
+                    self.max_chunk_size))
+        if not sha256 or checksum(data) != sha256.strip().lower():
+            raise exceptions.HTTPError(
+                400, 'Checksum of chunk {} does not match'.format(number))
+
+        # write to a temporary file first so that a failed request never
+        # leaves a partial chunk
+        fd, path = tempfile.mkstemp(dir=self._path(upload_id), suffix='.tmp')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.rename(path, self._chunk_path(upload_id, number))
+
+    def missing(self, upload_id, count):
+        """
+        :param upload_id: the upload's id
+        :param count: the number of chunks of the upload
+        :returns: the numbers of the chunks up to count not yet received
+        """
+        received = set(self.chunks(upload_id))
+        return [number for number in range(1, count + 1)
+                if number not in received]
+
+    def read(self, upload_id, count):
+        """
+        Read the chunks of an upload one at a time
+
+        :param upload_id: the upload's id
+        :param count: the number of chunks of the upload
+        :returns: generator of the data of each chunk, in order
+        """
+        for number in range(1, count + 1):
+            with open(self._chunk_path(upload_id, number), 'rb') as f:
+                yield f.read()
+
+    def lock(self, upload_id):
+        """
+        Mark an upload as being committed
+
+        :param upload_id: the upload's id
+        :returns: False if it is already being committed
+        """
+        try:
+            os.close(os.open(self._path(upload_id, COMMIT_FILE),
+                             os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+        except OSError:
+            return False
+        return True
+
+    def unlock(self, upload_id):
+        """Allow a failed upload to be committed again"""
+        try:
+            os.remove(self._path(upload_id, COMMIT_FILE))
+        except OSError:
+            pass
+
+    def remove(self, upload_id):
+        """Remove an upload and its chunks"""
+        shutil.rmtree(self._path(upload_id), ignore_errors=True)
+
+    def _evict(self):
+        for upload_id in os.listdir(self.directory):
+            if self._expired(upload_id):
+                self.remove(upload_id)
+
+
+store = None
+
+
+def configure():
+    """Create the upload store from the service's options"""
+    global store
+    store = UploadStore(options.upload_dir, options.upload_ttl,
+                        options.max_upload_chunk_size,
+                        options.max_upload_chunks)
+
+
+def get_store():
+    """The upload store, created with the configured options"""
+    if store is None:
+        configure()
+    return store
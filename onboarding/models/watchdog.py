@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Detect callbacks that block the IOLoop.
+
+While the IOLoop runs callbacks it is sent SIGALRM after blocking_threshold
+seconds (see IOLoop.set_blocking_signal_threshold). The signal handler logs
+the stack of the blocking code, and then samples the stack again every
+blocking_threshold seconds, up to blocking_max_samples times, until the
+loop gets to run the callback scheduled when the block was detected.
+"""
+import logging
+import signal
+import time
+import traceback
+
+from tornado.ioloop import IOLoop
+from tornado.options import options
+
+from onboarding.models import metrics
+
+BLOCKED_SECONDS = metrics.Histogram(
+    'onboarding_loop_blocked_seconds',
+    'Time the IOLoop was blocked by callbacks running for longer than the '
+    'blocking threshold, in seconds')
+
+
+class Watchdog(object):
+    """Logs stack samples of the code blocking an IOLoop"""
+
+    def __init__(self, io_loop, threshold, max_samples=5):
+        """
+        :param io_loop: the IOLoop
+        :param threshold: seconds a callback may run before it is reported
+        :param max_samples: maximum number of stack samples of each block
+        """
+        self.io_loop = io_loop
+        self.threshold = threshold
+        self.max_samples = max_samples
+        self.blocked_since = None
+        self.samples = 0
+
+    def start(self):
+        """Start watching the IOLoop"""
+        self.io_loop.set_blocking_signal_threshold(self.threshold, self.sample)
+
+    def stop(self):
+        """Stop watching the IOLoop"""
+        self.io_loop.set_blocking_signal_threshold(None, None)
+
+    def sample(self, signum, frame):
+        """Signal handler logging the stack of the blocking code"""
+        now = time.time()
+        if self.blocked_since is None:
+            self.blocked_since = now - self.threshold
+            self.samples = 0
+            # runs as soon as the loop is no longer blocked
+            self.io_loop.add_callback_from_signal(self.unblocked)
+
+        self.samples += 1
+        logging.warning('IOLoop blocked for %.3f seconds (sample %d) in\n%s',
+                        now - self.blocked_since, self.samples,
+                        ''.join(traceback.format_stack(frame)))
+
+        if self.samples < self.max_samples:
+            signal.setitimer(signal.ITIMER_REAL, self.threshold, 0)
+
+    def unblocked(self):
+        """Record how long the loop was blocked"""
+        if self.blocked_since is None:
+            return
+
+        elapsed = time.time() - self.blocked_since
+        self.blocked_since = None
+        BLOCKED_SECONDS.observe(elapsed)
+        logging.warning('IOLoop was blocked for %.3f seconds', elapsed)
+
+
+_watchdog = None
+
+
+def start():
+    """
+    Start watching the current IOLoop if the blocking_threshold option is
+    set. Called in each of the service's processes.
+    """
+    global _watchdog
+    if options.blocking_threshold and _watchdog is None:
+        _watchdog = Watchdog(IOLoop.current(), options.blocking_threshold,
+                             options.blocking_max_samples)
+        _watchdog.start()
@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""Useful utils."""
+
+
+def ignore_result(*futures):
+    """
+    Mark futures whose results are no longer needed, so that an error
+    raised by one of them is not logged as unhandled
+
+    :param futures: Futures, None is ignored
+    """
+    for future in futures:
+        if future is not None:
+            future.add_done_callback(lambda f: f.exception())
@@ -0,0 +1,262 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Benchmark generate_idmap and hub key generation, the service's CPU hot path.
+
+generate_idmap is run on Karma-style N-Triples for each scenario (see
+SCENARIOS) with an increasing number of assets. The time per asset should
+stay about the same as the number of assets grows. Allocations are
+measured as the net number of objects tracked by the garbage collector,
+and as the peak traced memory if tracemalloc is available.
+
+With --check the results are compared with the baseline file, and the
+benchmark fails if the time or allocations per asset of any scenario are
+more than --margin above the baseline. Use --update-baseline to record the
+results of the machine the checks run on.
+
+Usage:
+    python tests/benchmarks/idmap.py [--sizes 1000,10000,100000,1000000]
+        [--scenarios simple,source_ids,blank_lines,escapes,large_blocks,hub_key]
+        [--repeat 3] [--baseline tests/benchmarks/baseline.json]
+        [--margin 0.5] [--check | --update-baseline]
+"""
+import argparse
+import gc
+import json
+import os
+import sys
+import time
+
+from bass.hubkey import generate_hub_key
+from tornado.options import options, define
+
+from onboarding.models import assets
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+REPOSITORY_ID = '2e9ce79cfa710e80878920c98e076aa9'
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                        'baseline.json')
+# allowed above the baseline in addition to the margin, so that small
+# numbers such as a fraction of an object per asset don't fail the check
+TOLERANCE = {'us_per_asset': 0.5, 'objects_per_asset': 0.5,
+             'bytes_per_asset': 64}
+
+ENTITY = (
+    u'<http://openpermissions.org/ns/id/{entity_id}> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://openpermissions.org/ns/op/1.1/Asset> .\n'
+    u'<http://openpermissions.org/ns/id/{entity_id}> <http://purl.org/dc/terms/description> "Sunset over a Caribbean beach" .\n'
+)
+SOURCE_ID = (
+    u'<http://openpermissions.org/ns/id/{entity_id}> <http://openpermissions.org/ns/op/1.1/alsoIdentifiedBy> _:{node} .\n'
+    u'_:{node} <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://openpermissions.org/ns/op/1.1/Id> .\n'
+    u'_:{node} <http://openpermissions.org/ns/op/1.1/id_type> <http://openpermissions.org/ns/hub/examplecopictureid> .\n'
+    u'_:{node} <http://openpermissions.org/ns/op/1.1/value> "{value}" .\n'
+)
+OFFER = (
+    u'<http://openpermissions.org/ns/id/{entity_id}> <http://openpermissions.org/ns/op/1.1/hasOffer> <http://openpermissions.org/ns/id/{offer_id}> .\n'
+)
+# a source id with escaped quotes and backslashes, as N-Triples literals
+ESCAPED_VALUE = u'say \\"cheese\\" \\\\\\"{index}\\\\\\" \\"\\"\\" {index}'
+
+
+def karma_n3(count, source_ids=1, blank_lines=1, escapes=False,
+             offers=0):
+    """
+    Create Karma-style N-Triples, a block of triples per asset followed by
+    blank lines
+
+    :param count: number of assets
+    :param source_ids: number of source ids of each asset
+    :param blank_lines: number of blank lines after each asset. If more
+        than one, the extra lines contain whitespace and end with \\r\\n.
+    :param escapes: whether the source ids contain escaped quotes
+    :param offers: number of extra offer triples in each block
+    :returns: unicode
+    """
+    separator = u'\n' + u' \t\r\n' * (blank_lines - 1)
+    parts = []
+    for index in xrange(count):
+        entity_id = u'{:032x}'.format(index + 1)
+        parts.append(ENTITY.format(entity_id=entity_id))
+        for number in xrange(source_ids):
+            value = (ESCAPED_VALUE if escapes else u'{index}-{number}').format(
+                index=index, number=number)
+            parts.append(SOURCE_ID.format(
+                entity_id=entity_id, node=u'Id{}_{}'.format(index, number),
+                value=value))
+        for number in xrange(offers):
+            parts.append(OFFER.format(entity_id=entity_id,
+                                      offer_id=u'{:032x}'.format(number + 1)))
+        parts.append(separator)
+    return u''.join(parts)
+
+
+def idmap_scenario(**kwargs):
+    """A scenario timing generate_idmap on karma_n3(count, **kwargs)"""
+    def prepare(count):
+        data = {'data': {'rdf_n3': karma_n3(count, **kwargs)}}
+
+        def run():
+            id_map = assets.generate_idmap(data, REPOSITORY_ID)
+            assert len(id_map) == count
+            return id_map
+        return run
+    return prepare
+
+
+def hub_key_scenario(count):
+    """A scenario timing generate_hub_key"""
+    entity_ids = [u'{:032x}'.format(index + 1) for index in xrange(count)]
+
+    def run():
+        return [generate_hub_key(options.default_resolver_id, options.hub_id,
+                                 REPOSITORY_ID, 'asset', entity_id)
+                for entity_id in entity_ids]
+    return run
+
+
+SCENARIOS = {
+    # one source id per asset
+    'simple': idmap_scenario(),
+    # several source ids per asset
+    'source_ids': idmap_scenario(source_ids=5),
+    # extra whitespace lines with \r\n line endings between assets
+    'blank_lines': idmap_scenario(blank_lines=4),
+    # source ids with many escaped quotes and backslashes
+    'escapes': idmap_scenario(escapes=True, source_ids=2),
+    # large blocks, with triples that are not read
+    'large_blocks': idmap_scenario(offers=10),
+    'hub_key': hub_key_scenario
+}
+
+
+def measure(prepare, count, repeat):
+    """
+    Run a scenario with count assets repeat times
+
+    :returns: the best time, the net number of objects allocated and the
+        peak traced memory (None without tracemalloc), per asset
+    """
+    run = prepare(count)
+    best = None
+    objects = None
+    peak = None
+    for _ in xrange(repeat):
+        gc.collect()
+        gc.disable()
+        try:
+            before = gc.get_count()[0]
+            start = time.time()
+            result = run()
+            elapsed = time.time() - start
+            objects = gc.get_count()[0] - before
+        finally:
+            gc.enable()
+        del result
+        best = elapsed if best is None else min(best, elapsed)
+
+    if tracemalloc is not None:
+        gc.collect()
+        tracemalloc.start()
+        result = run()
+        peak = tracemalloc.get_traced_memory()[1] / float(count)
+        tracemalloc.stop()
+        del result
+
+    return best * 1e6 / count, objects / float(count), peak
+
+
+def check(results, baseline, margin):
+    """
+    Compare results with the baseline
+
+    :returns: list of messages describing each regression
+    """
+    failures = []
+    for key, result in sorted(results.items()):
+        expected = baseline.get(key)
+        if expected is None:
+            print('{} is not in the baseline'.format(key))
+            continue
+
+        for name, value in sorted(result.items()):
+            limit = expected.get(name)
+            if value is None or limit is None:
+                continue
+            if value > limit * (1 + margin) + TOLERANCE[name]:
+                failures.append('{} {} is {:.2f}, more than {:.0%} above the '
+                                'baseline of {:.2f}'.format(
+                                    key, name, value, margin, limit))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000',
+                        help='comma separated numbers of assets')
+    parser.add_argument('--scenarios', default=','.join(sorted(SCENARIOS)),
+                        help='comma separated scenarios')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of runs of each scenario, the best '
+                             'time is used')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='JSON file of the baseline results')
+    parser.add_argument('--margin', type=float, default=0.5,
+                        help='fraction above the baseline allowed')
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--check', action='store_true',
+                       help='fail if the baseline is exceeded')
+    group.add_argument('--update-baseline', action='store_true',
+                       help='write the results to the baseline file')
+    args = parser.parse_args()
+
+    for name in ('default_resolver_id', 'hub_id'):
+        if name not in options:
+            define(name)
+    options.default_resolver_id = 'openpermissions.org'
+    options.hub_id = 'hub1'
+
+    results = {}
+    print('{:>12} {:>10} {:>14} {:>16} {:>16}'.format(
+        'scenario', 'assets', 'us per asset', 'objects / asset',
+        'bytes / asset'))
+    for scenario in args.scenarios.split(','):
+        for count in [int(size) for size in args.sizes.split(',')]:
+            seconds, objects, peak = measure(SCENARIOS[scenario], count,
+                                             args.repeat)
+            results['{}:{}'.format(scenario, count)] = {
+                'us_per_asset': seconds,
+                'objects_per_asset': objects,
+                'bytes_per_asset': peak
+            }
+            print('{:>12} {:>10} {:>14.2f} {:>16.2f} {:>16}'.format(
+                scenario, count, seconds, objects,
+                'n/a' if peak is None else '{:.0f}'.format(peak)))
+
+    if args.update_baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True,
+                  separators=(',', ': '))
+        print('Baseline written to {}'.format(args.baseline))
+    elif args.check:
+        with open(args.baseline) as f:
+            failures = check(results, json.load(f), args.margin)
+        for failure in failures:
+            print(failure)
+        if failures:
+            sys.exit(1)
+        print('No regressions')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,401 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Load test the onboarding service against stub upstream services.
+
+The stubs (see stubs.py) and the service each run in their own process. For
+each catalogue size and format a new service process is started, sent the
+requests, and asked for its peak RSS and how long its event loop was
+blocked. The results are written as JSON, and compared with the results of
+an earlier run if one is given.
+
+The transformation cache and the sharing of identical requests are turned
+off, so that every request is processed in full.
+
+Usage:
+    python tests/benchmarks/load.py [--sizes 1000,10000,100000,1000000]
+        [--formats csv,json] [--requests 10] [--concurrency 2]
+        [--latency 0.01] [--payload-size 0] [--stream] [--local-transform]
+        [--output results.json] [--compare previous.json]
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import resource
+import subprocess
+import sys
+import time
+
+from tornado import httpclient
+from tornado.gen import coroutine, Return
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from tornado.web import RequestHandler
+
+import stubs
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(os.path.dirname(BENCHMARKS_DIR))
+RESULTS_DIR = os.path.join(BENCHMARKS_DIR, 'results')
+
+REPOSITORY_ID = '2e9ce79cfa710e80878920c98e076aa9'
+CONTENT_TYPES = {'csv': 'text/csv', 'json': 'application/json'}
+CSV_HEADER = 'source_id_types,source_ids,offer_ids,description\n'
+CSV_ROW = 'examplecopictureid,{run}-{index},,Sunset over a Caribbean beach\n'
+
+# ru_maxrss is in kilobytes on Linux and bytes on OS X
+RSS_UNIT = 1 if sys.platform == 'darwin' else 1024
+
+
+def catalogue(count, fmt, run=0):
+    """
+    Create a catalogue of assets
+
+    :param count: number of assets
+    :param fmt: 'csv' or 'json'
+    :param run: included in the source ids, so that catalogues of different
+        runs are different
+    :returns: the body and its content type
+    """
+    if fmt == 'csv':
+        body = CSV_HEADER + ''.join(CSV_ROW.format(run=run, index=index)
+                                    for index in xrange(count))
+    else:
+        body = json.dumps([
+            {'source_ids': [{'source_id_type': 'examplecopictureid',
+                             'source_id': '{}-{}'.format(run, index)}],
+             'description': 'Sunset over a Caribbean beach'}
+            for index in xrange(count)])
+    return body, CONTENT_TYPES[fmt]
+
+
+def percentile(values, fraction):
+    """The nearest-rank percentile of a list of values"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(int(round(fraction * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(index, len(ordered) - 1)]
+
+
+class LoopMonitor(object):
+    """
+    Measures how long the IOLoop is blocked, from how late a callback
+    scheduled every interval seconds runs
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.blocked = 0.0
+        self.max_blocked = 0.0
+        self.io_loop = IOLoop.current()
+        self._deadline = None
+
+    def start(self):
+        self._deadline = self.io_loop.time() + self.interval
+        self.io_loop.call_at(self._deadline, self._tick)
+
+    def _tick(self):
+        now = self.io_loop.time()
+        late = now - self._deadline
+        if late > self.interval:
+            self.blocked += late
+            self.max_blocked = max(self.max_blocked, late)
+
+        self._deadline = now + self.interval
+        self.io_loop.call_at(self._deadline, self._tick)
+
+
+class StatsHandler(RequestHandler):
+    """Reports the service process's resource use to the load test"""
+
+    def initialize(self, monitor):
+        self.monitor = monitor
+
+    def get(self):
+        from onboarding.models import metrics
+
+        stages = {}
+        for (stage,), counts in metrics.STAGE_SECONDS.values.items():
+            stages[stage] = {'count': sum(counts[:-1]), 'seconds': counts[-1]}
+
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        self.finish({
+            'peak_rss_bytes': usage.ru_maxrss * RSS_UNIT,
+            'cpu_seconds': usage.ru_utime + usage.ru_stime,
+            'loop_blocked_seconds': self.monitor.blocked,
+            'loop_max_blocked_seconds': self.monitor.max_blocked,
+            'stages': stages
+        })
+
+
+def serve(stubs_url, settings):
+    """
+    Run the onboarding service using the stubs, printing its url once it
+    is listening
+
+    :param stubs_url: url of the stub services
+    :param settings: dictionary of options to override
+    """
+    from koi.configure import load_config_file
+    from tornado.options import options
+    from onboarding import app
+
+    logging.basicConfig(level=logging.WARNING)
+    load_config_file(app.CONF_DIR)
+    options.url_auth = stubs_url
+    options.url_accounts = stubs_url
+    options.url_transformation = stubs_url
+    options.use_ssl = False
+    options.metrics_dir = ''
+    options.trace_sink = ''
+    options.dedupe_by_content = False
+    options.transform_cache_size = 0
+    options.transform_cache_dir = ''
+    for name, value in settings.items():
+        setattr(options, name, value)
+
+    app.configure()
+    application = app.make_application()
+    monitor = LoopMonitor()
+    application.add_handlers(r'.*$', [
+        (r'/benchmark/stats', StatsHandler, {'monitor': monitor})])
+
+    sockets = bind_sockets(0, '127.0.0.1')
+    server = HTTPServer(application, max_body_size=2 ** 31)
+    server.add_sockets(sockets)
+    monitor.start()
+
+    print('http://127.0.0.1:{}'.format(sockets[0].getsockname()[1]))
+    sys.stdout.flush()
+    IOLoop.current().start()
+
+
+def start_process(args):
+    """Start a python process, returning it and the url it prints"""
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join(
+        filter(None, [ROOT_DIR, env.get('PYTHONPATH')]))
+    process = subprocess.Popen([sys.executable] + args, env=env,
+                               stdout=subprocess.PIPE)
+    url = process.stdout.readline().strip()
+    if not url:
+        process.wait()
+        raise RuntimeError('Unable to start {}'.format(' '.join(args)))
+    return process, url
+
+
+def stop_process(process):
+    process.terminate()
+    process.wait()
+
+
+@coroutine
+def load(url, body, content_type, requests, concurrency):
+    """
+    Send requests to onboard the catalogue, concurrency at a time
+
+    :returns: the latency of each successful request, the number of failed
+        requests and the total time taken
+    """
+    client = httpclient.AsyncHTTPClient(force_instance=True,
+                                        max_clients=concurrency,
+                                        max_body_size=2 ** 31)
+    headers = {'Content-Type': content_type,
+               'Authorization': 'Bearer {}'.format(stubs.make_token())}
+    endpoint = '{}/v1/onboarding/repositories/{}/assets'.format(
+        url, REPOSITORY_ID)
+    latencies = []
+    errors = [0]
+    remaining = [requests]
+
+    @coroutine
+    def worker():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            start = time.time()
+            try:
+                yield client.fetch(endpoint, method='POST', body=body,
+                                   headers=headers, request_timeout=3600)
+            except httpclient.HTTPError as exc:
+                logging.warning('Request failed: %s', exc)
+                errors[0] += 1
+            else:
+                latencies.append(time.time() - start)
+
+    start = time.time()
+    yield [worker() for _ in range(concurrency)]
+    elapsed = time.time() - start
+    client.close()
+    raise Return((latencies, errors[0], elapsed))
+
+
+@coroutine
+def run(stubs_url, settings, count, fmt, requests, concurrency):
+    """
+    Load test a new service process with a catalogue
+
+    :returns: dictionary of results
+    """
+    process, url = start_process(
+        [os.path.abspath(__file__), '--serve', stubs_url, '--settings', json.dumps(settings)])
+    try:
+        body, content_type = catalogue(count, fmt, run=int(time.time()))
+        latencies, errors, elapsed = yield load(
+            url, body, content_type, requests, concurrency)
+        del body
+
+        client = httpclient.AsyncHTTPClient()
+        response = yield client.fetch(url + '/benchmark/stats')
+        stats = json.loads(response.body)
+    finally:
+        stop_process(process)
+
+    completed = len(latencies)
+    result = {
+        'assets': count,
+        'format': fmt,
+        'requests': requests,
+        'concurrency': concurrency,
+        'errors': errors,
+        'seconds': elapsed,
+        'requests_per_second': completed / elapsed,
+        'assets_per_second': completed * count / elapsed,
+        'latency_seconds': {
+            'p50': percentile(latencies, 0.5),
+            'p99': percentile(latencies, 0.99),
+            'max': max(latencies) if latencies else None
+        }
+    }
+    result.update(stats)
+    raise Return(result)
+
+
+def key(result):
+    return result['format'], result['assets']
+
+
+def compare(results, previous):
+    """Print the change in throughput and latency since a previous run"""
+    earlier = {key(result): result for result in previous['results']}
+    print('\nChange since {}'.format(previous['started']))
+    print('{:>6} {:>10} {:>12} {:>12} {:>12}'.format(
+        'format', 'assets', 'req/s', 'p99', 'peak rss'))
+    for result in results:
+        before = earlier.get(key(result))
+        if before is None:
+            continue
+
+        changes = []
+        for name in ('requests_per_second', 'p99', 'peak_rss_bytes'):
+            if name == 'p99':
+                old = before['latency_seconds']['p99']
+                new = result['latency_seconds']['p99']
+            else:
+                old, new = before[name], result[name]
+            changes.append('{:+.1%}'.format(float(new) / old - 1)
+                           if old and new is not None else 'n/a')
+        print('{:>6} {:>10} {:>12} {:>12} {:>12}'.format(
+            result['format'], result['assets'], *changes))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sizes', default='1000,10000,100000,1000000',
+                        help='comma separated numbers of assets')
+    parser.add_argument('--formats', default='csv,json',
+                        help='comma separated catalogue formats, csv or json')
+    parser.add_argument('--requests', type=int, default=10,
+                        help='number of requests per catalogue')
+    parser.add_argument('--concurrency', type=int, default=2,
+                        help='number of requests sent at a time')
+    parser.add_argument('--latency', type=float, default=0.01,
+                        help='seconds each stub response is delayed by')
+    parser.add_argument('--payload-size', type=int, default=0,
+                        help='minimum size of each stub response, in bytes')
+    parser.add_argument('--stream', action='store_true',
+                        help='onboard assets as the body is received')
+    parser.add_argument('--local-transform', action='store_true',
+                        help='transform in the service, not the stub')
+    parser.add_argument('--output', help='file for the JSON results, '
+                        'defaults to a new file in {}'.format(RESULTS_DIR))
+    parser.add_argument('--compare', help='JSON results of an earlier run')
+    parser.add_argument('--serve', help=argparse.SUPPRESS)
+    parser.add_argument('--settings', default='{}', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve:
+        return serve(args.serve, json.loads(args.settings))
+
+    settings = {
+        'stream_uploads': args.stream,
+        'local_transform': args.local_transform,
+        'max_post_body_size': 2 ** 31,
+        'max_decoded_body_size': 2 ** 31
+    }
+    started = datetime.datetime.utcnow()
+    stubs_process, stubs_url = start_process(
+        [os.path.join(BENCHMARKS_DIR, 'stubs.py'), '--port', '0', '--latency', str(args.latency),
+         '--payload-size', str(args.payload_size)])
+
+    print('{:>6} {:>10} {:>8} {:>10} {:>10} {:>10} {:>12} {:>10}'.format(
+        'format', 'assets', 'req/s', 'p50', 'p99', 'errors', 'peak rss MB',
+        'blocked s'))
+    results = []
+    try:
+        for fmt in args.formats.split(','):
+            for count in [int(size) for size in args.sizes.split(',')]:
+                result = IOLoop.current().run_sync(lambda: run(
+                    stubs_url, settings, count, fmt, args.requests,
+                    args.concurrency))
+                results.append(result)
+                print('{:>6} {:>10} {:>8.2f} {:>10.3f} {:>10.3f} {:>10} '
+                      '{:>12.1f} {:>10.3f}'.format(
+                          fmt, count, result['requests_per_second'],
+                          result['latency_seconds']['p50'] or 0,
+                          result['latency_seconds']['p99'] or 0,
+                          result['errors'],
+                          result['peak_rss_bytes'] / 1e6,
+                          result['loop_blocked_seconds']))
+    finally:
+        stop_process(stubs_process)
+
+    output = args.output
+    if not output:
+        if not os.path.isdir(RESULTS_DIR):
+            os.makedirs(RESULTS_DIR)
+        output = os.path.join(RESULTS_DIR, 'load-{}.json'.format(
+            started.strftime('%Y%m%dT%H%M%S')))
+
+    report = {
+        'started': started.isoformat() + 'Z',
+        'python': platform.python_version(),
+        'machine': platform.node(),
+        'settings': dict(settings, latency=args.latency,
+                         payload_size=args.payload_size,
+                         requests=args.requests,
+                         concurrency=args.concurrency),
+        'results': results
+    }
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print('\nResults written to {}'.format(output))
+
+    if args.compare:
+        with open(args.compare) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
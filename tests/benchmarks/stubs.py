@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+"""
+Stub auth, accounts, transformation and repository services for load tests.
+
+Each stub answers after a fixed latency and can pad its responses to a
+given size. The transformation stub transforms the data with the service's
+default mapping, so the onboarding service has realistic N-Triples to
+generate id maps for and store.
+
+Usage:
+    python tests/benchmarks/stubs.py [--port 8100] [--latency 0.01]
+"""
+import argparse
+import base64
+import json
+import sys
+import time
+
+from tornado.gen import coroutine, sleep
+from tornado.httpserver import HTTPServer
+from tornado.ioloop import IOLoop
+from tornado.netutil import bind_sockets
+from tornado.web import Application, RequestHandler
+
+from onboarding.models import mapping
+
+# the transformation service doesn't know the repository the data is for
+TRANSFORM_REPOSITORY_ID = '0' * 32
+
+def make_token(lifetime=3600):
+    """An unsigned JWT expiring after lifetime seconds"""
+    payload = json.dumps({'exp': int(time.time() + lifetime)})
+    return 'e30.{}.sig'.format(base64.urlsafe_b64encode(payload).rstrip('='))
+
+
+class StubHandler(RequestHandler):
+    """Answers after the stub's latency with a padded JSON response"""
+
+    def initialize(self, latency=0, payload_size=0, repository_url=None):
+        self.latency = latency
+        self.payload_size = payload_size
+        self.repository_url = repository_url
+
+    @coroutine
+    def respond(self, result):
+        if self.latency:
+            yield sleep(self.latency)
+
+        if self.payload_size:
+            size = len(json.dumps(result))
+            result = dict(result, padding='x' * max(self.payload_size - size, 0))
+        self.finish(result)
+
+
+class TokenHandler(StubHandler):
+    def post(self):
+        return self.respond({'status': 200, 'access_token': make_token(),
+                             'token_type': 'bearer', 'expiry': 3600})
+
+
+class RepositoryHandler(StubHandler):
+    def get(self, repository_id):
+        return self.respond({'status': 200, 'data': {
+            'id': repository_id,
+            'service': {'location': self.repository_url}}})
+
+
+class TransformationHandler(StubHandler):
+    def post(self):
+        result, status, errors = mapping.transform(
+            self.request.body, self.request.headers.get('Content-Type'),
+            TRANSFORM_REPOSITORY_ID, 'openpermissions.org', 'hub1')
+        if status != 200:
+            self.set_status(status)
+            return self.respond({'status': status, 'errors': errors})
+
+        return self.respond(
+            {'status': 200, 'data': {'rdf_n3': result['data']['rdf_n3']}})
+
+
+class AssetsHandler(StubHandler):
+    def post(self, repository_id):
+        return self.respond({'status': 200})
+
+    def delete(self, repository_id):
+        return self.respond({'status': 200})
+
+
+def make_application(url, latency=0, payload_size=0):
+    """
+    The stub services, all served by one application
+
+    :param url: the url the application is served at
+    :param latency: seconds each response is delayed by
+    :param payload_size: minimum size of each response, in bytes
+    """
+    kwargs = {'latency': latency, 'payload_size': payload_size,
+              'repository_url': url}
+    return Application([
+        (r'/v1/auth/token', TokenHandler, kwargs),
+        (r'/v1/accounts/repositories/([^/]+)', RepositoryHandler, kwargs),
+        (r'/v1/transformation/assets', TransformationHandler, kwargs),
+        (r'/v1/repository/repositories/([^/]+)/assets', AssetsHandler, kwargs)
+    ])
+
+
+def serve(port=0, latency=0, payload_size=0, address='127.0.0.1'):
+    """
+    Serve the stubs on the current IOLoop
+
+    :param port: the port, 0 to use any free port
+    :returns: the stubs' url, used for all of the stub services
+    """
+    sockets = bind_sockets(port, address)
+    url = 'http://{}:{}'.format(address, sockets[0].getsockname()[1])
+    server = HTTPServer(make_application(url, latency, payload_size),
+                        decompress_request=True,
+                        max_body_size=2 ** 31)
+    server.add_sockets(sockets)
+    return url
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=8100,
+                        help='0 to use any free port')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='seconds each response is delayed by')
+    parser.add_argument('--payload-size', type=int, default=0,
+                        help='minimum size of each response, in bytes')
+    args = parser.parse_args()
+
+    url = serve(args.port, args.latency, args.payload_size)
+    print(url)
+    sys.stdout.flush()
+    IOLoop.current().start()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import pytest
+
+from onboarding.models import jobs, metrics
+from onboarding.models.cache import CACHES
+
+
+@pytest.fixture(autouse=True)
+def clear_caches():
+    """Don't share cached responses between tests"""
+    for cache in CACHES.values():
+        cache.clear()
+
+
+@pytest.fixture(autouse=True)
+def reset_jobs():
+    """Each test gets a new job queue"""
+    jobs.queue = None
+
+
+@pytest.fixture(autouse=True)
+def clear_metrics():
+    """Each test starts with no recorded metrics"""
+    for metric in metrics.METRICS.values():
+        metric.clear()
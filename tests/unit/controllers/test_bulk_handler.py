@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import json
+
+from mock import MagicMock, Mock, patch
+import pytest
+from koi.exceptions import HTTPError
+from koi.test_helpers import make_future
+
+from onboarding.controllers.bulk_handler import BulkAssetHandler
+from onboarding.models import scheduler
+
+
+def make_repository(repository_id):
+    return make_future({'id': repository_id,
+                        'service': {'location': 'https://' + repository_id}})
+
+
+def make_handler(body, authorization='Bearer token1234'):
+    handler = BulkAssetHandler(MagicMock(), MagicMock())
+    handler.finish = MagicMock()
+    handler.get_argument = Mock(return_value=None)
+    body = json.dumps(body)
+    handler.request = Mock(body=body, method='POST', headers={
+        'Content-Type': 'application/json',
+        'Content-Length': str(len(body)),
+        'Authorization': authorization})
+    return handler
+
+
+@patch('onboarding.controllers.repository_handler.options',
+       max_post_body_size=1000)
+@patch('onboarding.controllers.bulk_handler.options',
+       max_bulk_repositories=10, max_concurrent_bulk_repositories=2)
+@patch('onboarding.controllers.bulk_handler.remote')
+@patch('onboarding.controllers.bulk_handler.assets')
+@patch('onboarding.controllers.bulk_handler.get_repository',
+       side_effect=make_repository)
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       side_effect=lambda token, repository_id: make_future(repository_id))
+def test_post_repositories(exchange_delegate_token, get_repository, assets,
+                           remote, options, handler_options):
+    assets.batches.return_value = None
+    assets.use_local_transform.return_value = False
+    assets.onboard.side_effect = lambda *args, **kwargs: make_future(
+        ([{'entity_id': args[3]}], 200, []))
+    handler = make_handler({'repositories': ['repo1', 'repo2', 'repo3'],
+                            'content_type': 'text/csv',
+                            'data': 'id\n1\n'})
+
+    handler.post().result()
+
+    # the data is transformed by the transformation service once
+    remote.transform.assert_called_once_with('id\n1\n', 'text/csv', None)
+    assert assets.transform.call_count == 3
+    for call in assets.transform.call_args_list:
+        assert call[1]['response'] is remote.transform.return_value
+    assert assets.onboard.call_count == 3
+    assets.onboard.assert_any_call(
+        'id\n1\n', 'text/csv', 'https://repo2', 'repo2', token='repo2',
+        r2rml_url=None, transformed=assets.transform.return_value,
+        local_transform=None)
+    handler.finish.assert_called_once_with({'status': 200, 'data': [
+        {'repository_id': 'repo1', 'status': 200,
+         'data': [{'entity_id': 'repo1'}]},
+        {'repository_id': 'repo2', 'status': 200,
+         'data': [{'entity_id': 'repo2'}]},
+        {'repository_id': 'repo3', 'status': 200,
+         'data': [{'entity_id': 'repo3'}]}]})
+
+
+@patch('onboarding.controllers.repository_handler.options',
+       max_post_body_size=1000)
+@patch('onboarding.controllers.bulk_handler.options',
+       max_bulk_repositories=10, max_concurrent_bulk_repositories=2)
+@patch('onboarding.controllers.bulk_handler.remote')
+@patch('onboarding.controllers.bulk_handler.assets')
+@patch('onboarding.controllers.bulk_handler.get_repository',
+       side_effect=make_repository)
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       side_effect=lambda token, repository_id: make_future(repository_id))
+def test_post_items(exchange_delegate_token, get_repository, assets, remote,
+                    options, handler_options):
+    assets.batches.return_value = None
+    assets.use_local_transform.return_value = False
+    assets.onboard.return_value = make_future(([], 200, []))
+    handler = make_handler({'items': [
+        {'repository_id': 'repo1', 'content_type': 'text/csv',
+         'data': 'id\n1\n'},
+        {'repository_id': 'repo2', 'content_type': 'application/json',
+         'data': [{'id': 1}]},
+        {'repository_id': 'repo3', 'content_type': 'text/csv',
+         'data': 'id\n1\n'}]})
+
+    handler.post().result()
+
+    assert remote.transform.call_count == 2
+    remote.transform.assert_any_call('[{"id": 1}]', 'application/json', None)
+    assert handler.finish.call_args[0][0]['status'] == 200
+
+
+@patch('onboarding.controllers.repository_handler.options',
+       max_post_body_size=1000)
+@patch('onboarding.controllers.bulk_handler.options',
+       max_bulk_repositories=10, max_concurrent_bulk_repositories=2)
+@patch('onboarding.controllers.bulk_handler.remote')
+@patch('onboarding.controllers.bulk_handler.assets')
+@patch('onboarding.controllers.bulk_handler.get_repository')
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       side_effect=lambda token, repository_id: make_future(repository_id))
+def test_post_partial_failure(exchange_delegate_token, get_repository, assets,
+                              remote, options, handler_options):
+    def repository(repository_id):
+        if repository_id == 'unknown':
+            raise HTTPError(404, 'Not found')
+        return make_repository(repository_id)
+
+    get_repository.side_effect = repository
+    assets.batches.return_value = None
+    assets.onboard.return_value = make_future(
+        (None, 400, [{'message': 'invalid'}]))
+    handler = make_handler({'repositories': ['repo1', 'unknown'],
+                            'content_type': 'text/csv', 'data': 'id\n1\n'})
+    handler.set_status = Mock()
+
+    handler.post().result()
+
+    handler.set_status.assert_called_once_with(207)
+    result = handler.finish.call_args[0][0]
+    assert result['status'] == 207
+    assert result['data'][0] == {'repository_id': 'repo1', 'status': 400,
+                                 'data': [], 'errors': [{'message': 'invalid'}]}
+    assert result['data'][1]['repository_id'] == 'unknown'
+    assert result['data'][1]['status'] == 404
+
+
+@pytest.mark.parametrize('body,status', [
+    ([], 400),
+    ({}, 400),
+    ({'repositories': []}, 400),
+    ({'repositories': 'repo1'}, 400),
+    ({'repositories': ['repo1'] * 11, 'content_type': 'text/csv',
+      'data': ''}, 400),
+    ({'items': [{'repository_id': 'repo1'}]}, 400),
+    ({'items': [{'repository_id': 1, 'content_type': 'text/csv',
+                 'data': ''}]}, 400),
+    ({'repositories': ['repo1'], 'content_type': 'text/csv'}, 400),
+    ({'repositories': ['repo1'], 'content_type': 'text/plain',
+      'data': ''}, 415),
+])
+@patch('onboarding.controllers.repository_handler.options',
+       max_post_body_size=1000)
+@patch('onboarding.controllers.bulk_handler.options', max_bulk_repositories=10)
+def test_post_invalid(options, handler_options, body, status):
+    handler = make_handler(body)
+
+    with pytest.raises(HTTPError) as exc:
+        handler.post().result()
+
+    assert exc.value.status_code == status
+
+
+def test_post_no_token():
+    handler = make_handler({'repositories': ['repo1']}, authorization=None)
+    del handler.request.headers['Authorization']
+
+    with pytest.raises(HTTPError) as exc:
+        handler.post().result()
+
+    assert exc.value.status_code == 401
+
+
+@patch('onboarding.controllers.repository_handler.options',
+       max_post_body_size=1000)
+@patch('onboarding.controllers.bulk_handler.options',
+       max_bulk_repositories=10, max_concurrent_bulk_repositories=1)
+@patch('onboarding.controllers.bulk_handler.remote')
+@patch('onboarding.controllers.bulk_handler.assets')
+@patch('onboarding.controllers.bulk_handler.get_repository',
+       side_effect=make_repository)
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       side_effect=lambda token, repository_id: make_future(repository_id))
+def test_post_queues_items_in_own_share(exchange_delegate_token,
+                                        get_repository, assets, remote,
+                                        options, handler_options):
+    assets.batches.return_value = None
+    assets.use_local_transform.return_value = False
+    shares = []
+
+    def onboard(*args, **kwargs):
+        shares.append(scheduler.current().key)
+        return make_future(([], 200, []))
+
+    assets.onboard.side_effect = onboard
+    handler = make_handler({'repositories': ['repo1', 'repo2'],
+                            'content_type': 'text/csv',
+                            'data': 'id\n1\n'})
+    handler.request.headers['X-Priority'] = 'low'
+
+    handler.post().result()
+
+    assert shares == [('repo1', 'low'), ('repo2', 'low')]
+
+
+@pytest.mark.parametrize('method', ['DELETE', 'PUT'])
+def test_unsupported_method(method):
+    handler = make_handler({})
+    handler.request.method = method
+    handler.send_error = Mock()
+
+    handler._execute([], b'').result()
+
+    assert handler.send_error.call_args[0][0] == 405
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+from mock import MagicMock, patch
+
+import pytest
+from koi.exceptions import HTTPError
+
+from onboarding.controllers.cache_handler import CacheHandler
+
+
+def make_caches():
+    tokens = MagicMock()
+    tokens.stats.return_value = {'hits': 1, 'misses': 2}
+    repositories = MagicMock()
+    repositories.stats.return_value = {'hits': 3, 'misses': 4}
+    return {'delegate_tokens': tokens, 'repositories': repositories}
+
+
+@patch('onboarding.controllers.cache_handler.cache')
+def test_get_cache_stats(cache):
+    cache.CACHES = make_caches()
+    handler = CacheHandler(MagicMock(), MagicMock())
+    handler.finish = MagicMock()
+
+    # MUT
+    handler.get()
+    msg = {
+        'status': 200,
+        'data': {
+            'delegate_tokens': {'hits': 1, 'misses': 2},
+            'repositories': {'hits': 3, 'misses': 4}
+        }
+    }
+
+    handler.finish.assert_called_once_with(msg)
+
+
+@patch('onboarding.controllers.cache_handler.cache')
+def test_get_named_cache_stats(cache):
+    cache.CACHES = make_caches()
+    handler = CacheHandler(MagicMock(), MagicMock())
+    handler.finish = MagicMock()
+
+    # MUT
+    handler.get('repositories')
+    msg = {
+        'status': 200,
+        'data': {'repositories': {'hits': 3, 'misses': 4}}
+    }
+
+    handler.finish.assert_called_once_with(msg)
+
+
+@patch('onboarding.controllers.cache_handler.cache')
+def test_delete_all_caches(cache):
+    cache.CACHES = make_caches()
+    handler = CacheHandler(MagicMock(), MagicMock())
+    handler.finish = MagicMock()
+
+    # MUT
+    handler.delete()
+    msg = {
+        'status': 200,
+        'data': {'flushed': ['delegate_tokens', 'repositories']}
+    }
+
+    handler.finish.assert_called_once_with(msg)
+    for value in cache.CACHES.values():
+        value.clear.assert_called_once_with()
+
+
+@patch('onboarding.controllers.cache_handler.cache')
+def test_delete_named_cache(cache):
+    cache.CACHES = make_caches()
+    handler = CacheHandler(MagicMock(), MagicMock())
+    handler.finish = MagicMock()
+
+    # MUT
+    handler.delete('repositories')
+
+    cache.CACHES['repositories'].clear.assert_called_once_with()
+    assert not cache.CACHES['delegate_tokens'].clear.called
+
+
+@patch('onboarding.controllers.cache_handler.cache')
+def test_delete_unknown_cache(cache):
+    cache.CACHES = make_caches()
+    handler = CacheHandler(MagicMock(), MagicMock())
+
+    with pytest.raises(HTTPError) as exc:
+        handler.delete('unknown')
+
+    assert exc.value.status_code == 404
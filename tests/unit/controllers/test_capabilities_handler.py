@@ -17,6 +17,9 @@ from onboarding.controllers.capabilities_handler import CapabilitiesHandler
 @patch('onboarding.controllers.capabilities_handler.options')
 def test_get_capabilites(options):
     options.max_post_body_size = 1000
+    options.stream_uploads = True
+    options.max_stream_body_size = 100000
+    options.max_decoded_body_size = 10000
     handler = CapabilitiesHandler(MagicMock(), MagicMock())
     handler.finish = MagicMock()
 
@@ -25,7 +28,10 @@ def test_get_capabilites(options):
     msg = {
         'status': 200,
         'data': {
-            'max_post_body_size': options.max_post_body_size
+            'max_post_body_size': options.max_post_body_size,
+            'stream_uploads': True,
+            'max_stream_body_size': options.max_stream_body_size,
+            'max_decoded_body_size': options.max_decoded_body_size
         }
     }
 
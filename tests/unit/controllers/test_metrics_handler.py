@@ -0,0 +1,30 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+from mock import MagicMock, patch
+
+from onboarding.controllers.metrics_handler import MetricsHandler
+from onboarding.models import metrics
+
+
+@patch.object(metrics, 'directory', None)
+def test_get_metrics():
+    metrics.UPSTREAM_RESPONSES.inc(host='localhost:8004', code=200)
+    handler = MetricsHandler(MagicMock(), MagicMock())
+    handler.finish = MagicMock()
+    handler.set_header = MagicMock()
+
+    # MUT
+    handler.get()
+
+    handler.set_header.assert_called_once_with(
+        'Content-Type', 'text/plain; version=0.0.4')
+    text = handler.finish.call_args[0][0]
+    assert ('onboarding_upstream_responses_total'
+            '{host="localhost:8004",code="200"} 1') in text
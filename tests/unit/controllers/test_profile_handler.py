@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import pytest
+from mock import MagicMock, patch
+from tornado.concurrent import Future
+from koi.exceptions import HTTPError
+from koi.test_helpers import make_future
+
+from onboarding.controllers.profile_handler import ProfileHandler
+from onboarding.models import profiler
+
+
+def make_handler(**arguments):
+    handler = ProfileHandler(MagicMock(), MagicMock())
+    handler.finish = MagicMock()
+    handler.set_header = MagicMock()
+    handler.get_argument = lambda name, default=None: arguments.get(
+        name, default)
+    return handler
+
+
+@patch('onboarding.controllers.profile_handler.profiler.profile',
+       return_value=make_future('report'))
+@patch('onboarding.controllers.profile_handler.options')
+def test_post(options, profile):
+    options.profile_max_seconds = 30
+    handler = make_handler(seconds='5', sort='time', limit='20')
+
+    handler.post().result()
+
+    profile.assert_called_once_with(5.0, 'time', 20)
+    handler.set_header.assert_any_call(
+        'Content-Type', 'text/plain; charset=UTF-8')
+    handler.finish.assert_called_once_with('report')
+
+
+@patch('onboarding.controllers.profile_handler.options')
+def test_post_disabled(options):
+    options.profile_max_seconds = 0
+
+    with pytest.raises(HTTPError) as exc:
+        make_handler().post().result()
+
+    assert exc.value.status_code == 404
+
+
+@pytest.mark.parametrize('arguments', [
+    {'seconds': 'ten'},
+    {'seconds': '0'},
+    {'seconds': '31'},
+    {'limit': 'all'},
+    {'sort': 'name'},
+])
+@patch('onboarding.controllers.profile_handler.options')
+def test_post_invalid_arguments(options, arguments):
+    options.profile_max_seconds = 30
+
+    with pytest.raises(HTTPError) as exc:
+        make_handler(**arguments).post().result()
+
+    assert exc.value.status_code == 400
+
+
+@patch('onboarding.controllers.profile_handler.profiler.profile')
+@patch('onboarding.controllers.profile_handler.options')
+def test_post_already_profiling(options, profile):
+    options.profile_max_seconds = 30
+    future = Future()
+    future.set_exception(profiler.ProfileRunning('running'))
+    profile.return_value = future
+
+    with pytest.raises(HTTPError) as exc:
+        make_handler().post().result()
+
+    assert exc.value.status_code == 409
@@ -0,0 +1,834 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import base64
+import json
+
+from mock import MagicMock, Mock, patch
+
+import pytest
+from tornado.concurrent import Future
+from koi.exceptions import HTTPError
+from koi.test_helpers import make_future, gen_test
+
+from onboarding.models import compression, resilience, scheduler, tracing
+from onboarding.controllers.repository_handler import (AssetHandler,
+                                                       AssetStreamHandler,
+                                                       JobHandler)
+
+REPOSITORY = {'id': 'repo1', 'service': {'location': 'https://localhost:8004'}}
+
+
+def make_error(status_code):
+    future = Future()
+    future.set_exception(HTTPError(status_code, 'error'))
+    return future
+
+
+def make_handler(content_type='text/csv', authorization='Bearer token1234'):
+    handler = AssetHandler(MagicMock(), MagicMock())
+    handler.finish = MagicMock()
+    handler.get_argument = Mock(return_value=None)
+    handler.request = Mock(body='data', headers={
+        'Content-Type': content_type,
+        'Content-Length': '4',
+        'Authorization': authorization})
+    return handler
+
+
+@patch('onboarding.controllers.repository_handler.options')
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_post(exchange_delegate_token, get_repository, assets, options):
+    options.max_post_body_size = 100
+    options.dedupe_by_content = False
+    assets.batches.return_value = None
+    assets.onboard.return_value = make_future(([{'entity_id': '1'}], 200, []))
+    handler = make_handler()
+
+    handler.post('repo1').result()
+
+    assets.transform.assert_called_once_with(
+        'data', 'text/csv', 'repo1', r2rml_url=None, local_transform=None)
+    assets.onboard.assert_called_once_with(
+        'data', 'text/csv', 'https://localhost:8004', 'repo1',
+        token='delegated', r2rml_url=None,
+        transformed=assets.transform.return_value, local_transform=None)
+    handler.finish.assert_called_once_with(
+        {'status': 200, 'data': [{'entity_id': '1'}]})
+
+
+@patch('onboarding.controllers.repository_handler.options')
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_delete(exchange_delegate_token, get_repository, assets, options):
+    options.max_post_body_size = 100
+    assets.batches.return_value = None
+    assets.delete.return_value = make_future(([{'source_ids': []}], 200, []))
+    handler = make_handler()
+
+    handler.delete('repo1').result()
+
+    assets.delete.assert_called_once_with(
+        'data', 'text/csv', 'https://localhost:8004', 'repo1',
+        token='delegated', r2rml_url=None,
+        transformed=assets.transform.return_value, local_transform=None)
+
+
+@patch('onboarding.controllers.repository_handler.options')
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token')
+def test_post_no_token(exchange_delegate_token, get_repository, assets, options):
+    handler = make_handler(authorization=None)
+    del handler.request.headers['Authorization']
+
+    with pytest.raises(HTTPError) as exc:
+        handler.post('repo1').result()
+
+    assert exc.value.status_code == 401
+    assert not assets.onboard.called
+
+
+@patch('onboarding.controllers.repository_handler.options')
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token')
+def test_post_forbidden_before_invalid_content_type(
+        exchange_delegate_token, get_repository, assets, options):
+    exchange_delegate_token.return_value = make_error(403)
+    handler = make_handler(content_type='text/plain')
+
+    with pytest.raises(HTTPError) as exc:
+        handler.post('repo1').result()
+
+    assert exc.value.status_code == 403
+    assert not assets.transform.called
+
+
+@patch('onboarding.controllers.repository_handler.options')
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository')
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_post_invalid_content_type_before_unknown_repository(
+        exchange_delegate_token, get_repository, assets, options):
+    get_repository.return_value = make_error(404)
+    handler = make_handler(content_type='text/plain')
+
+    with pytest.raises(HTTPError) as exc:
+        handler.post('repo1').result()
+
+    assert exc.value.status_code == 415
+    assert not assets.transform.called
+
+
+@patch('onboarding.controllers.repository_handler.options')
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository')
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_post_unknown_repository(exchange_delegate_token, get_repository,
+                                 assets, options):
+    options.max_post_body_size = 100
+    get_repository.return_value = make_error(404)
+    handler = make_handler()
+
+    with pytest.raises(HTTPError) as exc:
+        handler.post('repo1').result()
+
+    assert exc.value.status_code == 404
+    assert not assets.onboard.called
+
+
+@patch('onboarding.controllers.repository_handler.options')
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_post_body_too_large(exchange_delegate_token, get_repository, assets,
+                             options):
+    options.max_post_body_size = 1
+    handler = make_handler()
+
+    with pytest.raises(HTTPError) as exc:
+        handler.post('repo1').result()
+
+    assert exc.value.status_code == 400
+
+
+@patch('onboarding.controllers.repository_handler.options')
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_post_onboard_errors(exchange_delegate_token, get_repository, assets,
+                             options):
+    options.max_post_body_size = 100
+    errors = [{'message': 'invalid'}]
+    assets.onboard.return_value = make_future((None, 400, errors))
+    handler = make_handler()
+
+    with pytest.raises(HTTPError) as exc:
+        handler.post('repo1').result()
+
+    assert exc.value.status_code == 400
+    assert exc.value.errors == {'errors': errors, 'data': None}
+
+
+def make_stream_handler(content_type='text/csv', method='POST'):
+    handler = AssetStreamHandler(MagicMock(), MagicMock())
+    handler.finish = MagicMock()
+    handler.get_argument = Mock(return_value=None)
+    handler.path_kwargs = {'repository_id': 'repo1'}
+    handler.request = Mock(method=method, headers={
+        'Content-Type': content_type,
+        'Authorization': 'Bearer token1234'})
+    return handler
+
+
+@patch('onboarding.controllers.repository_handler.options')
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_stream_post(exchange_delegate_token, get_repository, assets, options):
+    options.max_stream_body_size = 1000
+    options.stream_chunk_size = 1
+    assets.onboard.side_effect = lambda data, *args, **kwargs: make_future(
+        ([{'data': data}], 200, []))
+    handler = make_stream_handler()
+
+    handler.prepare().result()
+    handler.request.connection.set_max_body_size.assert_called_once_with(1000)
+    assert not assets.transform.called
+
+    handler.data_received('a,b\n1,').result()
+    handler.data_received('2\n3,4').result()
+    handler.post('repo1').result()
+
+    assert assets.onboard.call_count == 2
+    assert assets.onboard.call_args[0][2:4] == ('https://localhost:8004', 'repo1')
+    assert assets.onboard.call_args[1]['token'] == 'delegated'
+    handler.finish.assert_called_once_with({
+        'status': 200, 'data': {'count': 2}})
+
+
+@patch('onboarding.controllers.repository_handler.options')
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_stream_delete(exchange_delegate_token, get_repository, assets,
+                       options):
+    options.max_stream_body_size = 1000
+    options.stream_chunk_size = 1000
+    assets.delete.return_value = make_future(([{'source_ids': []}], 200, []))
+    handler = make_stream_handler(method='DELETE')
+
+    handler.prepare().result()
+    handler.data_received('a,b\n1,2\n').result()
+    handler.delete('repo1').result()
+
+    assert assets.delete.call_count == 1
+    assert not assets.onboard.called
+
+
+@patch('onboarding.controllers.repository_handler.options')
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_stream_stops_at_first_error(exchange_delegate_token, get_repository,
+                                     assets, options):
+    options.max_stream_body_size = 1000
+    options.stream_chunk_size = 1
+    errors = [{'message': 'invalid'}]
+    assets.onboard.return_value = make_future((None, 400, errors))
+    handler = make_stream_handler()
+
+    handler.prepare().result()
+    handler.data_received('a,b\n1,2\n3,4\n').result()
+
+    with pytest.raises(HTTPError) as exc:
+        handler.post('repo1').result()
+
+    assert assets.onboard.call_count == 1
+    assert exc.value.status_code == 400
+    assert exc.value.errors == {'errors': errors, 'data': {'count': 0}}
+
+
+@patch('onboarding.controllers.repository_handler.options')
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_stream_post_ndjson(exchange_delegate_token, get_repository, assets,
+                            options):
+    options.max_stream_body_size = 1000
+    options.stream_chunk_size = 1
+    errors = [{'message': 'invalid'}]
+    assets.onboard.side_effect = [
+        make_future(([{'entity_id': '1'}], 200, [])),
+        make_future((None, 400, errors))]
+    handler = make_stream_handler()
+    handler.request.headers['Accept'] = 'application/x-ndjson'
+    handler.write = Mock()
+    handler.flush = Mock(return_value=make_future(None))
+
+    handler.prepare().result()
+    handler.data_received('a,b\n1,2\n').result()
+
+    # the assets are written as soon as their chunk has been stored
+    handler.write.assert_called_once_with('{"entity_id": "1"}\n')
+
+    handler.data_received('3,4\n').result()
+    handler.post('repo1').result()
+
+    handler.finish.assert_called_once_with(
+        json.dumps({'status': 400, 'errors': errors}) + '\n')
+
+
+@patch('onboarding.controllers.repository_handler.options')
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_stream_invalid_json(exchange_delegate_token, get_repository,
+                             assets, options):
+    options.max_stream_body_size = 1000
+    options.stream_chunk_size = 1
+    handler = make_stream_handler(content_type='application/json')
+
+    handler.prepare().result()
+    handler.data_received('{"not": "an array"}').result()
+
+    with pytest.raises(HTTPError) as exc:
+        handler.post('repo1').result()
+
+    assert exc.value.status_code == 400
+    assert not assets.onboard.called
+
+
+@patch('onboarding.controllers.repository_handler.options')
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_stream_content_length_too_large(exchange_delegate_token,
+                                         get_repository, assets, options):
+    options.max_post_body_size = 10
+    options.max_stream_body_size = 1000
+    handler = make_stream_handler()
+    handler.request.headers['Content-Length'] = '100'
+
+    handler.prepare().result()
+
+    handler.request.headers['Content-Length'] = '1001'
+    with pytest.raises(HTTPError) as exc:
+        handler.prepare().result()
+
+    assert exc.value.status_code == 400
+
+
+@patch('onboarding.controllers.repository_handler.options')
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_post_batched(exchange_delegate_token, get_repository, assets,
+                      options):
+    options.max_post_body_size = 100
+    assets.batches.return_value = ['data1', 'data2']
+    assets.onboard.return_value = make_future(([{'entity_id': '1'}], 200, []))
+    handler = make_handler()
+
+    handler.post('repo1').result()
+
+    assets.batches.assert_called_once_with('data', 'text/csv')
+    assert not assets.transform.called
+    assert assets.onboard.call_args[1]['transformed'] is None
+
+
+@patch('onboarding.controllers.repository_handler.jobs')
+@patch('onboarding.controllers.repository_handler.options')
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_post_async(exchange_delegate_token, get_repository, assets, options,
+                    jobs):
+    options.max_post_body_size = 100
+    job = {'id': 'job1', 'status': 'queued'}
+    jobs.get_queue.return_value.submit.return_value = job
+    assets.onboard.return_value = make_future(([{'entity_id': '1'}], 200, []))
+    handler = make_handler()
+    handler.get_argument = Mock(
+        side_effect=lambda name, default: 'true' if name == 'async' else None)
+    handler.request.path = '/v1/onboarding/repositories/repo1/assets'
+    handler.set_status = Mock()
+    handler.set_header = Mock()
+
+    handler.post('repo1').result()
+
+    assert not assets.transform.called
+    assert not assets.onboard.called
+    handler.set_status.assert_called_once_with(202)
+    handler.set_header.assert_called_once_with(
+        'Location', '/v1/onboarding/repositories/repo1/jobs/job1')
+    handler.finish.assert_called_once_with({'status': 202, 'data': job})
+
+    repository_id, work = jobs.get_queue.return_value.submit.call_args[0]
+    progress = Mock()
+    assert repository_id == 'repo1'
+    assert work(progress).result() == ([{'entity_id': '1'}], 200, [])
+    assets.onboard.assert_called_once_with(
+        'data', 'text/csv', 'https://localhost:8004', 'repo1',
+        token='delegated', r2rml_url=None, progress=progress,
+        local_transform=None)
+
+
+@patch('onboarding.controllers.repository_handler.jobs')
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_get_job(exchange_delegate_token, jobs):
+    job = {'id': 'job1', 'repository_id': 'repo1', 'status': 'running'}
+    jobs.get_queue.return_value.get.return_value = job
+    handler = JobHandler(MagicMock(), MagicMock())
+    handler.finish = MagicMock()
+    handler.request = Mock(headers={'Authorization': 'Bearer token1234'})
+
+    handler.get('repo1', 'job1').result()
+
+    exchange_delegate_token.assert_called_once_with('token1234', 'repo1')
+    jobs.get_queue.return_value.get.assert_called_once_with('job1')
+    handler.finish.assert_called_once_with({'status': 200, 'data': job})
+
+
+@pytest.mark.parametrize('job', [
+    None, {'id': 'job1', 'repository_id': 'repo2', 'status': 'running'}])
+@patch('onboarding.controllers.repository_handler.jobs')
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_get_job_not_found(exchange_delegate_token, jobs, job):
+    jobs.get_queue.return_value.get.return_value = job
+    handler = JobHandler(MagicMock(), MagicMock())
+    handler.request = Mock(headers={'Authorization': 'Bearer token1234'})
+
+    with pytest.raises(HTTPError) as exc:
+        handler.get('repo1', 'job1').result()
+
+    assert exc.value.status_code == 404
+
+
+def test_get_job_no_token():
+    handler = JobHandler(MagicMock(), MagicMock())
+    handler.request = Mock(headers={})
+
+    with pytest.raises(HTTPError) as exc:
+        handler.get('repo1', 'job1').result()
+
+    assert exc.value.status_code == 401
+
+
+@pytest.mark.parametrize('value,expected', [
+    (None, None), ('', None), ('true', True), ('1', True), ('false', False)])
+def test_local_transform(value, expected):
+    handler = make_handler()
+    handler.get_argument = Mock(return_value=value)
+
+    assert handler.local_transform() is expected
+    handler.get_argument.assert_called_once_with('local_transform', None)
+
+
+@patch('onboarding.controllers.repository_handler.options',
+       max_post_body_size=100, dedupe_by_content=False, onboard_result_ttl=60)
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_post_idempotency_key(exchange_delegate_token, get_repository, assets,
+                              options):
+    assets.batches.return_value = None
+    assets.onboard.return_value = make_future(([{'entity_id': '1'}], 200, []))
+    handlers = [make_handler(), make_handler()]
+    for handler in handlers:
+        handler.request.method = 'POST'
+        handler.request.headers['Idempotency-Key'] = 'key1'
+        handler.post('repo1').result()
+
+    assert assets.onboard.call_count == 1
+    assert assets.transform.call_count == 1
+    for handler in handlers:
+        handler.finish.assert_called_once_with(
+            {'status': 200, 'data': [{'entity_id': '1'}]})
+
+    handler = make_handler()
+    handler.request.headers['Idempotency-Key'] = 'key1'
+    handler.request.body = 'other data'
+    with pytest.raises(HTTPError) as exc:
+        handler.post('repo1').result()
+    assert exc.value.status_code == 422
+
+
+@patch('onboarding.controllers.repository_handler.options',
+       max_post_body_size=100, dedupe_by_content=True, onboard_result_ttl=60)
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+@gen_test
+def test_post_joins_identical_request(exchange_delegate_token, get_repository,
+                                      assets, options):
+    assets.batches.return_value = None
+    result = Future()
+    assets.onboard.return_value = result
+    first = make_handler()
+    second = make_handler()
+
+    first_post = first.post('repo1')
+    second_post = second.post('repo1')
+    result.set_result(([{'entity_id': '1'}], 200, []))
+    yield [first_post, second_post]
+
+    assert assets.onboard.call_count == 1
+    first.finish.assert_called_once_with(
+        {'status': 200, 'data': [{'entity_id': '1'}]})
+    second.finish.assert_called_once_with(
+        {'status': 200, 'data': [{'entity_id': '1'}]})
+
+    # different data is onboarded
+    third = make_handler()
+    third.request.body = 'other data'
+    assets.onboard.return_value = make_future(([], 200, []))
+    yield third.post('repo1')
+    assert assets.onboard.call_count == 2
+
+
+@patch('onboarding.controllers.repository_handler.options',
+       max_post_body_size=100, dedupe_by_content=True, onboard_result_ttl=60)
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_post_after_delete_onboards_again(exchange_delegate_token,
+                                          get_repository, assets, options):
+    assets.batches.return_value = None
+    assets.onboard.return_value = make_future(([{'entity_id': '1'}], 200, []))
+    assets.delete.return_value = make_future(([{'entity_id': '1'}], 200, []))
+
+    make_handler().post('repo1').result()
+    make_handler().delete('repo1').result()
+    make_handler().post('repo1').result()
+
+    # the result of the first request isn't returned for the assets that
+    # have been deleted since
+    assert assets.onboard.call_count == 2
+
+
+@patch('onboarding.controllers.repository_handler.options',
+       max_post_body_size=100, max_decoded_body_size=1000,
+       max_compression_ratio=100, dedupe_by_content=False)
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_post_compressed(exchange_delegate_token, get_repository, assets,
+                         options):
+    assets.batches.return_value = None
+    assets.onboard.return_value = make_future(([], 200, []))
+    handler = make_handler()
+    handler.request.body = compression.compress('a,b\n' * 100)
+    handler.request.headers['Content-Encoding'] = 'gzip'
+    handler.request.headers['Content-Length'] = str(len(handler.request.body))
+
+    handler.post('repo1').result()
+
+    assert assets.onboard.call_args[0][0] == 'a,b\n' * 100
+
+
+@patch('onboarding.controllers.repository_handler.options',
+       max_post_body_size=100, max_decoded_body_size=100,
+       max_compression_ratio=100)
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_post_compressed_too_large(exchange_delegate_token, get_repository,
+                                   assets, options):
+    handler = make_handler()
+    handler.request.body = compression.compress('a,b\n' * 100)
+    handler.request.headers['Content-Encoding'] = 'gzip'
+
+    with pytest.raises(HTTPError) as exc:
+        handler.post('repo1').result()
+
+    assert exc.value.status_code == 400
+    assert not assets.onboard.called
+
+
+@patch('onboarding.controllers.repository_handler.options',
+       max_post_body_size=100)
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_post_unsupported_encoding(exchange_delegate_token, get_repository,
+                                   assets, options):
+    handler = make_handler()
+    handler.request.headers['Content-Encoding'] = 'br'
+
+    with pytest.raises(HTTPError) as exc:
+        handler.post('repo1').result()
+
+    assert exc.value.status_code == 415
+    assert not assets.onboard.called
+
+
+@patch('onboarding.controllers.repository_handler.options',
+       max_stream_body_size=1000, max_compression_ratio=100,
+       stream_chunk_size=1)
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_stream_post_compressed(exchange_delegate_token, get_repository,
+                                assets, options):
+    assets.onboard.side_effect = lambda data, *args, **kwargs: make_future(
+        ([{'data': data}], 200, []))
+    handler = make_stream_handler()
+    handler.request.headers['Content-Encoding'] = 'gzip'
+    body = compression.compress('a,b\n1,2\n3,4')
+
+    handler.prepare().result()
+    handler.data_received(body[:10]).result()
+    handler.data_received(body[10:]).result()
+    handler.post('repo1').result()
+
+    handler.finish.assert_called_once_with({
+        'status': 200, 'data': {'count': 2}})
+
+
+@patch('onboarding.controllers.repository_handler.options',
+       max_post_body_size=100)
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_post_ndjson(exchange_delegate_token, get_repository, assets,
+                     options):
+    def onboard(*args, **kwargs):
+        kwargs['on_assets']([{'entity_id': '1'}, {'entity_id': '2'}])
+        kwargs['on_assets']([{'entity_id': '3'}])
+        return make_future(([], 400, [{'message': 'invalid', 'batch': 2}]))
+
+    assets.batches.return_value = ['data1', 'data2', 'data3']
+    assets.onboard.side_effect = onboard
+    handler = make_handler()
+    handler.request.headers['Accept'] = 'application/x-ndjson'
+    handler.write = Mock()
+    handler.flush = Mock(return_value=make_future(None))
+    handler.set_header = Mock()
+
+    handler.post('repo1').result()
+
+    handler.set_header.assert_called_with('Content-Type',
+                                          'application/x-ndjson')
+    assert [c[0][0] for c in handler.write.call_args_list] == [
+        '{"entity_id": "1"}\n{"entity_id": "2"}\n',
+        '{"entity_id": "3"}\n']
+    assert handler.flush.call_count == 2
+    assert json.loads(handler.finish.call_args[0][0]) == {
+        'status': 400, 'errors': [{'message': 'invalid', 'batch': 2}]}
+
+
+@patch('onboarding.controllers.repository_handler.options',
+       max_post_body_size=100)
+@patch('onboarding.controllers.repository_handler.assets')
+@patch('onboarding.controllers.repository_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+@patch('onboarding.controllers.repository_handler.exchange_delegate_token',
+       return_value=make_future('delegated'))
+def test_delete_ndjson_error_before_assets(exchange_delegate_token,
+                                           get_repository, assets, options):
+    errors = [{'message': 'invalid'}]
+    assets.batches.return_value = None
+    assets.delete.return_value = make_future((None, 400, errors))
+    handler = make_handler()
+    handler.request.headers['Accept'] = 'application/x-ndjson'
+
+    with pytest.raises(HTTPError) as exc:
+        handler.delete('repo1').result()
+
+    assert exc.value.status_code == 400
+    assert exc.value.errors == {'errors': errors, 'data': []}
+    assert 'on_assets' in assets.delete.call_args[1]
+
+
+@patch('onboarding.controllers.repository_handler.tracing.sink')
+@patch('onboarding.controllers.repository_handler.base.CorsHandler._execute')
+def test_execute_traces_request(_execute, sink):
+    def execute(*args, **kwargs):
+        # the request's span is current while the request is handled
+        assert tracing.current() is handler.span
+        return make_future(None)
+
+    _execute.side_effect = execute
+    handler = make_handler()
+    handler.request.method = 'POST'
+    handler.request.path = '/v1/onboarding/repositories/repo1/assets'
+    handler.request.headers['traceparent'] = (
+        '00-4bf92f3577b34da6a3ce929d0e0e4736-00f067aa0ba902b7-01')
+    handler.get_status = Mock(return_value=200)
+
+    handler._execute([], 'repo1').result()
+
+    span = sink.export.call_args[0][0]
+    assert span['trace_id'] == '4bf92f3577b34da6a3ce929d0e0e4736'
+    assert span['parent_id'] == '00f067aa0ba902b7'
+    assert span['name'] == 'assets'
+    assert span['attributes']['status'] == 200
+
+
+@patch('onboarding.controllers.repository_handler.resilience.requests',
+       resilience.InFlight(limit=1))
+def test_prepare_sheds_requests():
+    first = make_handler()
+    first.request.method = 'POST'
+    first.prepare()
+
+    second = make_handler()
+    second.request.method = 'DELETE'
+    with pytest.raises(resilience.Unavailable) as exc:
+        second.prepare()
+    assert exc.value.status_code == 503
+
+    first.on_finish()
+    second.prepare()
+    assert resilience.requests.count == 1
+
+
+@patch('onboarding.controllers.repository_handler.resilience.requests',
+       resilience.InFlight(limit=1))
+def test_prepare_does_not_count_options():
+    handler = make_handler()
+    handler.request.method = 'OPTIONS'
+    handler.prepare()
+    handler.on_finish()
+
+    assert resilience.requests.count == 0
+
+
+@patch('onboarding.controllers.repository_handler.metrics')
+def test_on_finish_counts_response_bytes(metrics):
+    handler = make_handler()
+    handler.request.method = 'POST'
+    handler._transforms = []
+    handler.write('{"a": 1}\n')
+    handler.flush()
+    handler.write('{"status": 200}\n')
+    handler.flush()
+
+    handler.on_finish()
+
+    metrics.RESPONSE_BYTES.inc.assert_called_once_with(25, method='POST')
+
+
+def test_prepare_invalid_priority():
+    handler = make_handler()
+    handler.request.method = 'POST'
+    handler.request.headers['X-Priority'] = 'urgent'
+
+    with pytest.raises(HTTPError) as exc:
+        handler.prepare()
+
+    assert exc.value.status_code == 400
+    assert not handler.in_flight
+
+
+def test_share():
+    handler = make_handler()
+    handler.request.headers['X-Priority'] = ' High'
+
+    share = handler.share('repo1')
+
+    assert share.key == ('repo1', 'high')
+
+
+@patch.object(scheduler, 'share_by', 'caller')
+def test_share_by_caller():
+    payload = base64.urlsafe_b64encode(json.dumps({'sub': 'client1'}))
+    handler = make_handler(
+        authorization='Bearer header.{}.signature'.format(payload))
+
+    share = handler.share('repo1')
+
+    assert share.key == ('client1', 'normal')
+
+
+def test_stream_data_received_in_share():
+    handler = make_stream_handler()
+    handler._share = scheduler.Share('repo1', 'low')
+    shares = []
+    handler.receive = lambda chunk: shares.append(scheduler.current())
+
+    handler.data_received('a,b\n')
+
+    assert shares == [handler._share]
+    assert scheduler.current() is scheduler.DEFAULT_SHARE
+
+
+@patch('onboarding.controllers.repository_handler.base.JsonHandler.write_error')
+def test_write_error_retry_after(write_error):
+    handler = make_handler()
+    handler.set_header = Mock()
+    exc = resilience.Unavailable('Too many requests', 2.5)
+
+    handler.write_error(503, exc_info=(type(exc), exc, None))
+
+    handler.set_header.assert_called_once_with('Retry-After', 3)
+    write_error.assert_called_once_with(503, exc_info=(type(exc), exc, None))
+
+
+@patch('onboarding.controllers.repository_handler.resilience.retry_after', 7)
+@patch('onboarding.controllers.repository_handler.base.JsonHandler.write_error')
+def test_write_error_default_retry_after(write_error):
+    handler = make_handler()
+    handler.set_header = Mock()
+    exc = HTTPError(503, {'errors': [], 'data': []})
+
+    handler.write_error(503, exc_info=(type(exc), exc, None))
+
+    handler.set_header.assert_called_once_with('Retry-After', 7)
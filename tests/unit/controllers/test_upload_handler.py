@@ -0,0 +1,294 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import json
+import os
+import shutil
+import tempfile
+
+import pytest
+from mock import MagicMock, Mock, patch
+from tornado.concurrent import Future
+from koi.exceptions import HTTPError
+from koi.test_helpers import make_future
+
+from onboarding.controllers.upload_handler import (UploadsHandler,
+                                                   UploadHandler,
+                                                   UploadChunkHandler)
+from onboarding.models import uploads
+from onboarding.models.uploads import UploadStore, checksum
+
+REPOSITORY = {'id': 'repo1', 'service': {'location': 'https://localhost:8004'}}
+
+
+@pytest.fixture
+def store(request):
+    directory = tempfile.mkdtemp()
+    patcher = patch.object(uploads, 'store', UploadStore(directory))
+    patcher.start()
+
+    def remove():
+        patcher.stop()
+        shutil.rmtree(directory)
+
+    request.addfinalizer(remove)
+    return uploads.store
+
+
+def make_error(status_code):
+    future = Future()
+    future.set_exception(HTTPError(status_code, 'error'))
+    return future
+
+
+def make_handler(cls, body='', content_type='application/json', headers=None):
+    handler = cls(MagicMock(), MagicMock())
+    handler.finish = MagicMock()
+    handler.write = MagicMock()
+    handler.flush = Mock(return_value=make_future(None))
+    handler.get_argument = Mock(return_value=None)
+    handler.get_token = Mock(return_value=make_future('delegated'))
+    handler.request = Mock(body=body, path='/v1/onboarding/repositories/repo1'
+                                           '/uploads', headers=dict(
+        {'Content-Type': content_type, 'Authorization': 'Bearer token1234'},
+        **(headers or {})))
+    return handler
+
+
+def add_chunks(store, upload, *chunks):
+    for number, data in enumerate(chunks, 1):
+        store.put_chunk(upload['id'], number, data, checksum(data))
+
+
+def test_create(store):
+    handler = make_handler(UploadsHandler,
+                           json.dumps({'content_type': 'text/csv'}))
+    handler.set_header = Mock()
+
+    handler.post('repo1').result()
+
+    handler.get_token.assert_called_once_with('repo1')
+    response = handler.finish.call_args[0][0]
+    assert response['status'] == 201
+    upload = response['data']
+    assert upload['repository_id'] == 'repo1'
+    assert upload['content_type'] == 'text/csv'
+    assert upload['chunks'] == []
+    assert store.get(upload['id'])
+    handler.set_header.assert_called_once_with(
+        'Location',
+        '/v1/onboarding/repositories/repo1/uploads/{}'.format(upload['id']))
+
+
+def test_create_invalid_content_type(store):
+    handler = make_handler(UploadsHandler,
+                           json.dumps({'content_type': 'text/plain'}))
+
+    with pytest.raises(HTTPError) as exc:
+        handler.post('repo1').result()
+
+    assert exc.value.status_code == 415
+
+
+def test_create_unauthorized(store):
+    handler = make_handler(UploadsHandler,
+                           json.dumps({'content_type': 'text/csv'}))
+    handler.get_token.return_value = make_error(403)
+
+    with pytest.raises(HTTPError) as exc:
+        handler.post('repo1').result()
+
+    assert exc.value.status_code == 403
+    assert os.listdir(store.directory) == []
+
+
+def test_get(store):
+    upload = store.create('repo1', 'text/csv')
+    add_chunks(store, upload, 'a\n', 'b\n')
+    handler = make_handler(UploadHandler)
+
+    handler.get('repo1', upload['id']).result()
+
+    handler.finish.assert_called_once_with({
+        'status': 200, 'data': dict(upload, chunks=[1, 2])})
+
+
+def test_get_other_repository(store):
+    upload = store.create('repo2', 'text/csv')
+    handler = make_handler(UploadHandler)
+
+    with pytest.raises(HTTPError) as exc:
+        handler.get('repo1', upload['id']).result()
+
+    assert exc.value.status_code == 404
+
+
+def test_put_chunk(store):
+    upload = store.create('repo1', 'text/csv')
+    handler = make_handler(UploadChunkHandler, 'a\n', 'text/csv', {
+        'X-Content-SHA256': checksum('a\n')})
+
+    handler.put('repo1', upload['id'], '1').result()
+
+    assert store.chunks(upload['id']) == [1]
+    handler.finish.assert_called_once_with({
+        'status': 200, 'data': dict(upload, chunks=[1])})
+
+
+def test_put_chunk_without_checksum(store):
+    upload = store.create('repo1', 'text/csv')
+    handler = make_handler(UploadChunkHandler, 'a\n', 'text/csv')
+
+    with pytest.raises(HTTPError) as exc:
+        handler.put('repo1', upload['id'], '1').result()
+
+    assert exc.value.status_code == 400
+    assert store.chunks(upload['id']) == []
+
+
+def test_put_chunk_checksum_mismatch(store):
+    upload = store.create('repo1', 'text/csv')
+    handler = make_handler(UploadChunkHandler, 'a\n', 'text/csv', {
+        'X-Content-SHA256': checksum('b\n')})
+
+    with pytest.raises(HTTPError) as exc:
+        handler.put('repo1', upload['id'], '1').result()
+
+    assert exc.value.status_code == 400
+    assert store.chunks(upload['id']) == []
+
+
+def test_put_chunk_invalid_number(store):
+    upload = store.create('repo1', 'text/csv')
+    handler = make_handler(UploadChunkHandler, 'a\n', 'text/csv', {
+        'X-Content-SHA256': checksum('a\n')})
+
+    with pytest.raises(HTTPError) as exc:
+        handler.put('repo1', upload['id'], 'one').result()
+
+    assert exc.value.status_code == 400
+
+
+@patch('onboarding.controllers.upload_handler.options', stream_chunk_size=1)
+@patch('onboarding.controllers.upload_handler.assets')
+@patch('onboarding.controllers.upload_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+def test_commit(get_repository, assets, options, store):
+    assets.onboard.side_effect = lambda data, *args, **kwargs: make_future(
+        ([{'data': data}], 200, []))
+    upload = store.create('repo1', 'text/csv', local_transform=True)
+    # records are split across chunks
+    add_chunks(store, upload, 'a,b\n1,', '2\n3,4')
+    handler = make_handler(UploadHandler, json.dumps({'chunks': 2}))
+
+    handler.post('repo1', upload['id']).result()
+
+    assert assets.onboard.call_count == 2
+    assets.onboard.assert_any_call(
+        'a,b\n1,2\n', 'text/csv', 'https://localhost:8004', 'repo1',
+        token='delegated', r2rml_url=None, local_transform=True)
+    assert handler.write.call_args_list[0][0][0] == json.dumps(
+        {'data': 'a,b\n1,2\n'}) + '\n'
+    handler.finish.assert_called_once_with('{"status": 200}\n')
+    # the upload is removed once onboarded
+    assert store.get(upload['id']) is None
+
+
+@patch('onboarding.controllers.upload_handler.options', stream_chunk_size=1)
+@patch('onboarding.controllers.upload_handler.assets')
+@patch('onboarding.controllers.upload_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+def test_commit_errors(get_repository, assets, options, store):
+    errors = [{'message': 'error'}]
+    assets.onboard.side_effect = [
+        make_future(([{'data': 1}], 200, [])),
+        make_future(([], 500, errors))]
+    upload = store.create('repo1', 'text/csv')
+    add_chunks(store, upload, 'a,b\n1,2\n3,4\n5,6')
+    handler = make_handler(UploadHandler, json.dumps({'chunks': 1}))
+
+    handler.post('repo1', upload['id']).result()
+
+    # processing stops at the first batch that fails
+    assert assets.onboard.call_count == 2
+    handler.finish.assert_called_once_with(
+        json.dumps({'status': 500, 'errors': errors}) + '\n')
+    # the upload can be committed again
+    assert store.get(upload['id'])
+    assert store.lock(upload['id'])
+
+
+@patch('onboarding.controllers.upload_handler.options', stream_chunk_size=1)
+@patch('onboarding.controllers.upload_handler.assets')
+@patch('onboarding.controllers.upload_handler.get_repository',
+       return_value=make_future(REPOSITORY))
+def test_commit_fails_before_any_asset(get_repository, assets, options,
+                                       store):
+    errors = [{'message': 'error'}]
+    assets.onboard.return_value = make_future(([], 400, errors))
+    upload = store.create('repo1', 'text/csv')
+    add_chunks(store, upload, 'a,b\n1,2\n')
+    handler = make_handler(UploadHandler, json.dumps({'chunks': 1}))
+
+    with pytest.raises(HTTPError) as exc:
+        handler.post('repo1', upload['id']).result()
+
+    assert exc.value.status_code == 400
+    assert exc.value.errors == {'errors': errors, 'data': []}
+    assert store.lock(upload['id'])
+
+
+@patch('onboarding.controllers.upload_handler.assets')
+def test_commit_missing_chunks(assets, store):
+    upload = store.create('repo1', 'text/csv')
+    store.put_chunk(upload['id'], 2, 'b\n', checksum('b\n'))
+    handler = make_handler(UploadHandler, json.dumps({'chunks': 3}))
+
+    with pytest.raises(HTTPError) as exc:
+        handler.post('repo1', upload['id']).result()
+
+    assert exc.value.status_code == 409
+    assert 'Chunks 1, 3 have not been received' in str(exc.value.errors)
+    assert not assets.onboard.called
+
+
+@patch('onboarding.controllers.upload_handler.assets')
+def test_commit_already_committing(assets, store):
+    upload = store.create('repo1', 'text/csv')
+    add_chunks(store, upload, 'a\n')
+    store.lock(upload['id'])
+    handler = make_handler(UploadHandler, json.dumps({'chunks': 1}))
+
+    with pytest.raises(HTTPError) as exc:
+        handler.post('repo1', upload['id']).result()
+
+    assert exc.value.status_code == 409
+    assert not assets.onboard.called
+
+
+@pytest.mark.parametrize('body', [{}, {'chunks': 0}, {'chunks': '2'}])
+def test_commit_invalid_chunks(body, store):
+    upload = store.create('repo1', 'text/csv')
+    handler = make_handler(UploadHandler, json.dumps(body))
+
+    with pytest.raises(HTTPError) as exc:
+        handler.post('repo1', upload['id']).result()
+
+    assert exc.value.status_code == 400
+
+
+def test_delete(store):
+    upload = store.create('repo1', 'text/csv')
+    add_chunks(store, upload, 'a\n')
+    handler = make_handler(UploadHandler)
+
+    handler.delete('repo1', upload['id']).result()
+
+    handler.finish.assert_called_once_with({'status': 200})
+    assert store.get(upload['id']) is None
@@ -9,8 +9,13 @@
 
 import os
 
+import pytest
 from mock import patch
+from tornado.concurrent import Future
+from tornado.gen import moment
+from koi.test_helpers import make_future, gen_test
 
+from onboarding.models import assets, mapping
 from onboarding.models.assets import generate_idmap
 
 
@@ -32,3 +37,362 @@ def test_generate_idmap(options):
 
     new_id_map = generate_idmap(SAMPLE_DATA, repository_id)
     assert len(new_id_map)
+
+
+def source_ids(id_map):
+    return {item['entity_id']: sorted((s['source_id_type'], s['source_id'])
+                                      for s in item['source_ids'])
+            for item in id_map}
+
+
+@patch('onboarding.models.assets.options', hub_id='hub1', local_transform=False,
+       default_resolver_id='openpermissions.org')
+def test_generate_idmap_content(options):
+    id_map = generate_idmap({'data': {'rdf_n3': TRIPLES.decode('utf-8')}},
+                            '2e9ce79cfa710e80878920c98e076aa9')
+
+    assert source_ids(id_map) == {
+        'b197b469dafc46848f1e1cb50c53f68b': [('testcopictureid', '100123')],
+        'a2719dc7f1ef42cc966e48609e50acb0': [('examplecopictureid', '999002'),
+                                             ('testcopictureid', '100456')],
+        'bfa853aea878469085ee51b4a9cfccdc': [('testcopictureid', '200123')],
+        '5417cd184450490584fd7236dae9a17a': [('examplecopictureid', '998002'),
+                                             ('testcopictureid', '200456')]
+    }
+    # in the order of the document
+    assert [item['entity_id'] for item in id_map] == [
+        'b197b469dafc46848f1e1cb50c53f68b', 'a2719dc7f1ef42cc966e48609e50acb0',
+        'bfa853aea878469085ee51b4a9cfccdc', '5417cd184450490584fd7236dae9a17a']
+    assert id_map[0]['hub_key'] == (
+        'https://openpermissions.org/s1/hub1/2e9ce79cfa710e80878920c98e076aa9'
+        '/asset/b197b469dafc46848f1e1cb50c53f68b')
+    assert id_map[0]['entity_type'] == 'asset'
+
+
+@patch('onboarding.models.assets.options', hub_id='hub1', local_transform=False,
+       default_resolver_id='openpermissions.org')
+def test_generate_idmap_only_reads_rdf_n3(options):
+    data = {'data': {'rdf_n3': TRIPLES, 'rdf_xml': 'not triples'}}
+
+    id_map = generate_idmap(data, '2e9ce79cfa710e80878920c98e076aa9')
+
+    assert len(id_map) == 4
+
+
+@patch('onboarding.models.assets.options', hub_id='hub1', local_transform=False,
+       default_resolver_id='openpermissions.org')
+def test_generate_idmap_blocks(options):
+    triples = (
+        '<http://openpermissions.org/ns/id/0a> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://openpermissions.org/ns/op/1.1/Asset> .\n'
+        '_:n1 <http://openpermissions.org/ns/op/1.1/value> "100123" .\n'
+        '_:n1 <http://openpermissions.org/ns/op/1.1/id_type> <http://openpermissions.org/ns/hub/testid> .\n'
+        '_:n2 <http://openpermissions.org/ns/op/1.1/value> "no type" .\n'
+        '\n\n  \n'
+        '<http://openpermissions.org/ns/id/0b> <http://purl.org/dc/terms/description> "no asset" .\n'
+        '\n'
+        '<http://openpermissions.org/ns/id/0c> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://openpermissions.org/ns/op/1.1/Asset> .'
+    )
+
+    id_map = generate_idmap({'data': {'rdf_n3': triples}},
+                            '2e9ce79cfa710e80878920c98e076aa9')
+
+    assert source_ids(id_map) == {
+        '0a': [('testid', '100123')],
+        '0c': []
+    }
+
+
+@patch('onboarding.models.assets.options', hub_id='hub1', local_transform=False,
+       default_resolver_id='openpermissions.org')
+def test_generate_idmap_escaped_source_id(options):
+    triples = (
+        '<http://openpermissions.org/ns/id/0a> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://openpermissions.org/ns/op/1.1/Asset> .\n'
+        '_:n1 <http://openpermissions.org/ns/op/1.1/value> "say \\"cheese\\" \\\\" .\n'
+        '_:n1 <http://openpermissions.org/ns/op/1.1/id_type> <http://openpermissions.org/ns/hub/testid> .\n'
+    )
+
+    id_map = generate_idmap({'data': {'rdf_n3': triples}},
+                            '2e9ce79cfa710e80878920c98e076aa9')
+
+    assert source_ids(id_map) == {
+        '0a': [('testid', 'say \\"cheese\\" \\\\')]
+    }
+
+
+CSV ='id,name\n1,a\n2,b\n3,c\n'
+
+
+def transformed(data, status=200, errors=None):
+    return make_future(({'data': {'rdf_n3': data, 'id_map': [{'data': data}]}},
+                        status, errors or []))
+
+
+@patch('onboarding.models.assets.options', batch_size=0)
+def test_batches_disabled(options):
+    assert assets.batches(CSV, 'text/csv') is None
+
+
+@patch('onboarding.models.assets.options', batch_size=1000)
+def test_batches_small_data(options):
+    assert assets.batches(CSV, 'text/csv') is None
+
+
+@patch('onboarding.models.assets.options', batch_size=4, batch_records=0)
+def test_batches(options):
+    assert assets.batches(CSV, 'text/csv') == [
+        'id,name\n1,a\n', 'id,name\n2,b\n', 'id,name\n3,c\n']
+
+
+@patch('onboarding.models.assets.options', batch_size=4, batch_records=0)
+def test_batches_invalid_json(options):
+    assert assets.batches('{"a": "not an array"}', 'application/json') is None
+
+
+@patch('onboarding.models.assets.remote')
+@patch('onboarding.models.assets.options', batch_size=4, batch_records=0,
+       local_transform=False,
+       max_concurrent_transforms=2, max_concurrent_stores=2)
+def test_onboard_batches(options, remote):
+    remote.transform.side_effect = lambda data, *args: transformed(data)
+    remote.store.return_value = make_future((200, []))
+
+    result = assets.onboard(CSV, 'text/csv', 'https://repo', 'repo1',
+                            token='token').result()
+
+    assert remote.transform.call_count == 3
+    assert remote.store.call_count == 3
+    assert result == ([{'data': 'id,name\n1,a\n'},
+                       {'data': 'id,name\n2,b\n'},
+                       {'data': 'id,name\n3,c\n'}], 200, [])
+
+
+@patch('onboarding.models.assets.remote')
+@patch('onboarding.models.assets.options', batch_size=4, batch_records=0,
+       local_transform=False,
+       max_concurrent_transforms=2, max_concurrent_stores=2)
+def test_onboard_batches_on_assets(options, remote):
+    def transform(data, *args):
+        if '2,b' in data:
+            return transformed(data, 400, [{'message': 'invalid'}])
+        return transformed(data)
+
+    remote.transform.side_effect = transform
+    remote.store.return_value = make_future((200, []))
+    received = []
+
+    data, status, errors = assets.onboard(
+        CSV, 'text/csv', 'https://repo', 'repo1',
+        on_assets=received.append).result()
+
+    assert data == []
+    assert status == 400
+    assert errors == [{'message': 'invalid', 'batch': 1}]
+    assert sorted(received) == [[{'data': 'id,name\n1,a\n'}],
+                                [{'data': 'id,name\n3,c\n'}]]
+
+
+@patch('onboarding.models.assets.remote')
+@patch('onboarding.models.assets.options', batch_size=0, local_transform=False)
+def test_onboard_on_assets(options, remote):
+    remote.transform.return_value = transformed('data')
+    remote.store.return_value = make_future((200, []))
+    received = []
+
+    result = assets.onboard('data', 'text/csv', 'https://repo', 'repo1',
+                            on_assets=received.append).result()
+
+    assert result == ([], 200, [])
+    assert received == [[{'data': 'data'}]]
+
+
+@patch('onboarding.models.assets.remote')
+@patch('onboarding.models.assets.options', batch_size=4, batch_records=0,
+       local_transform=False,
+       max_concurrent_transforms=2, max_concurrent_stores=2)
+def test_onboard_batch_errors(options, remote):
+    def transform(data, *args):
+        if '2,b' in data:
+            return transformed(data, 400, [{'message': 'invalid'}])
+        return transformed(data)
+
+    remote.transform.side_effect = transform
+    remote.store.side_effect = [make_future((200, [])),
+                                make_future((500, [{'message': 'down'}]))]
+
+    data, status, errors = assets.onboard(
+        CSV, 'text/csv', 'https://repo', 'repo1').result()
+
+    assert data == [{'data': 'id,name\n1,a\n'}]
+    assert status == 400
+    assert errors == [{'message': 'invalid', 'batch': 1},
+                      {'message': 'down', 'batch': 2}]
+
+
+@patch('onboarding.models.assets.remote')
+@patch('onboarding.models.assets.options', batch_size=4, batch_records=0,
+       local_transform=False,
+       max_concurrent_transforms=1, max_concurrent_stores=1)
+@gen_test
+def test_onboard_batches_pipelined(options, remote):
+    transforms = []
+    stores = []
+
+    def transform(data, *args):
+        transforms.append(Future())
+        return transforms[-1]
+
+    def store(*args, **kwargs):
+        stores.append(Future())
+        return stores[-1]
+
+    remote.transform.side_effect = transform
+    remote.store.side_effect = store
+
+    result = assets.onboard(CSV, 'text/csv', 'https://repo', 'repo1')
+    yield moment
+    assert len(transforms) == 1
+
+    transforms[0].set_result(transformed('1').result())
+    for _ in range(5):
+        yield moment
+    # the second batch is transformed while the first is stored
+    assert len(transforms) == 2
+    assert len(stores) == 1
+
+    transforms[1].set_result(transformed('2').result())
+    for _ in range(5):
+        yield moment
+    # only one store at a time
+    assert len(transforms) == 3
+    assert len(stores) == 1
+
+    transforms[2].set_result(transformed('3').result())
+    for _ in range(3):
+        stores[-1].set_result((200, []))
+        for _ in range(5):
+            yield moment
+
+    data, status, errors = yield result
+    assert [item['data'] for item in data] == ['1', '2', '3']
+    assert status == 200
+
+
+@patch('onboarding.models.assets.remote')
+@patch('onboarding.models.assets.options', batch_size=4, batch_records=0,
+       local_transform=False,
+       max_concurrent_transforms=2, max_concurrent_stores=2)
+def test_delete_batches(options, remote):
+    remote.transform.side_effect = lambda data, *args: make_future((
+        {'data': {'rdf_n3': data,
+                  'id_map': [{'entity_id': 'e', 'hub_key': 'h',
+                              'source_ids': [data]}]}},
+        200, []))
+    remote.delete.return_value = make_future((200, []))
+
+    data, status, errors = assets.delete(
+        CSV, 'text/csv', 'https://repo', 'repo1').result()
+
+    assert remote.delete.call_count == 3
+    assert not remote.store.called
+    # the merged id map is cleaned once, as when the data isn't batched
+    assert data == [{'source_ids': ['id,name\n1,a\n']},
+                    {'entity_id': 'e', 'hub_key': 'h',
+                     'source_ids': ['id,name\n2,b\n']},
+                    {'entity_id': 'e', 'hub_key': 'h',
+                     'source_ids': ['id,name\n3,c\n']}]
+
+
+@patch('onboarding.models.assets.remote')
+@patch('onboarding.models.assets.options', batch_size=4, batch_records=0,
+       local_transform=False,
+       max_concurrent_transforms=2, max_concurrent_stores=2)
+def test_delete_batches_on_assets(options, remote):
+    remote.transform.side_effect = lambda data, *args: make_future((
+        {'data': {'rdf_n3': data,
+                  'id_map': [{'entity_id': 'e', 'hub_key': 'h',
+                              'source_ids': [data]}]}},
+        200, []))
+    remote.delete.return_value = make_future((200, []))
+    sent = []
+
+    data, status, errors = assets.delete(
+        CSV, 'text/csv', 'https://repo', 'repo1',
+        on_assets=sent.extend).result()
+
+    assert data == []
+    assert sent == [{'source_ids': ['id,name\n1,a\n']},
+                    {'entity_id': 'e', 'hub_key': 'h',
+                     'source_ids': ['id,name\n2,b\n']},
+                    {'entity_id': 'e', 'hub_key': 'h',
+                     'source_ids': ['id,name\n3,c\n']}]
+
+
+@patch('onboarding.models.assets.executor')
+@patch('onboarding.models.assets.remote')
+@patch('onboarding.models.assets.options', hub_id='hub1', local_transform=False,
+       default_resolver_id='openpermissions.org')
+def test_transform_generates_idmap_in_executor(options, remote, executor):
+    remote.transform.return_value = make_future(
+        ({'data': {'rdf_n3': TRIPLES}}, 200, []))
+    executor.run.return_value = make_future([{'entity_id': '1'}])
+
+    result = assets.transform('data', 'text/csv',
+                              '2e9ce79cfa710e80878920c98e076aa9').result()
+
+    assert result[0]['data']['id_map'] == [{'entity_id': '1'}]
+    executor.run.assert_called_once_with(
+        len(TRIPLES), assets.idmap_from_triples, [TRIPLES],
+        '2e9ce79cfa710e80878920c98e076aa9', 'openpermissions.org', 'hub1')
+
+
+@pytest.mark.parametrize('r2rml_url,local_transform,option,expected', [
+    (None, None, False, False),
+    (None, None, True, True),
+    (None, True, False, True),
+    (None, False, True, False),
+    ('http://mapping', True, True, False),
+])
+def test_use_local_transform(r2rml_url, local_transform, option, expected):
+    with patch('onboarding.models.assets.options', local_transform=option):
+        assert assets.use_local_transform(r2rml_url,
+                                          local_transform) is expected
+
+
+@patch('onboarding.models.assets.executor')
+@patch('onboarding.models.assets.remote')
+@patch('onboarding.models.assets.options', hub_id='hub1', local_transform=True,
+       default_resolver_id='openpermissions.org')
+def test_transform_local(options, remote, executor):
+    transformed = ({'data': {'rdf_n3': '', 'id_map': []}}, 200, [])
+    executor.run.return_value = make_future(transformed)
+
+    result = assets.transform('data', 'text/csv',
+                              '2e9ce79cfa710e80878920c98e076aa9').result()
+
+    assert result == transformed
+    assert not remote.transform.called
+    executor.run.assert_called_once_with(
+        4, mapping.transform, 'data', 'text/csv',
+        '2e9ce79cfa710e80878920c98e076aa9', 'openpermissions.org', 'hub1')
+
+
+@patch('onboarding.models.assets.executor')
+@patch('onboarding.models.assets.remote')
+@patch('onboarding.models.assets.options', local_transform=False,
+       default_resolver_id='openpermissions.org', hub_id='hub1')
+def test_transform_shared_response(options, remote, executor):
+    def run(size, func, values, repository_id, *args):
+        return make_future([{'repository_id': repository_id}])
+
+    executor.run.side_effect = run
+    response = make_future(({'data': {'rdf_n3': TRIPLES}}, 200, []))
+
+    first = assets.transform('data', 'text/csv', 'repo1',
+                             response=response).result()
+    second = assets.transform('data', 'text/csv', 'repo2',
+                              response=response).result()
+
+    assert not remote.transform.called
+    assert first[0]['data']['id_map'] == [{'repository_id': 'repo1'}]
+    assert second[0]['data']['id_map'] == [{'repository_id': 'repo2'}]
+    assert 'id_map' not in response.result()[0]['data']
@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+from mock import Mock, patch
+
+import pytest
+from tornado.concurrent import Future
+from koi.test_helpers import make_future, gen_test
+
+from onboarding.models.cache import LRUCache, SpillCache, CACHES, stats
+
+
+def test_get_missing():
+    cache = LRUCache('test', max_size=2)
+
+    assert cache.get('a') is None
+    assert cache.stats()['misses'] == 1
+
+
+def test_set_and_get():
+    cache = LRUCache('test', max_size=2)
+    cache.set('a', 1)
+
+    assert cache.get('a') == 1
+    assert cache.stats()['hits'] == 1
+
+
+def test_evicts_least_recently_used():
+    cache = LRUCache('test', max_size=2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+
+    assert 'a' in cache
+    assert 'b' not in cache
+    assert 'c' in cache
+
+
+@patch.object(LRUCache, '_now')
+def test_entry_expires(now):
+    cache = LRUCache('test', ttl=10)
+    now.return_value = 100
+    cache.set('a', 1)
+
+    now.return_value = 109
+    assert cache.get('a') == 1
+
+    now.return_value = 110
+    assert cache.get('a') is None
+
+
+def test_set_non_positive_ttl_not_cached():
+    cache = LRUCache('test')
+    cache.set('a', 1, ttl=0)
+
+    assert 'a' not in cache
+
+
+def test_invalidate_and_clear():
+    cache = LRUCache('test')
+    cache.set('a', 1)
+    cache.set('b', 2)
+
+    cache.invalidate('a')
+    assert 'a' not in cache
+    assert 'b' in cache
+
+    cache.clear()
+    assert len(cache) == 0
+
+
+def test_get_or_fetch_caches_result():
+    cache = LRUCache('test')
+    fetch = Mock(return_value=make_future(('value', 60)))
+
+    assert cache.get_or_fetch('a', fetch).result() == 'value'
+    assert cache.get_or_fetch('a', fetch).result() == 'value'
+    assert fetch.call_count == 1
+
+
+@gen_test
+def test_get_or_fetch_shares_pending_fetch():
+    cache = LRUCache('test')
+    future = Future()
+    fetch = Mock(return_value=future)
+
+    first = cache.get_or_fetch('a', fetch)
+    second = cache.get_or_fetch('a', fetch)
+    assert cache.stats()['pending'] == 1
+
+    future.set_result(('value', 60))
+
+    assert (yield first) == 'value'
+    assert (yield second) == 'value'
+    assert fetch.call_count == 1
+    assert cache.stats()['pending'] == 0
+
+
+def test_get_or_fetch_does_not_cache_errors():
+    cache = LRUCache('test')
+    future = Future()
+    future.set_exception(ValueError())
+    fetch = Mock(return_value=future)
+
+    with pytest.raises(ValueError):
+        cache.get_or_fetch('a', fetch).result()
+
+    assert 'a' not in cache
+    assert cache.stats()['pending'] == 0
+
+
+def test_stats():
+    cache = LRUCache('test_stats')
+
+    assert CACHES['test_stats'] is cache
+    assert stats()['test_stats'] == cache.stats()
+
+
+def test_spill_cache_spills_evicted_entries(tmpdir):
+    cache = SpillCache('test', max_size=1, directory=str(tmpdir))
+    cache.set('a', {'value': 1})
+    cache.set('b', {'value': 2})
+
+    assert 'a' not in cache
+    assert cache.stats()['files'] == 1
+
+    assert cache.get('a') == {'value': 1}
+    assert cache.stats()['hits'] == 1
+    # b is spilled in turn
+    assert cache.stats()['files'] == 1
+    assert cache.get('b') == {'value': 2}
+
+
+def test_spill_cache_without_directory():
+    cache = SpillCache('test', max_size=1)
+    cache.set('a', 1)
+    cache.set('b', 2)
+
+    assert cache.get('a') is None
+    assert cache.stats()['files'] == 0
+
+
+@patch.object(LRUCache, '_now')
+def test_spill_cache_spilled_entry_expires(now, tmpdir):
+    cache = SpillCache('test', max_size=1, ttl=10, directory=str(tmpdir))
+    now.return_value = 100
+    cache.set('a', 1)
+    cache.set('b', 2)
+
+    now.return_value = 110
+    assert cache.get('a') is None
+    assert cache.stats()['files'] == 0
+
+
+def test_spill_cache_max_files(tmpdir):
+    cache = SpillCache('test', max_size=1, directory=str(tmpdir), max_files=2)
+    for key in 'abcde':
+        cache.set(key, 1)
+
+    assert cache.stats()['files'] == 2
+
+
+def test_spill_cache_clear(tmpdir):
+    cache = SpillCache('test', max_size=1, directory=str(tmpdir))
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.set('c', 3)
+
+    cache.invalidate('a')
+    assert cache.get('a') is None
+    assert cache.stats()['files'] == 1
+
+    cache.clear()
+    assert cache.get('b') is None
+    assert cache.stats()['files'] == 0
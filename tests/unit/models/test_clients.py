@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+from mock import Mock, patch
+
+import pytest
+from tornado import httpclient
+from tornado.concurrent import Future
+from koi.test_helpers import make_future
+
+from onboarding.models import clients, metrics, tracing
+
+
+@patch('onboarding.models.clients.tracing.client_class')
+@patch('onboarding.models.clients.curl_available', return_value=True)
+@patch('onboarding.models.clients.httpclient.AsyncHTTPClient')
+@patch('onboarding.models.clients.options')
+def test_configure_curl(options, AsyncHTTPClient, curl_available,
+                        client_class):
+    options.http_use_curl = True
+    options.http_max_clients = 20
+
+    clients.configure()
+
+    client_class.assert_called_once_with(clients.CURL_CLIENT)
+    AsyncHTTPClient.configure.assert_called_once_with(
+        client_class.return_value, max_clients=20)
+
+
+@patch('onboarding.models.clients.curl_available', return_value=False)
+@patch('onboarding.models.clients.httpclient.AsyncHTTPClient')
+@patch('onboarding.models.clients.options')
+def test_configure_curl_not_available(options, AsyncHTTPClient, curl_available):
+    options.http_use_curl = True
+    options.http_max_clients = 20
+
+    clients.configure()
+
+    AsyncHTTPClient.configure.assert_called_once_with(
+        tracing.client_class(), max_clients=20)
+
+
+@patch('onboarding.models.clients.use_curl', return_value=False)
+@patch('onboarding.models.clients.options')
+def test_get_client_shared_per_host(options, use_curl):
+    options.http_max_clients = 5
+    clients._clients.clear()
+
+    first = clients.get_client('https://localhost:8004/v1/repository')
+    second = clients.get_client('https://localhost:8004')
+    other = clients.get_client('https://localhost:8005')
+
+    assert first is second
+    assert first is not other
+    assert first.stats.max_clients == 5
+    clients._clients.clear()
+
+
+@patch('onboarding.models.clients.use_curl', return_value=True)
+@patch('onboarding.models.clients.options')
+def test_request_defaults_curl(options, use_curl):
+    options.ssl_cert_reqs = 0
+
+    defaults = clients.request_defaults()
+
+    assert defaults['ca_certs'] == options.ssl_ca_cert
+    assert defaults['validate_cert'] is False
+    assert 'ssl_options' not in defaults
+
+
+def test_instrumented_client_records_response():
+    response = Mock(time_info={'connect': 0.1, 'appconnect': 0.3},
+                    request_time=0.5, code=200, body='abc')
+    client = clients.InstrumentedClient(
+        Mock(fetch=Mock(return_value=make_future(response))), 10, 'localhost')
+
+    result = client.fetch(Mock(body='ab')).result()
+    stats = client.stats.stats()
+
+    assert metrics.UPSTREAM_SENT_BYTES.values == {('localhost',): 2}
+    assert metrics.UPSTREAM_RECEIVED_BYTES.values == {('localhost',): 3}
+    assert metrics.UPSTREAM_RESPONSES.values == {('localhost', '200'): 1}
+
+    assert result is response
+    assert stats['requests'] == 1
+    assert stats['in_flight'] == 0
+    assert stats['max_in_flight'] == 1
+    assert stats['errors'] == 0
+    assert stats['mean_seconds'] == {
+        'connect': 0.1, 'appconnect': 0.3, 'request': 0.5}
+
+
+def test_instrumented_client_records_error():
+    future = Future()
+    future.set_exception(httpclient.HTTPError(599, 'Connection refused'))
+    client = clients.InstrumentedClient(
+        Mock(fetch=Mock(return_value=future)), 10)
+
+    with pytest.raises(httpclient.HTTPError):
+        client.fetch('https://localhost').result()
+
+    stats = client.stats.stats()
+    assert stats['errors'] == 1
+    assert metrics.UPSTREAM_RESPONSES.values == {('', '599'): 1}
+    assert stats['in_flight'] == 0
+
+
+def test_host_stats_utilisation():
+    stats = clients.HostStats(4)
+    stats.started()
+
+    assert stats.stats()['utilisation'] == 0.25
+
+
+@patch('onboarding.models.clients.get_client')
+def test_api_uses_shared_client(get_client):
+    api = clients.API('https://localhost:8004', token='token1234')
+
+    get_client.assert_called_once_with('https://localhost:8004')
+    assert api.base_url == 'https://localhost:8004/v1'
+    assert api.token == 'token1234'
+    assert api.fetch.keywords['httpclient'] is get_client.return_value
+    assert api.repository.fetch is api.fetch
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+from mock import Mock
+import pytest
+from koi.test_helpers import make_future, gen_test
+
+from onboarding.models.coalesce import Coalescer, merge_n3
+
+
+def test_merge_n3_single_document():
+    assert merge_n3(['_:b0 <p> "x" .']) == '_:b0 <p> "x" .'
+
+
+def test_merge_n3_renames_blank_nodes():
+    documents = ['<a> <p> _:b0 .\n_:b0 <q> "1" .',
+                 '<b> <p> _:b0 .\n_:b0 <q> "2" .']
+
+    assert merge_n3(documents) == ('<a> <p> _:d0_b0 .\n_:d0_b0 <q> "1" .\n'
+                                   '<b> <p> _:d1_b0 .\n_:d1_b0 <q> "2" .')
+
+
+def test_merge_n3_ignores_literals():
+    documents = ['_:b0 <p> "see _:b0 and \\"_:b1\\"" .', '_:b1 <p> "" .']
+
+    assert merge_n3(documents) == ('_:d0_b0 <p> "see _:b0 and \\"_:b1\\"" .\n'
+                                   '_:d1_b1 <p> "" .')
+
+
+@gen_test
+def test_coalescer_combines_writes():
+    flush = Mock(return_value=make_future('result'))
+    writes = Coalescer(flush, window=0.01)
+
+    first = writes.add('key', 'a')
+    second = writes.add('key', 'b')
+    assert len(writes) == 2
+    assert not flush.called
+
+    results = yield [first, second]
+
+    assert results == ['result', 'result']
+    flush.assert_called_once_with('key', ['a', 'b'])
+    assert len(writes) == 0
+
+
+@gen_test
+def test_coalescer_keys_flushed_separately():
+    flush = Mock(side_effect=lambda key, items: make_future(items))
+    writes = Coalescer(flush, window=0.01)
+
+    results = yield [writes.add('key1', 'a'), writes.add('key2', 'b'),
+                     writes.add('key1', 'c')]
+
+    assert results == [['a', 'c'], ['b'], ['a', 'c']]
+    assert flush.call_count == 2
+
+
+def test_coalescer_max_bytes():
+    flush = Mock(side_effect=lambda key, items: make_future(items))
+    writes = Coalescer(flush, window=60, max_bytes=10)
+
+    first = writes.add('key', 'a', size=6)
+    assert not first.done()
+    second = writes.add('key', 'b', size=6)
+
+    assert first.result() == second.result() == ['a', 'b']
+    # later writes start a new batch
+    assert not writes.add('key', 'c', size=1).done()
+    writes.flush('key')
+
+
+def test_coalescer_flush_error():
+    flush = Mock(side_effect=ValueError('bad'))
+    writes = Coalescer(flush, window=60)
+    first = writes.add('key', 'a')
+    second = writes.add('key', 'b')
+
+    writes.flush('key')
+
+    for future in (first, second):
+        with pytest.raises(ValueError):
+            future.result()
@@ -0,0 +1,189 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import zlib
+
+import pytest
+from mock import Mock, patch
+from tornado import httpclient
+from tornado.concurrent import Future
+from koi.test_helpers import make_future
+
+from onboarding.models import compression
+
+DATA = 'source_id_types,source_ids\n' + 'id,1\n' * 100
+
+
+@pytest.fixture(autouse=True)
+def reset_peers():
+    compression.peers.clear()
+
+
+def make_error(status_code):
+    future = Future()
+    future.set_exception(httpclient.HTTPError(status_code))
+    return future
+
+
+def test_compress_and_decompress():
+    compressed = compression.compress(DATA)
+
+    assert len(compressed) < len(DATA)
+    assert compression.decompress(compressed, 'gzip', 10000) == DATA
+
+
+def test_compress_unicode():
+    compressed = compression.compress(u'Ev\xe1ns')
+
+    assert compression.decompress(compressed, 'gzip', 100) == 'Ev\xc3\xa1ns'
+
+
+def test_decompress_deflate():
+    assert compression.decompress(zlib.compress(DATA), 'deflate', 10000) == DATA
+
+
+def test_decompress_invalid():
+    with pytest.raises(compression.InvalidBody):
+        compression.decompress('not compressed', 'gzip', 10000)
+
+
+def test_decompress_too_large():
+    compressed = compression.compress(DATA)
+
+    with pytest.raises(compression.InvalidBody) as exc:
+        compression.decompress(compressed, 'gzip', len(DATA) - 1)
+
+    assert 'too large' in str(exc.value)
+
+
+def test_decompress_ratio():
+    compressed = compression.compress('a' * 100000)
+
+    with pytest.raises(compression.InvalidBody) as exc:
+        compression.decompress(compressed, 'gzip', 1000000, max_ratio=10)
+
+    assert 'ratio' in str(exc.value)
+
+
+def test_decompressor_stops_early():
+    compressed = compression.compress('a' * 1000000)
+    decompressor = compression.Decompressor('gzip', 1000)
+
+    with pytest.raises(compression.InvalidBody):
+        decompressor.feed(compressed[:len(compressed) // 2])
+
+    assert decompressor.size <= 1001
+
+
+def test_decompressor_in_parts():
+    compressed = compression.compress(DATA)
+    decompressor = compression.Decompressor('gzip', 10000, max_ratio=100)
+
+    result = ''.join(decompressor.feed(compressed[i:i + 10])
+                     for i in range(0, len(compressed), 10))
+
+    assert result + decompressor.flush() == DATA
+
+
+def test_encodings():
+    assert compression.is_supported('gzip')
+    assert compression.is_supported('Deflate')
+    assert compression.is_supported(None)
+    assert compression.is_supported('identity')
+    assert not compression.is_supported('br')
+    assert compression.is_compressed('gzip')
+    assert not compression.is_compressed(None)
+    assert not compression.is_compressed('identity')
+
+
+@patch.object(compression, 'request_min_size', 10)
+def test_request_encoding():
+    assert compression.request_encoding('https://repo', 10) == 'gzip'
+    assert compression.request_encoding('https://repo', 9) is None
+
+    compression.peers['repo'] = False
+    assert compression.request_encoding('https://repo', 10) is None
+    assert compression.request_encoding('https://other', 10) == 'gzip'
+
+
+@patch.object(compression, 'request_min_size', 0)
+def test_request_encoding_disabled():
+    assert compression.request_encoding('https://repo', 10) is None
+
+
+@patch.object(compression, 'request_min_size', 10)
+def test_send_compressed():
+    endpoint = Mock()
+    endpoint.post.return_value = make_future('response')
+
+    response = compression.send(endpoint, 'post', 'https://repo', DATA,
+                                {'Accept': 'application/json'},
+                                request_timeout=180).result()
+
+    assert response == 'response'
+    kwargs = endpoint.prepare_request.call_args[1]
+    assert kwargs['headers'] == {'Accept': 'application/json',
+                                 'Content-Encoding': 'gzip'}
+    assert kwargs['request_timeout'] == 180
+    assert compression.decompress(kwargs['body'], 'gzip', 10000) == DATA
+    assert compression.peers == {'repo': True}
+
+
+@patch.object(compression, 'request_min_size', 10)
+def test_send_rejected():
+    endpoint = Mock()
+    endpoint.post.side_effect = [make_error(415), make_future('response')]
+
+    response = compression.send(endpoint, 'post', 'https://repo', DATA,
+                                {}).result()
+
+    assert response == 'response'
+    endpoint.prepare_request.assert_called_with(headers={}, body=DATA)
+    assert compression.peers == {'repo': False}
+
+    endpoint.post.side_effect = None
+    endpoint.post.return_value = make_future('response')
+    compression.send(endpoint, 'post', 'https://repo', DATA, {}).result()
+    assert endpoint.post.call_count == 3
+    endpoint.prepare_request.assert_called_with(headers={}, body=DATA)
+
+
+@patch.object(compression, 'request_min_size', 10)
+def test_send_error_uncompressed():
+    endpoint = Mock()
+    endpoint.post.side_effect = lambda: make_error(400)
+
+    with pytest.raises(httpclient.HTTPError):
+        compression.send(endpoint, 'post', 'https://repo', DATA, {}).result()
+
+    assert endpoint.post.call_count == 2
+    assert 'repo' not in compression.peers
+
+
+@patch.object(compression, 'request_min_size', 10)
+def test_send_error_accepting_peer_not_retried():
+    compression.peers['repo'] = True
+    endpoint = Mock()
+    endpoint.post.side_effect = lambda: make_error(400)
+
+    with pytest.raises(httpclient.HTTPError):
+        compression.send(endpoint, 'post', 'https://repo', DATA, {}).result()
+
+    assert endpoint.post.call_count == 1
+
+
+@patch.object(compression, 'request_min_size', 10)
+def test_send_server_error_not_retried():
+    endpoint = Mock()
+    endpoint.post.side_effect = lambda: make_error(500)
+
+    with pytest.raises(httpclient.HTTPError):
+        compression.send(endpoint, 'post', 'https://repo', DATA, {}).result()
+
+    assert endpoint.post.call_count == 1
@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import os
+import threading
+
+import pytest
+from mock import patch
+from koi.test_helpers import gen_test
+
+from onboarding.models import executor
+from onboarding.models.assets import idmap_from_triples
+
+with open(os.path.join(os.path.dirname(__file__), '../fixture/transform.ttl'), 'r') as myfile:
+    TRIPLES = myfile.read()
+
+
+@pytest.fixture(autouse=True)
+def shutdown_executor(request):
+    request.addfinalizer(lambda: executor._executor and
+                         executor._executor.shutdown())
+    executor._executor = None
+
+
+def thread_name():
+    return threading.current_thread().name
+
+
+def fail():
+    raise ValueError('failed')
+
+
+@patch('onboarding.models.executor.options', cpu_executor='',
+       cpu_inline_threshold=0)
+def test_run_inline_without_executor(options):
+    assert executor.get_executor() is None
+    assert executor.run(100, thread_name).result() == thread_name()
+
+
+@patch('onboarding.models.executor.options', cpu_executor='thread',
+       cpu_workers=1, cpu_inline_threshold=100)
+def test_run_inline_below_threshold(options):
+    assert executor.run(100, thread_name).result() == thread_name()
+
+
+@patch('onboarding.models.executor.options', cpu_executor='thread',
+       cpu_workers=1, cpu_inline_threshold=100)
+def test_run_inline_error(options):
+    with pytest.raises(ValueError):
+        executor.run(1, fail).result()
+
+
+@patch('onboarding.models.executor.options', cpu_executor='thread',
+       cpu_workers=1, cpu_inline_threshold=100)
+@gen_test
+def test_run_in_thread(options):
+    name = yield executor.run(101, thread_name)
+
+    assert name != thread_name()
+
+
+@patch('onboarding.models.executor.options', cpu_executor='process',
+       cpu_workers=1, cpu_inline_threshold=100)
+@gen_test
+def test_run_in_process(options):
+    id_map = yield executor.run(len(TRIPLES), idmap_from_triples, [TRIPLES],
+                                '2e9ce79cfa710e80878920c98e076aa9',
+                                'openpermissions.org', 'hub1')
+
+    assert len(id_map) == 4
+
+
+@patch('onboarding.models.executor.options', cpu_executor='thread',
+       cpu_workers=1)
+def test_configure_recreates_executor(options):
+    first = executor.get_executor()
+    executor.configure()
+
+    assert executor.get_executor() is not first
+
+
+@patch('onboarding.models.executor.options', cpu_executor='unknown')
+def test_configure_unknown_executor(options):
+    with pytest.raises(ValueError):
+        executor.configure()
@@ -0,0 +1,89 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import pytest
+from mock import Mock
+from koi.exceptions import HTTPError
+from koi.test_helpers import make_future
+
+from onboarding.models import idempotency
+
+
+def test_fingerprint():
+    fingerprint = idempotency.fingerprint('data', 'text/csv', 'repo1')
+
+    assert fingerprint == idempotency.fingerprint(u'data', 'text/csv', 'repo1')
+    assert fingerprint != idempotency.fingerprint('data', 'text/csv', 'repo2')
+    assert fingerprint != idempotency.fingerprint('data', 'application/json',
+                                                  'repo1')
+    assert fingerprint != idempotency.fingerprint('data', 'text/csv', 'repo1',
+                                                  r2rml_url='http://mapping')
+    assert fingerprint != idempotency.fingerprint('data2', 'text/csv', 'repo1')
+
+
+def test_request_key():
+    assert idempotency.request_key('repo1', 'abc', 'key1') == (
+        'key', 'repo1', 'key1')
+    assert idempotency.request_key('repo1', 'abc',
+                                   dedupe_by_content=True) == (
+        'content', 'repo1', 'abc')
+    assert idempotency.request_key('repo1', 'abc') is None
+
+
+def test_run_once_without_key():
+    func = Mock(return_value=make_future(([], 200, [])))
+
+    idempotency.run_once(None, 'abc', func).result()
+    idempotency.run_once(None, 'abc', func).result()
+
+    assert func.call_count == 2
+
+
+def test_run_once_caches_success():
+    func = Mock(return_value=make_future(([{'entity_id': '1'}], 200, [])))
+
+    first = idempotency.run_once(('content', 'repo1', 'abc'), 'abc', func).result()
+    second = idempotency.run_once(('content', 'repo1', 'abc'), 'abc', func).result()
+
+    assert first == second == ([{'entity_id': '1'}], 200, [])
+    assert func.call_count == 1
+    assert idempotency.is_known(('content', 'repo1', 'abc'))
+
+
+def test_run_once_does_not_cache_errors():
+    func = Mock(return_value=make_future((None, 400, [{'message': 'bad'}])))
+
+    idempotency.run_once(('content', 'repo1', 'abc'), 'abc', func).result()
+    idempotency.run_once(('content', 'repo1', 'abc'), 'abc', func).result()
+
+    assert func.call_count == 2
+    assert not idempotency.is_known(('content', 'repo1', 'abc'))
+
+
+def test_run_once_key_reused():
+    func = Mock(return_value=make_future(([], 200, [])))
+    key = ('key', 'repo1', 'key1')
+
+    idempotency.run_once(key, 'abc', func).result()
+    with pytest.raises(HTTPError) as exc:
+        idempotency.run_once(key, 'def', func).result()
+
+    assert exc.value.status_code == 422
+
+
+def test_forget():
+    func = Mock(return_value=make_future(([], 200, [])))
+    keys = [('content', 'repo1', 'abc'), ('key', 'repo1', 'key1'),
+            ('content', 'repo2', 'abc')]
+    for key in keys:
+        idempotency.run_once(key, 'abc', func).result()
+
+    idempotency.forget('repo1')
+
+    assert [idempotency.is_known(key) for key in keys] == [False, False, True]
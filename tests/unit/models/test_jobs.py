@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import os
+import shutil
+import tempfile
+import time
+
+import pytest
+from mock import patch
+from tornado.concurrent import Future
+from tornado.gen import moment
+from koi.exceptions import HTTPError
+from koi.test_helpers import make_future, gen_test
+
+from onboarding.models import jobs
+
+
+@pytest.fixture
+def job_dir(request):
+    directory = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(directory))
+    return directory
+
+
+def finished_job(status=jobs.COMPLETED, age=0):
+    job = jobs.new_job('repo1')
+    job['status'] = status
+    job['updated'] = time.time() - age
+    return job
+
+
+def test_memory_backend():
+    backend = jobs.MemoryBackend()
+    job = jobs.new_job('repo1')
+
+    backend.save(job)
+
+    assert backend.get(job['id']) == job
+    assert backend.get('unknown') is None
+
+
+def test_memory_backend_evicts_oldest_finished():
+    backend = jobs.MemoryBackend(max_jobs=2)
+    running = jobs.new_job('repo1')
+    old = finished_job()
+    new = finished_job()
+
+    for job in [running, old, new]:
+        backend.save(job)
+
+    assert backend.get(running['id']) == running
+    assert backend.get(old['id']) is None
+    assert backend.get(new['id']) == new
+
+
+def test_memory_backend_expires_finished():
+    backend = jobs.MemoryBackend(ttl=10)
+    running = jobs.new_job('repo1')
+    running['updated'] -= 20
+    expired = finished_job(age=20)
+
+    backend.save(running)
+    backend.save(expired)
+
+    assert backend.get(running['id']) == running
+    assert backend.get(expired['id']) is None
+
+
+def test_file_backend(job_dir):
+    backend = jobs.FileBackend(os.path.join(job_dir, 'jobs'))
+    job = jobs.new_job('repo1')
+
+    backend.save(job)
+
+    # another process sees the same jobs
+    other = jobs.FileBackend(os.path.join(job_dir, 'jobs'))
+    assert other.get(job['id']) == job
+    assert other.get('unknown') is None
+    assert other.get('../../etc/passwd') is None
+
+
+def test_file_backend_expires_finished(job_dir):
+    backend = jobs.FileBackend(job_dir, ttl=10)
+    expired = finished_job(age=20)
+    backend.save(expired)
+    assert backend.get(expired['id']) is None
+
+    os.utime(backend._path(expired['id']), (time.time() - 20,) * 2)
+    backend.save(finished_job())
+
+    assert not os.path.exists(backend._path(expired['id']))
+
+
+@gen_test
+def test_queue_runs_job():
+    queue = jobs.JobQueue(jobs.MemoryBackend())
+    result = Future()
+
+    def work(progress):
+        progress(1, 2)
+        return result
+
+    job = queue.submit('repo1', work)
+    assert queue.get(job['id'])['status'] == jobs.QUEUED
+
+    yield moment
+    job = queue.get(job['id'])
+    assert job['status'] == jobs.RUNNING
+    assert job['progress'] == {'completed': 1, 'total': 2}
+
+    result.set_result(([{'entity_id': '1'}], 200, []))
+    yield moment
+    yield moment
+
+    job = queue.get(job['id'])
+    assert job['status'] == jobs.COMPLETED
+    assert job['http_status'] == 200
+    assert job['data'] == [{'entity_id': '1'}]
+
+
+@gen_test
+def test_queue_job_errors():
+    queue = jobs.JobQueue(jobs.MemoryBackend())
+    errors = [{'message': 'invalid'}]
+
+    job = queue.submit('repo1', lambda progress: make_future(
+        (None, 400, errors)))
+    for _ in range(3):
+        yield moment
+
+    job = queue.get(job['id'])
+    assert job['status'] == jobs.FAILED
+    assert job['http_status'] == 400
+    assert job['errors'] == errors
+
+
+@gen_test
+def test_queue_job_raises():
+    queue = jobs.JobQueue(jobs.MemoryBackend())
+    failed = Future()
+    failed.set_exception(HTTPError(401, 'expired', source='onboarding'))
+
+    job = queue.submit('repo1', lambda progress: failed)
+    for _ in range(3):
+        yield moment
+
+    job = queue.get(job['id'])
+    assert job['status'] == jobs.FAILED
+    assert job['http_status'] == 401
+    assert job['errors'] == [{'source': 'onboarding', 'message': 'expired'}]
+
+
+@gen_test
+def test_queue_limits_concurrent_jobs():
+    queue = jobs.JobQueue(jobs.MemoryBackend(), max_workers=1, max_queued=1)
+    first = Future()
+    second = Future()
+
+    job1 = queue.submit('repo1', lambda progress: first)
+    yield moment
+    job2 = queue.submit('repo1', lambda progress: second)
+    yield moment
+
+    assert queue.get(job1['id'])['status'] == jobs.RUNNING
+    assert queue.get(job2['id'])['status'] == jobs.QUEUED
+
+    with pytest.raises(HTTPError) as exc:
+        queue.submit('repo1', lambda progress: Future())
+    assert exc.value.status_code == 503
+
+    first.set_result(([], 200, []))
+    for _ in range(3):
+        yield moment
+    assert queue.get(job2['id'])['status'] == jobs.RUNNING
+
+
+@patch('onboarding.models.jobs.options', job_store='file', job_ttl=10)
+def test_configure_file(options, job_dir):
+    options.job_dir = job_dir
+    jobs.configure()
+
+    assert isinstance(jobs.get_queue().backend, jobs.FileBackend)
+    assert jobs.get_queue().backend.directory == job_dir
+
+
+@patch('onboarding.models.jobs.options', job_store='unknown')
+def test_configure_unknown_store(options):
+    with pytest.raises(ValueError):
+        jobs.configure()
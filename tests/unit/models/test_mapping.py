@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import json
+
+import pytest
+
+from onboarding.models import mapping
+from onboarding.models.assets import idmap_from_triples
+
+REPOSITORY_ID = '2e9ce79cfa710e80878920c98e076aa9'
+HUB_KEY = ('https://openpermissions.org/s1/hub1/'
+           '2e9ce79cfa710e80878920c98e076aa9/offer/'
+           '5417cd184450490584fd7236dae9a17a')
+
+CSV = (u'source_id_types,source_ids,offer_ids,set_ids,description\n'
+       u'examplecopictureid,100123,1~2,,Sunset over a Caribbean beach\n'
+       u'examplecopictureid~anotherpictureid,100456~999002,,s1,'
+       u'"Polar bear, ice floe"\n')
+
+JSON = json.dumps([
+    {'source_ids': [{'source_id_type': 'examplecopictureid',
+                     'source_id': '100123'}],
+     'offer_ids': [HUB_KEY],
+     'description': u'Evans é "quoted"\nline'},
+    {'source_ids': [{'source_id_type': 'examplecopictureid',
+                     'source_id': 100456}],
+     'set_ids': ['s1']}
+])
+
+
+def transform(data, content_type):
+    return mapping.transform(data, content_type, REPOSITORY_ID,
+                             'openpermissions.org', 'hub1')
+
+
+def source_ids(id_map):
+    return [sorted((s['source_id_type'], s['source_id'])
+                   for s in item['source_ids'])
+            for item in id_map]
+
+
+def test_transform_csv():
+    result, status, errors = transform(CSV, 'text/csv; charset=utf-8')
+
+    assert status == 200
+    assert errors == []
+    id_map = result['data']['id_map']
+    assert source_ids(id_map) == [
+        [('examplecopictureid', '100123')],
+        [('anotherpictureid', '999002'), ('examplecopictureid', '100456')]]
+    assert id_map[0]['hub_key'] == (
+        'https://openpermissions.org/s1/hub1/{}/asset/{}'.format(
+            REPOSITORY_ID, id_map[0]['entity_id']))
+
+    rdf_n3 = result['data']['rdf_n3']
+    assert rdf_n3.count('<http://openpermissions.org/ns/op/1.1/Asset> .') == 2
+    assert '<http://openpermissions.org/ns/id/1> <http://www.w3.org/1999/02/22-rdf-syntax-ns#type> <http://openpermissions.org/ns/op/1.1/Policy> .' in rdf_n3
+    assert '<http://openpermissions.org/ns/id/s1> <http://openpermissions.org/ns/op/1.1/hasElement> <http://openpermissions.org/ns/id/{}> .'.format(id_map[1]['entity_id']) in rdf_n3
+    assert '"Polar bear, ice floe"' in rdf_n3
+
+
+def test_transform_json():
+    result, status, errors = transform(JSON, 'application/json')
+
+    assert status == 200
+    id_map = result['data']['id_map']
+    assert source_ids(id_map) == [[('examplecopictureid', '100123')],
+                                  [('examplecopictureid', '100456')]]
+
+    rdf_n3 = result['data']['rdf_n3']
+    assert u'"Evans é \\"quoted\\"\\nline"' in rdf_n3
+    assert ('<http://openpermissions.org/ns/id/5417cd184450490584fd7236dae9a17a> '
+            '<http://openpermissions.org/ns/op/1.1/defaultTarget>') in rdf_n3
+
+
+@pytest.mark.parametrize('data,content_type', [
+    (CSV, 'text/csv'), (JSON, 'application/json')])
+def test_transform_matches_parsed_triples(data, content_type):
+    """The triples have the same ids as the transformation service output"""
+    result, _, _ = transform(data, content_type)
+
+    parsed = idmap_from_triples([result['data']['rdf_n3']], REPOSITORY_ID,
+                                'openpermissions.org', 'hub1')
+
+    assert [item['hub_key'] for item in parsed] == [
+        item['hub_key'] for item in result['data']['id_map']]
+    assert source_ids(parsed) == source_ids(result['data']['id_map'])
+
+
+@pytest.mark.parametrize('data,content_type,line', [
+    ('', 'text/csv', 1),
+    ('source_ids,description\n1,a', 'text/csv', 1),
+    ('source_id_types,source_ids\na~b,1', 'text/csv', 2),
+    ('source_id_types,source_ids\na,1\nb,', 'text/csv', 3),
+    ('source_id_types,source_ids\n', 'text/csv', None),
+    ('source_id_types,source_ids\rtestcoid,1\r', 'text/csv', 1),
+    ('source_id_types,source_ids\ntestcoid,1\rtestcoid,2\n', 'text/csv', 2),
+    ('', 'application/json', None),
+    ('{"source_ids": []}', 'application/json', None),
+    ('[{"description": "a"}]', 'application/json', None),
+    ('[{"source_ids": []}]', 'application/json', None),
+    ('[not json', 'application/json', None),
+])
+def test_transform_invalid(data, content_type, line):
+    result, status, errors = transform(data, content_type)
+
+    assert result is None
+    assert status == 400
+    assert len(errors) == 1
+    assert errors[0]['source'] == 'onboarding'
+    assert errors[0].get('line') == line
+
+
+def test_transform_unsupported_content_type():
+    result, status, errors = transform('data', 'text/plain')
+
+    assert status == 415
+
+
+def test_iri_part():
+    assert mapping.iri_part(u'id type/é') == u'id%20type%2F%C3%A9'
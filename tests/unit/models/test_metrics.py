@@ -0,0 +1,150 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import json
+import os
+
+from mock import patch
+from tornado.concurrent import Future
+
+from onboarding.models import metrics
+
+
+def test_counter():
+    counter = metrics.Counter('test_total', 'A test', labels=('host',))
+    counter.inc(host='a')
+    counter.inc(2, host='a')
+    counter.inc(host='b')
+
+    assert counter.values == {('a',): 3, ('b',): 1}
+
+
+def test_gauge():
+    gauge = metrics.Gauge('test_depth', 'A test', labels=('queue',))
+    gauge.set(3, queue='a')
+    gauge.set(1, queue='a')
+    gauge.set(2, queue='b')
+    gauge.remove(queue='b')
+    gauge.remove(queue='c')
+
+    assert gauge.values == {('a',): 1}
+    assert gauge.dump()['type'] == 'gauge'
+
+
+def test_histogram():
+    histogram = metrics.Histogram('test_seconds', 'A test', buckets=(1, 10))
+    histogram.observe(0.5)
+    histogram.observe(1)
+    histogram.observe(5)
+    histogram.observe(50)
+
+    assert histogram.values == {(): [2, 1, 1, 56.5]}
+
+
+def test_merge():
+    histogram = metrics.Histogram('test_seconds', 'A test', labels=('stage',),
+                                  buckets=(1,))
+    histogram.observe(0.5, stage='a')
+    first = {'test_seconds': histogram.dump()}
+    histogram.clear()
+    histogram.observe(2, stage='a')
+    histogram.observe(2, stage='b')
+    second = json.loads(json.dumps({'test_seconds': histogram.dump()}))
+
+    merged = metrics.merge([first, second])
+
+    assert merged['test_seconds']['values'] == [
+        (('a',), [1, 1, 2.5]), (('b',), [0, 1, 2.0])]
+
+
+def test_render():
+    counter = metrics.Counter('test_total', 'A test', labels=('code',))
+    counter.inc(code='200')
+    counter.inc(code='a"b')
+    histogram = metrics.Histogram('test_seconds', 'Another test',
+                                  labels=('stage',), buckets=(0.5, 1))
+    histogram.observe(0.25, stage='transform')
+    histogram.observe(2, stage='transform')
+
+    text = metrics.render(metrics.merge([{
+        'test_total': counter.dump(),
+        'test_seconds': histogram.dump()}]))
+
+    assert text == (
+        '# HELP test_seconds Another test\n'
+        '# TYPE test_seconds histogram\n'
+        'test_seconds_bucket{stage="transform",le="0.5"} 1\n'
+        'test_seconds_bucket{stage="transform",le="1"} 1\n'
+        'test_seconds_bucket{stage="transform",le="+Inf"} 2\n'
+        'test_seconds_sum{stage="transform"} 2.25\n'
+        'test_seconds_count{stage="transform"} 2\n'
+        '# HELP test_total A test\n'
+        '# TYPE test_total counter\n'
+        'test_total{code="200"} 1\n'
+        'test_total{code="a\\"b"} 1\n')
+
+
+def test_collect_without_directory():
+    metrics.REQUEST_BYTES.inc(10, method='POST')
+
+    with patch.object(metrics, 'directory', None):
+        collected = metrics.collect()
+
+    assert collected['onboarding_request_bytes_total']['values'] == [
+        (('POST',), 10)]
+
+
+def test_collect_adds_up_processes(tmpdir):
+    other = {'onboarding_request_bytes_total':
+             dict(metrics.REQUEST_BYTES.dump(), values=[[['POST'], 5]])}
+    tmpdir.join('1.json').write(json.dumps(other))
+    tmpdir.join('2.json').write('partial')
+    metrics.REQUEST_BYTES.inc(10, method='POST')
+
+    with patch.object(metrics, 'directory', str(tmpdir)):
+        collected = metrics.collect()
+
+    assert collected['onboarding_request_bytes_total']['values'] == [
+        (('POST',), 15)]
+    assert tmpdir.join('{}.json'.format(os.getpid())).check()
+
+
+@patch('onboarding.models.metrics.options')
+def test_configure_removes_old_files(options, tmpdir):
+    tmpdir.join('1.json').write('{}')
+    options.metrics_dir = str(tmpdir)
+
+    with patch.object(metrics, 'directory', None):
+        metrics.configure()
+        assert metrics.directory == str(tmpdir)
+
+    assert tmpdir.listdir() == []
+
+
+def test_timed():
+    future = Future()
+
+    @metrics.timed('test')
+    def func():
+        return future
+
+    assert func() is future
+    assert not metrics.STAGE_SECONDS.values
+
+    future.set_result(None)
+    assert sum(metrics.STAGE_SECONDS.values[('test',)][:-1]) == 1
+
+
+def test_timed_error():
+    future = Future()
+    future.set_exception(ValueError())
+
+    metrics.timed('test')(lambda: future)()
+
+    assert ('test',) in metrics.STAGE_SECONDS.values
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import pytest
+from tornado.ioloop import IOLoop
+from koi.test_helpers import gen_test
+
+from onboarding.models import profiler
+
+
+def busy():
+    return sum(range(1000))
+
+
+@gen_test
+def test_profile():
+    IOLoop.current().call_later(0.01, busy)
+
+    report = yield profiler.profile(0.05, sort='calls', limit=None)
+
+    assert 'function calls' in report
+    assert 'busy' in report
+
+
+@gen_test
+def test_profile_one_at_a_time():
+    first = profiler.profile(0.05)
+
+    with pytest.raises(profiler.ProfileRunning):
+        yield profiler.profile(0.05)
+
+    yield first
+    # another profile can be taken once the first has finished
+    yield profiler.profile(0.01)
@@ -0,0 +1,112 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import json
+
+import pytest
+
+from onboarding.models import records
+
+CSV = (
+    'source_id_types,source_ids,offer_ids,description\n'
+    'examplecopictureid,100123,1~2~3~4,Sunset over a Caribbean beach\n'
+    'examplecopictureid,100124,1~2,"A description, with a comma"\n'
+    'examplecopictureid,100125,1~2,"A ""quoted""\nmulti-line description"\n'
+    'examplecopictureid,100126,,\n')
+
+ASSETS = [
+    {'source_ids': [{'source_id_type': 'examplecopictureid',
+                     'source_id': str(i)}],
+     'description': 'An "escaped" \\ description, with [brackets] {}'}
+    for i in range(5)
+]
+
+
+def feed_in_pieces(splitter, data, size):
+    chunks = []
+    for i in range(0, len(data), size):
+        chunks.extend(splitter.feed(data[i:i + size]))
+    return chunks + splitter.close()
+
+
+def test_split_csv_by_records():
+    chunks = records.split(CSV, 'text/csv', max_records=2)
+    header = CSV.split('\n')[0] + '\n'
+
+    assert len(chunks) == 2
+    assert all(chunk.startswith(header) for chunk in chunks)
+    assert ''.join(chunk[len(header):] for chunk in chunks) == CSV[len(header):]
+
+
+@pytest.mark.parametrize('size', [1, 3, 7, 50, 1000])
+def test_split_csv_fed_in_pieces(size):
+    splitter = records.CSVSplitter(max_records=1)
+    chunks = feed_in_pieces(splitter, CSV, size)
+
+    assert len(chunks) == 4
+    assert '"A ""quoted""\nmulti-line description"' in chunks[2]
+
+
+def test_split_csv_by_size():
+    chunks = records.split(CSV, 'text/csv', max_size=1)
+
+    assert len(chunks) == 4
+
+
+def test_split_csv_without_trailing_newline():
+    chunks = records.split('a,b\n1,2', 'text/csv')
+
+    assert chunks == ['a,b\n1,2']
+
+
+def test_split_csv_header_only():
+    assert records.split('a,b\n', 'text/csv') == []
+
+
+def test_split_json_by_records():
+    data = json.dumps(ASSETS, indent=4)
+    chunks = records.split(data, 'application/json', max_records=2)
+
+    assert len(chunks) == 3
+    assert sum((json.loads(chunk) for chunk in chunks), []) == ASSETS
+
+
+@pytest.mark.parametrize('size', [1, 3, 7, 50, 1000])
+def test_split_json_fed_in_pieces(size):
+    data = json.dumps(ASSETS)
+    splitter = records.JSONSplitter(max_records=1)
+    chunks = feed_in_pieces(splitter, data, size)
+
+    assert [json.loads(chunk) for chunk in chunks] == [[a] for a in ASSETS]
+
+
+def test_split_json_empty_array():
+    assert records.split(' [ ] ', 'application/json') == []
+
+
+def test_split_json_not_an_array():
+    with pytest.raises(ValueError):
+        records.split('{"source_ids": []}', 'application/json')
+
+
+def test_split_json_incomplete():
+    with pytest.raises(ValueError):
+        records.split('[{"source_ids": []', 'application/json')
+
+
+def test_make_splitter():
+    assert isinstance(records.make_splitter('text/csv; charset=utf-8'),
+                      records.CSVSplitter)
+    assert isinstance(records.make_splitter('application/json'),
+                      records.JSONSplitter)
+
+
+def test_make_splitter_unsupported():
+    with pytest.raises(ValueError):
+        records.make_splitter('text/plain')
@@ -7,7 +7,9 @@
 # distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and limitations under the License.
 
+import base64
 import json
+import socket
 from mock import Mock, patch
 
 from tornado.gen import coroutine, Return
@@ -15,16 +17,17 @@ from tornado.concurrent import Future
 from tornado import httpclient
 import pytest
 from koi.exceptions import HTTPError
-from koi.test_helpers import make_future
+from koi.test_helpers import make_future, gen_test
 
 from onboarding.models import remote
 from onboarding.models.assets import onboard
 
 
+@patch('onboarding.models.assets.options', batch_size=0, local_transform=False)
 @patch('onboarding.models.remote.oauth2.get_token', return_value=make_future('token1234'))
 @patch('onboarding.models.remote.options')
 @patch('onboarding.models.remote.API')
-def test_onboard_csv(API, options, get_token):
+def test_onboard_csv(API, options, get_token, assets_options):
     options.service_id = 'test service ID'
     options.url_transformation = ''
     client = API()
@@ -156,3 +159,313 @@ def test_get_repository_empty(API, options, get_token):
         future.result()
 
     assert exc.value.status_code == 404
+
+
+@patch('onboarding.models.remote.token_ttl', return_value=300)
+@patch('onboarding.models.remote.oauth2.get_token', return_value=make_future('delegated'))
+@patch('onboarding.models.remote.options')
+def test_exchange_delegate_token_cached(options, get_token, token_ttl):
+
+    first = remote.exchange_delegate_token('token1234', 'repo1').result()
+    second = remote.exchange_delegate_token('token1234', 'repo1').result()
+
+    assert first == second == 'delegated'
+    assert get_token.call_count == 1
+    token_ttl.assert_called_once_with('token1234', 'delegated')
+    assert get_token.call_args[1]['cache'] is False
+
+
+@patch('onboarding.models.remote.token_ttl', return_value=300)
+@patch('onboarding.models.remote.oauth2.get_token', return_value=make_future('delegated'))
+@patch('onboarding.models.remote.options')
+def test_exchange_delegate_token_cached_per_repository(options, get_token, token_ttl):
+
+    remote.exchange_delegate_token('token1234', 'repo1').result()
+    remote.exchange_delegate_token('token1234', 'repo2').result()
+    remote.exchange_delegate_token('token5678', 'repo1').result()
+
+    assert get_token.call_count == 3
+
+
+@patch('onboarding.models.remote.token_ttl', return_value=0)
+@patch('onboarding.models.remote.oauth2.get_token', return_value=make_future('delegated'))
+@patch('onboarding.models.remote.options')
+def test_exchange_delegate_token_expired_not_cached(options, get_token, token_ttl):
+
+    remote.exchange_delegate_token('token1234', 'repo1').result()
+    remote.exchange_delegate_token('token1234', 'repo1').result()
+
+    assert get_token.call_count == 2
+
+
+@patch('onboarding.models.remote.oauth2.get_token')
+@patch('onboarding.models.remote.options')
+def test_exchange_delegate_token_forbidden(options, get_token):
+    response = Mock()
+    response.body = json.dumps({'errors': [{'message': 'not allowed'}]})
+    future = Future()
+    future.set_exception(httpclient.HTTPError(403, 'Forbidden', response))
+    get_token.return_value = future
+
+    with pytest.raises(HTTPError) as exc:
+        remote.exchange_delegate_token('token1234', 'repo1').result()
+
+    assert exc.value.status_code == 403
+    assert exc.value.errors == ['not allowed']
+    assert ('token1234', 'repo1') not in remote.delegate_tokens
+
+
+@patch('onboarding.models.remote.options')
+@patch('onboarding.models.remote.API')
+def test_get_repository_cached(API, options):
+    options.repository_cache_ttl = 300
+    data = {'data': {'id': 'repo1', 'service': {'location': 'https://repo'}}}
+    API().accounts.repositories.__getitem__().get.return_value = make_future(data)
+    API().accounts.repositories.__getitem__().get.reset_mock()
+
+    first = remote.get_repository('repo1').result()
+    second = remote.get_repository('repo1').result()
+
+    assert first == second == data['data']
+    assert API().accounts.repositories.__getitem__().get.call_count == 1
+
+
+@patch('onboarding.models.remote.options')
+@patch('onboarding.models.remote.API')
+def test_get_repository_not_found_cached(API, options):
+    options.repository_not_found_ttl = 10
+    response = Mock()
+    response.body = json.dumps({'status': 404, 'errors': [{'message': 'x'}]})
+    future = Future()
+    future.set_exception(httpclient.HTTPError(404, 'Not Found', response))
+    API().accounts.repositories.__getitem__().get.return_value = future
+    API().accounts.repositories.__getitem__().get.reset_mock()
+
+    for _ in range(2):
+        with pytest.raises(HTTPError) as exc:
+            remote.get_repository('repo1').result()
+        assert exc.value.status_code == 404
+        assert exc.value.errors == json.loads(response.body)
+
+    assert API().accounts.repositories.__getitem__().get.call_count == 1
+
+
+@patch('onboarding.models.remote.options')
+@patch('onboarding.models.remote.API')
+def test_get_repository_error_not_cached(API, options):
+    response = Mock()
+    response.body = json.dumps({'status': 500, 'errors': [{'message': 'x'}]})
+    future = Future()
+    future.set_exception(httpclient.HTTPError(500, 'Error', response))
+    API().accounts.repositories.__getitem__().get.return_value = future
+
+    with pytest.raises(HTTPError) as exc:
+        remote.get_repository('repo1').result()
+
+    assert exc.value.status_code == 500
+    assert 'repo1' not in remote.repositories
+
+
+def test_invalidate_repository():
+    remote.repositories.set('repo1', {'service': {'location': 'https://a'}})
+
+    remote.invalidate_repository('repo1', 'https://b')
+    assert 'repo1' in remote.repositories
+
+    remote.invalidate_repository('repo1', 'https://a')
+    assert 'repo1' not in remote.repositories
+
+
+@patch('onboarding.models.remote.options')
+@patch('onboarding.models.remote.API')
+def test_store_socket_error_invalidates_repository(API, options):
+    remote.repositories.set('repo1', {'service': {'location': 'https://a'}})
+    endpoint = API().repository.repositories.__getitem__().assets
+    endpoint.post.side_effect = socket.error('unknown host')
+
+    http_status, errors = remote.store(
+        {'data': {'rdf_n3': ''}}, 'https://a', 'repo1').result()
+
+    assert http_status == 500
+    assert 'repo1' not in remote.repositories
+
+
+@patch('onboarding.models.remote.options')
+@patch('onboarding.models.remote.API')
+def test_delete_connection_error_invalidates_repository(API, options):
+    remote.repositories.set('repo1', {'service': {'location': 'https://a'}})
+    endpoint = API().repository.repositories.__getitem__().assets
+    future = Future()
+    future.set_exception(httpclient.HTTPError(599, 'Connection refused'))
+    endpoint.delete.return_value = future
+
+    http_status, errors = remote.delete(
+        {'data': {'rdf_n3': ''}}, 'https://a', 'repo1').result()
+
+    assert http_status == 500
+    assert 'repo1' not in remote.repositories
+
+
+@patch.dict(remote.resilience.policies,
+            {'repository': remote.resilience.Policy(retries=2)})
+@patch('onboarding.models.remote.options')
+@patch('onboarding.models.remote.API')
+def test_store_does_not_retry_timeout(API, options):
+    endpoint = API().repository.repositories.__getitem__().assets
+    future = Future()
+    future.set_exception(httpclient.HTTPError(599, 'Timeout'))
+    endpoint.post.return_value = future
+
+    http_status, errors = remote.store(
+        {'data': {'rdf_n3': ''}}, 'https://a', 'repo1').result()
+
+    # the triples may have been stored, storing them again could add
+    # duplicate blank nodes
+    assert http_status == 500
+    assert endpoint.post.call_count == 1
+
+
+def make_transformation_error(status_code):
+    response = Mock()
+    response.body = json.dumps({'status': status_code,
+                                'errors': [{'message': 'invalid'}]})
+    future = Future()
+    future.set_exception(
+        httpclient.HTTPError(status_code, 'error', response))
+    return future
+
+
+@patch('onboarding.models.remote.oauth2.get_token',
+       return_value=make_future('token1234'))
+@patch('onboarding.models.remote.options')
+@patch('onboarding.models.remote.API')
+def test_transform_cached(API, options, get_token):
+    post = API.return_value.transformation.assets.post
+    post.return_value = make_future({'data': {'rdf_n3': 'triples'}})
+
+    first, http_status, errors = remote.transform(
+        'data', 'text/csv', None).result()
+    first['data']['id_map'] = []
+    second, http_status, errors = remote.transform(
+        u'data', 'text/csv', None).result()
+
+    assert post.call_count == 1
+    assert http_status == 200
+    assert second == {'data': {'rdf_n3': 'triples'}}
+
+    remote.transform('data', 'application/json', None).result()
+    remote.transform('data', 'text/csv', 'http://mapping').result()
+    remote.transform('other data', 'text/csv', None).result()
+    assert post.call_count == 4
+
+
+@patch('onboarding.models.remote.oauth2.get_token',
+       return_value=make_future('token1234'))
+@patch('onboarding.models.remote.options')
+@patch('onboarding.models.remote.API')
+def test_transform_cached_keeps_generated_ids(API, options, get_token):
+    # the transformation service generates a new entity id and timestamp
+    # for every call
+    responses = iter([
+        {'data': {'rdf_n3': '<http://openpermissions.org/ns/id/1> '
+                            '<http://purl.org/dc/terms/modified> "t1" .'}},
+        {'data': {'rdf_n3': '<http://openpermissions.org/ns/id/2> '
+                            '<http://purl.org/dc/terms/modified> "t2" .'}}])
+    post = API.return_value.transformation.assets.post
+    post.side_effect = lambda: make_future(next(responses))
+
+    first, _, _ = remote.transform('data', 'text/csv', None).result()
+    second, _, _ = remote.transform('data', 'text/csv', None).result()
+
+    # identical data onboarded again is stored with the same ids, by design
+    assert second['data']['rdf_n3'] == first['data']['rdf_n3']
+    assert post.call_count == 1
+
+    remote.transforms.clear()
+    third, _, _ = remote.transform('data', 'text/csv', None).result()
+    assert 'id/2' in third['data']['rdf_n3']
+
+
+@patch('onboarding.models.remote.oauth2.get_token',
+       return_value=make_future('token1234'))
+@patch('onboarding.models.remote.options')
+@patch('onboarding.models.remote.API')
+def test_transform_error_not_cached(API, options, get_token):
+    post = API.return_value.transformation.assets.post
+    post.side_effect = lambda: make_transformation_error(400)
+
+    for _ in range(2):
+        _, http_status, errors = remote.transform(
+            'data', 'text/csv', None).result()
+        assert http_status == 400
+        assert errors == [{'message': 'invalid'}]
+
+    assert post.call_count == 2
+
+
+@patch('onboarding.models.remote.resilience.circuit_failures', 1)
+@patch('onboarding.models.remote.options')
+@patch('onboarding.models.remote.API')
+def test_store_circuit_open(API, options):
+    remote.resilience.breakers.clear()
+    endpoint = API().repository.repositories.__getitem__().assets
+    future = Future()
+    future.set_exception(httpclient.HTTPError(599, 'Connection refused'))
+    endpoint.post.return_value = future
+
+    http_status, errors = remote.store(
+        {'data': {'rdf_n3': ''}}, 'https://a', 'repo1').result()
+    assert http_status == 500
+
+    http_status, errors = remote.store(
+        {'data': {'rdf_n3': ''}}, 'https://a', 'repo1').result()
+
+    assert http_status == 503
+    assert errors == [{'message': 'Service at https://a is unavailable'}]
+    assert endpoint.post.call_count == 1
+    remote.resilience.breakers.clear()
+
+
+def make_jwt(scope):
+    payload = base64.urlsafe_b64encode(json.dumps({'scope': scope}))
+    return 'header.{}.signature'.format(payload)
+
+
+@patch.object(remote.writes, 'window', 0.01)
+@patch('onboarding.models.remote.compression.send',
+       return_value=make_future(None))
+@patch('onboarding.models.remote.options')
+@patch('onboarding.models.remote.API')
+@gen_test
+def test_store_coalesced(API, options, send):
+    token1 = make_jwt('write:repo1')
+    token2 = make_jwt('write:repo1')
+
+    results = yield [
+        remote.store({'data': {'rdf_n3': '_:b0 <p> "1" .'}}, 'https://a',
+                     'repo1', token=token1),
+        remote.store({'data': {'rdf_n3': '_:b0 <p> "2" .'}}, 'https://a',
+                     'repo1', token=token2)]
+
+    assert results == [(200, []), (200, [])]
+    assert send.call_count == 1
+    assert send.call_args[0][3] == '_:d0_b0 <p> "1" .\n_:d1_b0 <p> "2" .'
+    API.assert_called_once_with('https://a', token=token1)
+
+
+@patch.object(remote.writes, 'window', 0.01)
+@patch('onboarding.models.remote.compression.send',
+       return_value=make_future(None))
+@patch('onboarding.models.remote.options')
+@patch('onboarding.models.remote.API')
+@gen_test
+def test_store_coalesced_by_repository_and_scope(API, options, send):
+    yield [
+        remote.store({'data': {'rdf_n3': '1'}}, 'https://a', 'repo1',
+                     token=make_jwt('write:repo1')),
+        remote.store({'data': {'rdf_n3': '2'}}, 'https://a', 'repo2',
+                     token=make_jwt('write:repo2')),
+        remote.store({'data': {'rdf_n3': '3'}}, 'https://a', 'repo1',
+                     token=make_jwt('read:repo1'))]
+
+    assert sorted(call[0][3] for call in send.call_args_list) == ['1', '2', '3']
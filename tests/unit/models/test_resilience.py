@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import socket
+
+from mock import Mock, patch
+import pytest
+from tornado import httpclient
+from tornado.concurrent import Future
+from koi.test_helpers import make_future
+
+from onboarding.models import resilience
+
+
+def make_error(code):
+    future = Future()
+    future.set_exception(httpclient.HTTPError(code, 'error'))
+    return future
+
+
+def test_policy_delay():
+    policy = resilience.Policy(backoff=0.1, max_backoff=0.3)
+
+    assert all(0 <= policy.delay(0) <= 0.1 for _ in range(100))
+    assert all(0 <= policy.delay(1) <= 0.2 for _ in range(100))
+    assert all(0 <= policy.delay(5) <= 0.3 for _ in range(100))
+
+
+def test_policy_request_kwargs():
+    policy = resilience.Policy(connect_timeout=1, request_timeout=2)
+
+    assert policy.request_kwargs() == {'connect_timeout': 1,
+                                       'request_timeout': 2}
+
+
+@patch.object(resilience.CircuitBreaker, '_now', return_value=100)
+def test_circuit_breaker_opens(_now):
+    breaker = resilience.CircuitBreaker(failures=2, reset_timeout=10)
+
+    breaker.failed()
+    assert breaker.allow()
+    breaker.failed()
+
+    assert breaker.state == breaker.OPEN
+    assert not breaker.allow()
+    assert breaker.retry_after() == 10
+
+
+@patch.object(resilience.CircuitBreaker, '_now', return_value=100)
+def test_circuit_breaker_success_resets_failures(_now):
+    breaker = resilience.CircuitBreaker(failures=2, reset_timeout=10)
+
+    breaker.failed()
+    breaker.succeeded()
+    breaker.failed()
+
+    assert breaker.allow()
+
+
+@patch.object(resilience.CircuitBreaker, '_now', return_value=100)
+def test_circuit_breaker_half_open(_now):
+    breaker = resilience.CircuitBreaker(failures=1, reset_timeout=10)
+    breaker.failed()
+
+    _now.return_value = 110
+    assert breaker.allow()
+    assert breaker.state == breaker.HALF_OPEN
+    # only one call is let through
+    assert not breaker.allow()
+
+    breaker.succeeded()
+    assert breaker.state == breaker.CLOSED
+    assert breaker.allow()
+
+
+@patch.object(resilience.CircuitBreaker, '_now', return_value=100)
+def test_circuit_breaker_half_open_failure(_now):
+    breaker = resilience.CircuitBreaker(failures=3, reset_timeout=10)
+    for _ in range(3):
+        breaker.failed()
+
+    _now.return_value = 110
+    assert breaker.allow()
+    breaker.failed()
+
+    assert breaker.state == breaker.OPEN
+    assert breaker.retry_after() == 10
+
+
+@patch('onboarding.models.resilience.sleep', return_value=make_future(None))
+@patch.dict(resilience.policies, {'repository': resilience.Policy(retries=2)})
+def test_call_retries(sleep):
+    func = Mock(side_effect=[make_error(503), make_error(599),
+                             make_future('ok')])
+
+    result = resilience.call('repository', func).result()
+
+    assert result == 'ok'
+    assert func.call_count == 3
+    func.assert_called_with(connect_timeout=20.0, request_timeout=180.0)
+    assert sleep.call_count == 2
+
+
+@patch('onboarding.models.resilience.sleep', return_value=make_future(None))
+@patch.dict(resilience.policies, {'repository': resilience.Policy(retries=1)})
+def test_call_gives_up(sleep):
+    func = Mock(side_effect=[make_error(503), make_error(504)])
+
+    with pytest.raises(httpclient.HTTPError) as exc:
+        resilience.call('repository', func).result()
+
+    assert exc.value.code == 504
+    assert func.call_count == 2
+
+
+@patch('onboarding.models.resilience.sleep', return_value=make_future(None))
+@patch.dict(resilience.policies, {'repository': resilience.Policy(retries=1)})
+def test_call_retries_socket_error(sleep):
+    func = Mock(side_effect=[socket.error('unknown host'), make_future('ok')])
+
+    assert resilience.call('repository', func).result() == 'ok'
+
+
+@patch('onboarding.models.resilience.sleep', return_value=make_future(None))
+@patch.dict(resilience.policies, {'repository': resilience.Policy(retries=2)})
+def test_call_does_not_retry_client_errors(sleep):
+    func = Mock(return_value=make_error(400))
+
+    with pytest.raises(httpclient.HTTPError):
+        resilience.call('repository', func).result()
+
+    assert func.call_count == 1
+    assert not sleep.called
+
+
+@patch('onboarding.models.resilience.sleep', return_value=make_future(None))
+@patch.dict(resilience.policies, {'repository': resilience.Policy(retries=3)})
+def test_call_not_idempotent_retries_unhandled(sleep):
+    curl_error = httpclient.HTTPError(599, "Couldn't connect to server")
+    curl_error.errno = 7
+    connect_failed = Future()
+    connect_failed.set_exception(curl_error)
+    func = Mock(side_effect=[socket.error('connection refused'),
+                             make_error(502), connect_failed,
+                             make_future('ok')])
+
+    result = resilience.call('repository', func, idempotent=False).result()
+
+    assert result == 'ok'
+    assert func.call_count == 4
+
+
+@pytest.mark.parametrize('code', [504, 599])
+@patch('onboarding.models.resilience.sleep', return_value=make_future(None))
+@patch.dict(resilience.policies, {'repository': resilience.Policy(retries=2)})
+def test_call_not_idempotent_does_not_retry_timeouts(sleep, code):
+    func = Mock(return_value=make_error(code))
+
+    with pytest.raises(httpclient.HTTPError):
+        resilience.call('repository', func, idempotent=False).result()
+
+    assert func.call_count == 1
+    assert not sleep.called
+
+
+@patch('onboarding.models.resilience.circuit_failures', 2)
+@patch('onboarding.models.resilience.breakers', {})
+def test_call_circuit_open():
+    func = Mock(return_value=make_error(502))
+    for _ in range(2):
+        with pytest.raises(httpclient.HTTPError):
+            resilience.call('repository', func, circuit='https://a').result()
+
+    with pytest.raises(resilience.CircuitOpen) as exc:
+        resilience.call('repository', func, circuit='https://a').result()
+
+    assert func.call_count == 2
+    assert exc.value.code == 503
+    assert exc.value.retry_after > 0
+    # other repositories are not affected
+    func.return_value = make_future('ok')
+    assert resilience.call('repository', func, circuit='https://b').result()
+
+
+@patch('onboarding.models.resilience.circuit_failures', 2)
+@patch('onboarding.models.resilience.breakers', {})
+def test_call_client_error_closes_circuit():
+    func = Mock(side_effect=[make_error(502), make_error(404),
+                             make_error(502), make_future('ok')])
+    for _ in range(3):
+        with pytest.raises(httpclient.HTTPError):
+            resilience.call('repository', func, circuit='https://a').result()
+
+    assert resilience.call('repository', func, circuit='https://a').result()
+
+
+@patch('onboarding.models.resilience.breakers', {})
+def test_call_without_circuit_breakers():
+    func = Mock(return_value=make_error(502))
+    for _ in range(10):
+        with pytest.raises(httpclient.HTTPError):
+            resilience.call('repository', func, circuit='https://a').result()
+
+    assert resilience.breakers == {}
+
+
+def test_in_flight_limit():
+    requests = resilience.InFlight(limit=2)
+
+    assert requests.acquire()
+    assert requests.acquire()
+    assert not requests.acquire()
+    requests.release()
+    assert requests.acquire()
+
+
+def test_in_flight_no_limit():
+    requests = resilience.InFlight()
+
+    assert all(requests.acquire() for _ in range(1000))
+
+
+@patch('onboarding.models.resilience.retry_after', 5)
+@patch('onboarding.models.resilience.circuit_reset_timeout', 30)
+@patch('onboarding.models.resilience.circuit_failures', 0)
+@patch('onboarding.models.resilience.requests', resilience.InFlight())
+@patch('onboarding.models.resilience.policies', {})
+@patch('onboarding.models.resilience.options')
+def test_configure(options):
+    options.transformation_connect_timeout = 1
+    options.transformation_request_timeout = 2
+    options.upstream_retries = 3
+    options.circuit_failures = 5
+    options.max_in_flight_requests = 4
+
+    resilience.configure()
+
+    policy = resilience.policies['transformation']
+    assert policy.request_kwargs() == {'connect_timeout': 1,
+                                       'request_timeout': 2}
+    assert policy.retries == 3
+    assert resilience.requests.limit == 4
+    assert resilience.circuit_failures == 5
+    assert set(resilience.policies) == set(resilience.UPSTREAMS)
@@ -0,0 +1,194 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import pytest
+from mock import Mock, patch
+from koi.test_helpers import gen_test, make_future
+from tornado.gen import sleep
+
+from onboarding.models import scheduler
+from onboarding.models.scheduler import FairScheduler, Share
+
+
+def test_no_limit():
+    fair = FairScheduler('test')
+
+    futures = [fair.acquire(Share('repo1')) for _ in range(100)]
+
+    assert all(future.done() for future in futures)
+    assert fair.active == 100
+
+
+def test_limit():
+    fair = FairScheduler('test', limit=2)
+
+    first = fair.acquire(Share('repo1'))
+    second = fair.acquire(Share('repo1'))
+    third = fair.acquire(Share('repo1'))
+
+    assert first.done() and second.done()
+    assert not third.done()
+    assert fair.waiting() == 1
+
+    with first.result():
+        pass
+
+    assert third.done()
+    assert fair.active == 2
+
+
+def test_queues_take_turns():
+    fair = FairScheduler('test', limit=1)
+    blocker = fair.acquire(Share('big'))
+    big = [fair.acquire(Share('big')) for _ in range(5)]
+    small = fair.acquire(Share('small'))
+    blocker.result().release()
+
+    granted = []
+    pending = big + [small]
+    # every call is granted and released once
+    for _ in range(len(pending)):
+        done = [future for future in pending if future.done()]
+        assert len(done) == 1
+        future = done[0]
+        pending.remove(future)
+        granted.append('small' if future is small else 'big')
+        future.result().release()
+
+    assert not pending
+    # the small queue doesn't wait for the big queue's backlog
+    assert granted.index('small') <= 1
+
+
+def test_weights():
+    fair = FairScheduler('test', limit=1)
+    blocker = fair.acquire(Share('blocker'))
+    high = [fair.acquire(Share('a', 'high')) for _ in range(8)]
+    low = [fair.acquire(Share('b', 'low')) for _ in range(8)]
+    blocker.result().release()
+
+    granted = []
+    pending = high + low
+    while pending:
+        done = [future for future in pending if future.done()]
+        assert len(done) == 1
+        future = done[0]
+        pending.remove(future)
+        granted.append('high' if future in high else 'low')
+        future.result().release()
+
+    # four high priority calls are granted for each low priority call
+    assert granted[:5].count('high') == 4
+
+
+def test_idle_queue_does_not_save_turns():
+    fair = FairScheduler('test', limit=1)
+    for _ in range(10):
+        fair.acquire(Share('busy')).result().release()
+
+    blocker = fair.acquire(Share('busy'))
+    busy = fair.acquire(Share('busy'))
+    late = fair.acquire(Share('late'))
+    blocker.result().release()
+
+    # the late queue gets the next turn but no more
+    assert busy.done() != late.done()
+
+
+def test_queue_removed_when_idle():
+    fair = FairScheduler('test', limit=1)
+    fair.acquire(Share('repo1')).result().release()
+
+    assert fair._queues == {}
+
+
+@patch.object(scheduler, 'QUEUE_DEPTH', scheduler.metrics.Gauge(
+    'test_depth', 'A test', labels=('stage', 'queue', 'priority')))
+def test_queue_depth():
+    fair = FairScheduler('test', limit=1)
+    first = fair.acquire(Share('repo1'))
+    fair.acquire(Share('repo1'))
+    fair.acquire(Share('repo1'))
+
+    assert scheduler.QUEUE_DEPTH.values == {
+        ('test', 'repo1', 'normal'): 2}
+
+    first.result().release()
+    assert scheduler.QUEUE_DEPTH.values == {
+        ('test', 'repo1', 'normal'): 1}
+
+
+def test_current_default():
+    assert scheduler.current() is scheduler.DEFAULT_SHARE
+
+
+def test_acquire_uses_current_share():
+    fair = FairScheduler('test', limit=1)
+    share = Share('repo1', 'high')
+
+    with scheduler.activate(share):
+        fair.acquire()
+
+    assert list(fair._queues) == [('repo1', 'high')]
+
+
+@gen_test
+def test_activate_follows_coroutines():
+    share = Share('repo1')
+    with scheduler.activate(share):
+        shares = []
+
+        def record(_):
+            shares.append(scheduler.current())
+
+        sleep(0.001).add_done_callback(record)
+
+    yield sleep(0.01)
+    assert shares == [share]
+    assert scheduler.current() is scheduler.DEFAULT_SHARE
+
+
+@gen_test
+def test_scheduled_holds_budget_during_call():
+    fair = FairScheduler('test', limit=1)
+    actives = []
+
+    def func(value):
+        actives.append(fair.active)
+        return make_future(value)
+
+    result = yield scheduler.scheduled(fair, func)('result')
+
+    assert result == 'result'
+    assert actives == [1]
+    assert fair.active == 0
+
+
+@gen_test
+def test_scheduled_releases_budget_on_error():
+    fair = FairScheduler('test', limit=1)
+    func = Mock(side_effect=ValueError)
+
+    with pytest.raises(ValueError):
+        yield scheduler.scheduled(fair, func)()
+
+    assert fair.active == 0
+
+
+@patch('onboarding.models.scheduler.options', max_scheduled_transforms=1,
+       max_scheduled_stores=2, schedule_share_by='caller')
+@patch.object(scheduler, 'share_by', 'repository')
+@patch.object(scheduler.stores, 'limit', 0)
+@patch.object(scheduler.transforms, 'limit', 0)
+def test_configure(options):
+    scheduler.configure()
+
+    assert scheduler.transforms.limit == 1
+    assert scheduler.stores.limit == 2
+    assert scheduler.share_by == 'caller'
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import base64
+import json
+
+import time
+
+from mock import Mock, patch
+import pytest
+from tornado.concurrent import Future
+from tornado import gen
+from koi.test_helpers import make_future, gen_test
+
+from onboarding.models import scheduler
+from onboarding.models.tokens import (token_expiry, token_scope, token_ttl,
+                                      MIN_TOKEN_LIFETIME, TokenManager)
+
+
+def make_jwt(**claims):
+    payload = base64.urlsafe_b64encode(json.dumps(claims)).rstrip('=')
+    return 'header.{}.signature'.format(payload)
+
+
+def test_token_expiry():
+    assert token_expiry(make_jwt(exp=1234)) == 1234
+
+
+def test_token_expiry_invalid_token():
+    assert token_expiry('not a jwt') is None
+    assert token_expiry(make_jwt(sub='no expiry')) is None
+    assert token_expiry(None) is None
+
+
+@patch('onboarding.models.tokens.time.time', return_value=1000)
+def test_token_ttl_uses_first_expiry(time):
+    ttl = token_ttl(make_jwt(exp=2000), make_jwt(exp=1500))
+
+    assert ttl == 500 - MIN_TOKEN_LIFETIME
+
+
+def test_token_ttl_unknown_expiry():
+    assert token_ttl(make_jwt(exp=2000), 'not a jwt') == 0
+
+
+def test_token_manager_reuses_token():
+    token = make_jwt(exp=time.time() + 3600)
+    fetch = Mock(return_value=make_future(token))
+    manager = TokenManager(fetch)
+
+    assert manager.get().result() == token
+    assert manager.get().result() == token
+    assert fetch.call_count == 1
+    manager.reset()
+
+
+def test_token_manager_token_without_expiry_not_reused():
+    fetch = Mock(return_value=make_future('token1234'))
+    manager = TokenManager(fetch)
+
+    manager.get().result()
+    manager.get().result()
+
+    assert fetch.call_count == 2
+
+
+def test_token_manager_refreshes_expiring_token():
+    fetch = Mock(side_effect=[
+        make_future(make_jwt(exp=time.time() + MIN_TOKEN_LIFETIME - 1)),
+        make_future('new')
+    ])
+    manager = TokenManager(fetch)
+
+    manager.get().result()
+
+    assert manager.get().result() == 'new'
+
+
+def test_token_manager_error_not_kept():
+    future = Future()
+    future.set_exception(ValueError())
+    token = make_jwt(exp=time.time() + 3600)
+    fetch = Mock(side_effect=[future, make_future(token)])
+    manager = TokenManager(fetch)
+
+    with pytest.raises(ValueError):
+        manager.get().result()
+
+    assert manager.get().result() == token
+    manager.reset()
+
+
+@gen_test
+def test_token_manager_merges_concurrent_refreshes():
+    future = Future()
+    fetch = Mock(return_value=future)
+    manager = TokenManager(fetch)
+
+    first = manager.get()
+    second = manager.get()
+    future.set_result('token1234')
+
+    assert (yield first) == 'token1234'
+    assert (yield second) == 'token1234'
+    assert fetch.call_count == 1
+
+
+@gen_test
+def test_token_manager_refreshes_in_background():
+    token = make_jwt(exp=time.time() + 3600)
+    fetch = Mock(side_effect=[make_future(token), make_future('new')])
+    manager = TokenManager(fetch, refresh_margin=3600 - 0.01)
+
+    yield manager.get()
+    assert manager._timeout is not None
+
+    while fetch.call_count < 2:
+        yield gen.sleep(0.01)
+
+    assert manager._token == 'new'
+
+
+@gen_test
+def test_token_manager_refreshes_outside_of_request_context():
+    token = make_jwt(exp=time.time() + 3600)
+    shares = []
+
+    def fetch():
+        shares.append(scheduler.current())
+        return make_future(token)
+
+    manager = TokenManager(fetch, refresh_margin=3600 - 0.01)
+    share = scheduler.Share('repo1')
+    with scheduler.activate(share):
+        future = manager.get()
+    yield future
+
+    while len(shares) < 2:
+        yield gen.sleep(0.01)
+
+    assert shares == [share, scheduler.DEFAULT_SHARE]
+
+
+def test_token_scope():
+    assert token_scope(make_jwt(scope='write:repo1')) == 'write:repo1'
+
+
+def test_token_scope_invalid_token():
+    assert token_scope('not a jwt') == 'not a jwt'
+    assert token_scope(make_jwt(sub='no scope')) == make_jwt(sub='no scope')
+    assert token_scope(None) is None
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+from mock import Mock, patch
+
+import pytest
+from tornado.gen import coroutine, moment
+from tornado.httpclient import HTTPRequest
+from tornado.simple_httpclient import SimpleAsyncHTTPClient
+from koi.test_helpers import make_future, gen_test
+
+from onboarding.models import tracing
+
+TRACE_ID = '4bf92f3577b34da6a3ce929d0e0e4736'
+PARENT_ID = '00f067aa0ba902b7'
+
+
+class FakeSink(object):
+    def __init__(self):
+        self.spans = []
+
+    def export(self, span):
+        self.spans.append(span)
+
+
+@pytest.yield_fixture
+def sink():
+    fake = FakeSink()
+    with patch.object(tracing, 'sink', fake):
+        yield fake
+
+
+def test_parse_traceparent():
+    value = '00-{}-{}-01'.format(TRACE_ID, PARENT_ID)
+
+    assert tracing.parse_traceparent(value) == (TRACE_ID, PARENT_ID)
+
+
+@pytest.mark.parametrize('value', [
+    None,
+    '',
+    'not a traceparent',
+    'ff-{}-{}-01'.format(TRACE_ID, PARENT_ID),
+    '00-{}-{}-01'.format('0' * 32, PARENT_ID),
+    '00-{}-{}-01'.format(TRACE_ID, '0' * 16),
+])
+def test_parse_invalid_traceparent(value):
+    assert tracing.parse_traceparent(value) is None
+
+
+def test_request_span_continues_trace():
+    request = Mock(method='POST', path='/v1/onboarding/repositories/r/assets',
+                   headers={'traceparent': '00-{}-{}-01'.format(TRACE_ID,
+                                                                PARENT_ID)})
+
+    span = tracing.request_span(request, 'assets')
+
+    assert span.trace_id == TRACE_ID
+    assert span.parent_id == PARENT_ID
+    assert span.attributes == {'method': 'POST', 'path': request.path}
+
+
+def test_request_span_starts_trace():
+    request = Mock(method='POST', path='/', headers={})
+
+    span = tracing.request_span(request, 'assets')
+
+    assert len(span.trace_id) == 32
+    assert span.parent_id is None
+
+
+def test_finish_without_sink():
+    with patch.object(tracing, 'sink', None):
+        tracing.Span('test').finish()
+
+
+def test_finish_exports_span(sink):
+    span = tracing.Span('test', TRACE_ID, PARENT_ID, a=1)
+    span.finish(ValueError('failed'), b=2)
+
+    assert len(sink.spans) == 1
+    record = sink.spans[0]
+    assert record['trace_id'] == TRACE_ID
+    assert record['parent_id'] == PARENT_ID
+    assert record['span_id'] == span.span_id
+    assert record['name'] == 'test'
+    assert record['attributes'] == {'a': 1, 'b': 2}
+    assert record['error'] == repr(ValueError('failed'))
+    assert record['duration'] >= 0
+
+
+def test_traced_outside_trace(sink):
+    func = tracing.traced(Mock(return_value=make_future(1), __name__='func'))
+
+    assert func().result() == 1
+    assert sink.spans == []
+
+
+@gen_test
+def test_traced_records_child_span():
+    @tracing.traced
+    @coroutine
+    def step():
+        yield moment
+        # the span is still current when the coroutine resumes
+        current = tracing.current()
+        raise ValueError(current.name)
+
+    sink = FakeSink()
+    parent = tracing.Span('assets')
+    with patch.object(tracing, 'sink', sink):
+        with tracing.activate(parent):
+            future = step()
+        assert tracing.current() is None
+
+        with pytest.raises(ValueError) as exc:
+            yield future
+
+    assert exc.value.args == ('test_tracing.step',)
+    assert len(sink.spans) == 1
+    assert sink.spans[0]['trace_id'] == parent.trace_id
+    assert sink.spans[0]['parent_id'] == parent.span_id
+    assert sink.spans[0]['name'] == 'test_tracing.step'
+    assert 'ValueError' in sink.spans[0]['error']
+
+
+@patch.object(SimpleAsyncHTTPClient, 'fetch_impl')
+def test_client_adds_traceparent(fetch_impl):
+    client = tracing.client_class()(force_instance=True)
+    span = tracing.Span('assets')
+    request = HTTPRequest('http://localhost')
+
+    with tracing.activate(span):
+        client.fetch_impl(request, None)
+
+    assert request.headers['traceparent'] == span.traceparent()
+    fetch_impl.assert_called_once_with(request, None)
+
+
+@patch.object(SimpleAsyncHTTPClient, 'fetch_impl')
+def test_client_outside_trace(fetch_impl):
+    client = tracing.client_class()(force_instance=True)
+    request = HTTPRequest('http://localhost')
+
+    client.fetch_impl(request, None)
+
+    assert 'traceparent' not in request.headers
+
+
+def test_client_class_is_reused():
+    assert tracing.client_class() is tracing.client_class(SimpleAsyncHTTPClient)
+    assert issubclass(tracing.client_class(), SimpleAsyncHTTPClient)
+
+
+@patch('onboarding.models.tracing.options')
+def test_configure_log_sink(options):
+    options.trace_sink = 'log'
+    options.trace_log_file = ''
+
+    with patch.object(tracing, 'sink', None):
+        tracing.configure()
+        assert isinstance(tracing.sink, tracing.LogSink)
+
+
+@patch('onboarding.models.tracing.options')
+def test_configure_no_sink(options):
+    options.trace_sink = ''
+
+    with patch.object(tracing, 'sink', None):
+        tracing.configure()
+        assert tracing.sink is None
+
+
+@patch('onboarding.models.tracing.options')
+def test_configure_unknown_sink(options):
+    options.trace_sink = 'unknown'
+
+    with pytest.raises(ValueError):
+        tracing.configure()
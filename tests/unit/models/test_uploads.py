@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import os
+import shutil
+import tempfile
+import time
+
+import pytest
+from mock import patch
+from koi.exceptions import HTTPError
+
+from onboarding.models import uploads
+from onboarding.models.uploads import UploadStore, checksum
+
+
+@pytest.fixture
+def upload_dir(request):
+    directory = tempfile.mkdtemp()
+    request.addfinalizer(lambda: shutil.rmtree(directory))
+    return directory
+
+
+def test_create(upload_dir):
+    store = UploadStore(upload_dir)
+
+    upload = store.create('repo1', 'text/csv', r2rml_url='http://mapping',
+                          local_transform=True)
+
+    assert store.get(upload['id']) == upload
+    assert upload['repository_id'] == 'repo1'
+    assert upload['content_type'] == 'text/csv'
+    assert upload['r2rml_url'] == 'http://mapping'
+    assert upload['local_transform'] is True
+    assert store.chunks(upload['id']) == []
+
+
+def test_get_unknown(upload_dir):
+    store = UploadStore(upload_dir)
+
+    assert store.get('0' * 32) is None
+
+
+def test_get_invalid_id(upload_dir):
+    store = UploadStore(upload_dir)
+    upload = store.create('repo1', 'text/csv')
+
+    assert store.get('../' + upload['id']) is None
+
+
+def test_get_expired(upload_dir):
+    store = UploadStore(upload_dir, ttl=60)
+    upload = store.create('repo1', 'text/csv')
+    old = time.time() - 61
+    os.utime(os.path.join(upload_dir, upload['id']), (old, old))
+
+    assert store.get(upload['id']) is None
+
+
+def test_create_removes_expired(upload_dir):
+    store = UploadStore(upload_dir, ttl=60)
+    expired = store.create('repo1', 'text/csv')
+    old = time.time() - 61
+    os.utime(os.path.join(upload_dir, expired['id']), (old, old))
+
+    upload = store.create('repo1', 'text/csv')
+
+    assert os.listdir(upload_dir) == [upload['id']]
+
+
+def test_put_chunk(upload_dir):
+    store = UploadStore(upload_dir)
+    upload = store.create('repo1', 'text/csv')
+
+    store.put_chunk(upload['id'], 2, 'b\n', checksum('b\n'))
+    store.put_chunk(upload['id'], 1, 'a\n', checksum('a\n').upper())
+
+    assert store.chunks(upload['id']) == [1, 2]
+    assert list(store.read(upload['id'], 2)) == ['a\n', 'b\n']
+
+
+def test_put_chunk_again_replaces_chunk(upload_dir):
+    store = UploadStore(upload_dir)
+    upload = store.create('repo1', 'text/csv')
+
+    store.put_chunk(upload['id'], 1, 'a\n', checksum('a\n'))
+    store.put_chunk(upload['id'], 1, 'b\n', checksum('b\n'))
+
+    assert list(store.read(upload['id'], 1)) == ['b\n']
+
+
+def test_put_chunk_checksum_mismatch(upload_dir):
+    store = UploadStore(upload_dir)
+    upload = store.create('repo1', 'text/csv')
+
+    with pytest.raises(HTTPError) as exc:
+        store.put_chunk(upload['id'], 1, 'a\n', checksum('b\n'))
+
+    assert exc.value.status_code == 400
+    assert store.chunks(upload['id']) == []
+
+
+@pytest.mark.parametrize('number', [0, 3])
+def test_put_chunk_invalid_number(upload_dir, number):
+    store = UploadStore(upload_dir, max_chunks=2)
+    upload = store.create('repo1', 'text/csv')
+
+    with pytest.raises(HTTPError) as exc:
+        store.put_chunk(upload['id'], number, 'a\n', checksum('a\n'))
+
+    assert exc.value.status_code == 400
+
+
+def test_put_chunk_too_large(upload_dir):
+    store = UploadStore(upload_dir, max_chunk_size=2)
+    upload = store.create('repo1', 'text/csv')
+
+    with pytest.raises(HTTPError) as exc:
+        store.put_chunk(upload['id'], 1, 'abc', checksum('abc'))
+
+    assert exc.value.status_code == 413
+
+
+def test_missing(upload_dir):
+    store = UploadStore(upload_dir)
+    upload = store.create('repo1', 'text/csv')
+    store.put_chunk(upload['id'], 2, 'b\n', checksum('b\n'))
+
+    assert store.missing(upload['id'], 3) == [1, 3]
+
+
+def test_lock(upload_dir):
+    store = UploadStore(upload_dir)
+    upload = store.create('repo1', 'text/csv')
+
+    assert store.lock(upload['id'])
+    assert not store.lock(upload['id'])
+    store.unlock(upload['id'])
+    assert store.lock(upload['id'])
+
+
+def test_remove(upload_dir):
+    store = UploadStore(upload_dir)
+    upload = store.create('repo1', 'text/csv')
+    store.put_chunk(upload['id'], 1, 'a\n', checksum('a\n'))
+
+    store.remove(upload['id'])
+
+    assert store.get(upload['id']) is None
+    assert os.listdir(upload_dir) == []
+
+
+@patch('onboarding.models.uploads.store', None)
+def test_configure(upload_dir):
+    with patch('onboarding.models.uploads.options',
+               upload_dir=os.path.join(upload_dir, 'uploads'), upload_ttl=60,
+               max_upload_chunk_size=100, max_upload_chunks=10):
+        store = uploads.get_store()
+
+    assert os.path.isdir(store.directory)
+    assert store.ttl == 60
+    assert store.max_chunk_size == 100
+    assert store.max_chunks == 10
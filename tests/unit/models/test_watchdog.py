@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+# Copyright 2016 Open Permissions Platform Coalition
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License. You may obtain a copy of the License at
+# http://www.apache.org/licenses/LICENSE-2.0
+# Unless required by applicable law or agreed to in writing, software distributed under the License is
+# distributed on an "AS IS" BASIS, WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and limitations under the License.
+
+import sys
+
+from mock import Mock, patch
+
+from onboarding.models import watchdog
+
+
+def test_start():
+    io_loop = Mock()
+    dog = watchdog.Watchdog(io_loop, 0.5)
+
+    dog.start()
+
+    io_loop.set_blocking_signal_threshold.assert_called_once_with(
+        0.5, dog.sample)
+
+
+@patch('onboarding.models.watchdog.signal.setitimer')
+@patch('onboarding.models.watchdog.logging')
+def test_sample_logs_stack(logging, setitimer):
+    io_loop = Mock()
+    dog = watchdog.Watchdog(io_loop, 0.5, max_samples=2)
+
+    dog.sample(14, sys._getframe())
+    dog.sample(14, sys._getframe())
+
+    # the end of the block is detected once
+    io_loop.add_callback_from_signal.assert_called_once_with(dog.unblocked)
+    assert logging.warning.call_count == 2
+    assert 'test_sample_logs_stack' in logging.warning.call_args[0][-1]
+    # sampled again until there are max_samples samples
+    setitimer.assert_called_once_with(watchdog.signal.ITIMER_REAL, 0.5, 0)
+
+
+@patch('onboarding.models.watchdog.signal.setitimer')
+@patch('onboarding.models.watchdog.logging')
+def test_unblocked_records_duration(logging, setitimer):
+    dog = watchdog.Watchdog(Mock(), 0.5)
+    dog.sample(14, sys._getframe())
+
+    dog.unblocked()
+
+    assert dog.blocked_since is None
+    counts = watchdog.BLOCKED_SECONDS.values[()]
+    # one block of a little over 0.5 seconds
+    assert sum(counts[:-1]) == 1
+    assert 0.5 <= counts[-1] < 1
+
+    # a new block is sampled from the start
+    dog.sample(14, sys._getframe())
+    assert dog.samples == 1
+
+
+@patch('onboarding.models.watchdog.IOLoop')
+@patch('onboarding.models.watchdog.options')
+def test_start_disabled(options, IOLoop):
+    options.blocking_threshold = 0
+
+    watchdog.start()
+
+    assert not IOLoop.current.return_value.set_blocking_signal_threshold.called
+
+
+@patch.object(watchdog, '_watchdog', None)
+@patch('onboarding.models.watchdog.IOLoop')
+@patch('onboarding.models.watchdog.options')
+def test_start_enabled(options, IOLoop):
+    options.blocking_threshold = 0.2
+    options.blocking_max_samples = 3
+
+    watchdog.start()
+
+    IOLoop.current.return_value.set_blocking_signal_threshold.\
+        assert_called_once_with(0.2, watchdog._watchdog.sample)
+    assert watchdog._watchdog.max_samples == 3
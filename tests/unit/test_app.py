@@ -11,15 +11,33 @@ from mock import patch
 from tornado.web import Application
 
 import onboarding.app
+from onboarding.controllers.repository_handler import (AssetHandler,
+                                                       AssetStreamHandler)
 
 
+@patch('onboarding.app.watchdog')
+@patch('onboarding.app.uploads')
+@patch('onboarding.app.scheduler')
+@patch('onboarding.app.resilience')
+@patch('onboarding.app.tracing')
+@patch('onboarding.app.metrics')
+@patch('onboarding.app.compression')
+@patch('onboarding.app.idempotency')
+@patch('onboarding.app.executor')
+@patch('onboarding.app.jobs')
+@patch('onboarding.app.clients')
+@patch('onboarding.app.remote')
 @patch('onboarding.app.options')
 @patch('tornado.ioloop.IOLoop.instance')
 @patch('onboarding.app.koi.make_application')
 @patch('onboarding.app.koi.make_server')
 @patch('onboarding.app.koi.load_config')
 def test_main_configure_and_run_service(load_config, make_server,
-                                        make_application, instance, options):
+                                        make_application, instance, options,
+                                        remote, clients, jobs, executor,
+                                        idempotency, compression, metrics,
+                                        tracing, resilience, scheduler,
+                                        uploads, watchdog):
     server = make_server.return_value
     options.processes = 1
     # MUT
@@ -29,4 +47,41 @@ def test_main_configure_and_run_service(load_config, make_server,
     make_application.call_count == 1
     make_server.call_count == 1
     server.start.assert_called_once_with(1)
+    remote.configure.assert_called_once_with()
+    clients.configure.assert_called_once_with()
+    jobs.configure.assert_called_once_with()
+    executor.configure.assert_called_once_with()
+    idempotency.configure.assert_called_once_with()
+    compression.configure.assert_called_once_with()
+    metrics.configure.assert_called_once_with()
+    metrics.start.assert_called_once_with()
+    tracing.configure.assert_called_once_with()
+    resilience.configure.assert_called_once_with()
+    scheduler.configure.assert_called_once_with()
+    uploads.configure.assert_called_once_with()
+    watchdog.start.assert_called_once_with()
+    make_application.return_value.add_transform.assert_called_once_with(
+        compression.GZipContentEncoding)
     instance.call_count == 1
+
+
+@patch('onboarding.app.options')
+def test_application_urls(options):
+    options.stream_uploads = False
+
+    urls = onboarding.app.application_urls()
+
+    assert urls == onboarding.app.APPLICATION_URLS
+
+
+@patch('onboarding.app.options')
+def test_application_urls_stream_uploads(options):
+    options.stream_uploads = True
+
+    urls = onboarding.app.application_urls()
+    handlers = [url[1] for url in urls]
+
+    assert len(urls) == len(onboarding.app.APPLICATION_URLS)
+    assert AssetStreamHandler in handlers
+    assert AssetHandler not in handlers
+    assert urls[0] == onboarding.app.APPLICATION_URLS[0]